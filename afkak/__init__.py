@@ -7,7 +7,7 @@ from __future__ import absolute_import
 from .client import KafkaClient
 from .kafkacodec import (
     create_message, create_message_set,
-    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY,
+    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4, CODEC_ZSTD,
 )
 from .producer import Producer
 from .partitioner import RoundRobinPartitioner, HashedPartitioner
@@ -25,6 +25,6 @@ __all__ = [
     'KafkaClient', 'Producer', 'Consumer',
     'RoundRobinPartitioner', 'HashedPartitioner',
     'create_message', 'create_message_set',
-    'CODEC_NONE', 'CODEC_GZIP', 'CODEC_SNAPPY',
+    'CODEC_NONE', 'CODEC_GZIP', 'CODEC_SNAPPY', 'CODEC_LZ4', 'CODEC_ZSTD',
     'OFFSET_EARLIEST', 'OFFSET_LATEST', 'OFFSET_COMMITTED',
 ]
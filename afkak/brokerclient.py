@@ -10,12 +10,13 @@ Low level network client for the Apache Kafka Message Broker.
 from __future__ import absolute_import
 
 import logging
-from collections import OrderedDict
-from functools import partial
+from collections import deque
+from operator import attrgetter
 
 from twisted.internet.defer import Deferred, fail, succeed
 from twisted.internet.error import ConnectionDone, UserError
 from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.python.failure import Failure
 
 from .common import CancelledError, ClientError, DuplicateRequestError
 from .kafkacodec import KafkaCodec
@@ -30,20 +31,37 @@ INIT_DELAY_SECONDS = 0.1
 
 class _Request(object):
 
-    """Private class to encapsulate requests we are processing."""
+    """Private class to encapsulate requests we are processing.
 
-    sent = False  # Have we written this request to our protocol?
+    One of these is made for every request, so it is kept small: anything
+    needed only when the request is cancelled or logged is made then.
+    """
+
+    __slots__ = ('id', 'data', 'expect', 'canceller', 'partCallback', 'seq',
+                 'retry', 'sent', 'd')
 
-    def __init__(self, requestId, data, expectResponse, canceller=None):
+    def __init__(self, requestId, data, expectResponse, canceller=None,
+                 partCallback=None, seq=0, retry=True):
         self.id = requestId
         self.data = data
         self.expect = expectResponse
+        # Called with the requestId if the deferred is cancelled
         self.canceller = canceller
-        self.d = Deferred(canceller=canceller)
-        self._repr = '_Request:{}:{}'.format(self.id, self.expect)
+        # Called as the response arrives in pieces
+        self.partCallback = partCallback
+        # Order in which the request was made, for resending
+        self.seq = seq
+        # Is it resent if the connection is lost after it was sent?
+        self.retry = retry
+        # Have we written this request to our protocol?
+        self.sent = False
+        self.d = Deferred(self._cancel if canceller is not None else None)
+
+    def _cancel(self, d):
+        self.canceller(self.id)
 
     def __repr__(self):
-        return self._repr
+        return '_Request:{}:{}'.format(self.id, self.expect)
 
 
 class _KafkaBrokerClient(ReconnectingClientFactory):
@@ -68,7 +86,8 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
                  subscriber=None,
                  maxDelay=MAX_RECONNECT_DELAY_SECONDS,
                  maxRetries=None,
-                 initDelay=INIT_DELAY_SECONDS):
+                 initDelay=INIT_DELAY_SECONDS,
+                 maxInFlight=None):
         """Create a _KafkaBrokerClient for a given host/port.
 
         Create a new object to manage the connection to a single Kafka broker.
@@ -94,6 +113,10 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
                 made.
             initDelay: Initial delay, multiplied by 'factor', when reconnecting
                 after the connection is lost. Defaults to 0.1 seconds.
+            maxInFlight (int): The most requests to have sent to the broker
+                without having received their responses. Further requests
+                wait, in the order they were made, for responses to arrive.
+                Defaults to None, for no limit.
         """
         self.clock = reactor  # ReconnectingClientFactory uses self.clock.
         self.host = host
@@ -112,8 +135,18 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
 
         # The protocol object for the current connection
         self.proto = None
-        # ordered dict of _Requests, keyed by requestId
-        self.requests = OrderedDict()
+        # dict of _Requests, keyed by requestId
+        self.requests = {}
+        # _Requests yet to be sent, in the order they were made. This may
+        # hold requests since removed from self.requests, which are skipped.
+        self._unsent = deque()
+        # Sequence number of the last request made
+        self._seq = 0
+        self.maxInFlight = maxInFlight
+        # How many of those have been sent and await a response
+        self._inFlight = 0
+        # Deferreds returned by waitForRoom(), in the order it was called
+        self._roomWaiters = []
         # deferred which fires when the close() completes
         self._dDown = None
         self._subscriber = subscriber
@@ -125,7 +158,8 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
             'connected' if self.connected() else 'unconnected',
         )
 
-    def makeRequest(self, requestId, request, expectResponse=True):
+    def makeRequest(self, requestId, request, expectResponse=True,
+                    partCallback=None, retry=True):
         """
         Send a request to our broker via our self.proto KafkaProtocol object.
 
@@ -134,6 +168,16 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
         return None instead.
         If we are not currently connected, then we buffer the request to send
         when the connection comes back up.
+
+        If partCallback is given, it is called each time part of a response
+        which arrives in pieces does, see :meth:`handleResponsePart`, and
+        with the whole response before the deferred fires. It may see the
+        start of more than one response, should the connection be lost and
+        the request be retried.
+
+        If retry is False, the deferred fails with the reason the connection
+        was lost, should that happen after the request was sent, rather than
+        the request being sent again over the next connection.
         """
         if requestId in self.requests:
             # Id is duplicate to 'in-flight' request. Reject it, as we
@@ -151,27 +195,49 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
             return fail(ClientError('makeRequest() called after close()'))
 
         # Ok, we are going to save/send it, create a _Request object to track
-        canceller = partial(
-            self.cancelRequest, requestId,
-            CancelledError("Request:{} was cancelled".format(requestId)))
-        tReq = _Request(requestId, request, expectResponse, canceller)
+        self._seq += 1
+        tReq = _Request(requestId, request, expectResponse,
+                        self._cancelRequest, partCallback, self._seq, retry)
 
-        # add it to our requests dict
+        # add it to our requests dict. Whatever removes it from there fires
+        # its deferred, so there's no need for an errback to do so.
         self.requests[requestId] = tReq
 
-        # Add an errback to the tReq.d to remove it from our requests dict
-        # if something goes wrong...
-        tReq.d.addErrback(self._handleRequestFailure, requestId)
-
         # Do we have a connection over which to send the request?
-        if self.proto:
+        if self.proto and self.maxInFlight is None:
             # Send the request
             self._sendRequest(tReq)
-        # Have we not even started trying to connect yet? Do so now
-        elif not self.connector:
-            self._connect()
+        else:
+            self._unsent.append(tReq)
+            if self.proto:
+                # Send it if it's at the head of the queue, and there's room
+                self._sendQueued()
+            # Have we not even started trying to connect yet? Do so now
+            elif not self.connector:
+                self._connect()
         return tReq.d
 
+    def waitForRoom(self):
+        """
+        Wait until a request made now would be sent without waiting for
+        responses to others: until fewer than `maxInFlight` requests have
+        been sent and await their responses. That is the same count which
+        holds requests back from being sent.
+
+        Callers which can hold on to their data, rather than queue up
+        requests, use this to match their pace to the broker's.
+
+        :returns:
+            :class:`Deferred` which fires with ``None``. Callers are woken
+            in the order they called, as room becomes available. It may be
+            cancelled.
+        """
+        if not self._roomWaiters and self._hasRoom():
+            return succeed(None)
+        d = Deferred(canceller=self._roomWaiters.remove)
+        self._roomWaiters.append(d)
+        return d
+
     def disconnect(self):
         """Disconnect from the Kafka broker by closing the socket.
         Does not cancel requests, so they will be retried."""
@@ -289,8 +355,39 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
             # when it's cancelled, causing us to remove it from self.requests
             log.warning('Unexpected response:%r, %r', requestId, response)
         else:
+            self._requestDone(tReq)
+            if tReq.partCallback is not None:
+                try:
+                    tReq.partCallback(response, len(response))
+                except Exception:
+                    log.exception('%r: Failure in partCallback for %r',
+                                  self, tReq)
             tReq.d.callback(response)
 
+    def handleResponsePart(self, response, received):
+        """Handle the part of a response received by KafkaProtocol so far.
+
+        Once the correlation ID has arrived, the partCallback of the request
+        it belongs to, if any, is called with the response's buffer and the
+        number of bytes of it which have been received. Should it raise, the
+        request fails with the exception, and the rest of its response is
+        ignored.
+        """
+        if received < 4:
+            return
+        requestId = KafkaCodec.get_response_correlation_id(response)
+        tReq = self.requests.get(requestId)
+        if tReq is not None and tReq.partCallback is not None:
+            try:
+                tReq.partCallback(response, received)
+            except Exception:
+                failure = Failure()
+                log.exception('%r: Failure in partCallback for %r',
+                              self, tReq)
+                del self.requests[requestId]
+                self._requestDone(tReq)
+                tReq.d.errback(failure)
+
     # # Private Methods # #
 
     def _sendRequest(self, tReq):
@@ -303,20 +400,51 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
                 '%r: request id: %d send failed:', self, tReq.id)
             del self.requests[tReq.id]
             tReq.d.errback(e)
+            self._notifyRoom()
         else:
             if not tReq.expect:
                 # Once we've sent a request for which we don't expect a reply,
                 # we're done, remove it from requests, and fire the deferred
-                # with 'None', since there is no reply to be expected
+                # with 'None', since there is no reply to be expected. But
+                # write it first, as it won't be resent should the
+                # connection be lost before the protocol gets round to it.
+                self.proto.flush()
                 del self.requests[tReq.id]
                 tReq.d.callback(None)
+                self._notifyRoom()
+            else:
+                self._inFlight += 1
 
     def _sendQueued(self):
-        """Connection just came up, send the unsent requests."""
-        for tReq in list(self.requests.values()):  # must copy, may del
-            if not tReq.sent:
+        """Send the unsent requests, in order, as far as the window allows.
+
+        This is called when the connection comes up, and when a response
+        makes room in the window.
+        """
+        unsent = self._unsent
+        while unsent and (self.maxInFlight is None or
+                          self._inFlight < self.maxInFlight):
+            tReq = unsent.popleft()
+            if not tReq.sent and self.requests.get(tReq.id) is tReq:
                 self._sendRequest(tReq)
 
+    def _hasRoom(self):
+        """Would a new request be sent without waiting?"""
+        return self.maxInFlight is None or self._inFlight < self.maxInFlight
+
+    def _notifyRoom(self):
+        """Wake the callers of waitForRoom() for which there's room."""
+        while self._roomWaiters and self._hasRoom():
+            self._roomWaiters.pop(0).callback(None)
+
+    def _requestDone(self, tReq):
+        """A request was removed from self.requests: update the window."""
+        if tReq.sent and tReq.expect:
+            self._inFlight -= 1
+            if self.proto:
+                self._sendQueued()
+        self._notifyRoom()
+
     def cancelRequest(self, requestId, reason=CancelledError(), _=None):
         """Cancel a request: remove it from requests, & errback the deferred.
 
@@ -325,30 +453,39 @@ class _KafkaBrokerClient(ReconnectingClientFactory):
           received) will raise KeyError
         """
         tReq = self.requests.pop(requestId)
+        self._requestDone(tReq)
         tReq.d.errback(reason)
 
+    def _cancelRequest(self, requestId):
+        """Cancel a request whose deferred was cancelled."""
+        self.cancelRequest(
+            requestId,
+            CancelledError("Request:{} was cancelled".format(requestId)))
+
     def _handlePending(self, reason):
         """Connection went down: handle in-flight & unsent as configured.
 
-        Note: for now, we just 'requeue' all the in-flight by setting their
-          'sent' variable to False and let '_sendQueued()' handle resending
-          when the connection comes back.
-          In the future, we may want to extend this so we can errback()
-          to our client's any in-flight (and possibly queued) so they can deal
-          with it at the application level.
+        Note: we 'requeue' all the in-flight by setting their 'sent'
+          variable to False and let '_sendQueued()' handle resending when
+          the connection comes back, except for those made with
+          retry=False, which are errback()'d with the reason.
         """
-        for tReq in self.requests.values():
+        failed = []
+        for tReq in list(self.requests.values()):  # must copy, may del
+            if tReq.sent and not tReq.retry:
+                del self.requests[tReq.id]
+                failed.append(tReq)
             tReq.sent = False
+        self._unsent = deque(sorted(self.requests.values(),
+                                    key=attrgetter('seq')))
+        self._inFlight = 0
+        if failed:
+            for tReq in failed:
+                tReq.d.errback(
+                    reason if reason is not None else ConnectionDone())
+            self._notifyRoom()
         return reason
 
-    def _handleRequestFailure(self, failure, requestId):
-        """Remove a failed request from our bookkeeping dict.
-
-        Not an error if already removed (canceller removes).
-        """
-        self.requests.pop(requestId, None)
-        return failure
-
     def _connect(self):
         """Initiate a connection to the Kafka Broker."""
         log.debug('%r: _connect', self)
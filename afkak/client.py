@@ -9,17 +9,20 @@ High level network client for an Apache Kafka Cluster.
 from __future__ import absolute_import
 
 import logging
+import math
 import random
 import collections
 from functools import partial
+from heapq import heappop, heappush
 from numbers import Real
 from twisted.names import client as DNSclient
 from twisted.names import dns
 from twisted.internet.abstract import isIPAddress
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, DeferredList,
+    inlineCallbacks, returnValue, Deferred, DeferredList, succeed,
     CancelledError as t_CancelledError,
 )
+from twisted.internet.threads import deferToThreadPool
 from twisted.python.compat import nativeString
 from twisted.python.compat import unicode as _unicode
 
@@ -31,9 +34,11 @@ from .common import (
     DefaultKafkaPort, RequestTimedOutError, KafkaError,
     NotCoordinatorForConsumerError, OffsetsLoadInProgressError, UnknownError,
     ConsumerCoordinatorNotAvailableError, CancelledError,
+    FetchSessionIdNotFound, InvalidFetchSessionEpoch,
 )
-from .kafkacodec import KafkaCodec
+from .kafkacodec import ATTRIBUTE_CODEC_MASK, CODEC_ZSTD, KafkaCodec
 from .brokerclient import _KafkaBrokerClient
+from .records import has_crc32c
 from .util import _coerce_topic
 from .util import _coerce_client_id
 from .util import _coerce_consumer_group
@@ -41,6 +46,205 @@ from .util import _coerce_consumer_group
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# The oldest Produce request version which may carry each message format
+_PRODUCE_VERSION_FOR_MAGIC = {0: 0, 1: 2, 2: 3}
+# The oldest Produce request version which may carry Zstandard compression
+_PRODUCE_VERSION_ZSTD = 7
+# The oldest Fetch request version which may return RecordBatches (magic 2)
+_FETCH_VERSION_MAGIC2 = 4
+# The oldest Fetch request version implemented which supports fetch sessions
+_FETCH_VERSION_SESSION = 10
+# Fetch session epochs wrap around to 1 after this
+_FETCH_SESSION_MAX_EPOCH = 2**31 - 1
+# The epoch of a full fetch request outside of any session
+_FETCH_SESSIONLESS_EPOCH = -1
+# Errors with which a broker rejects a request because it lost track of the
+# session, or of its epoch. The session is started over with a full request.
+_FETCH_SESSION_ERRORS = (FetchSessionIdNotFound.errno,
+                         InvalidFetchSessionEpoch.errno)
+# Request timeouts are rounded up to a multiple of this many seconds, so that
+# those which fall close together are handled together.
+_TIMEOUT_RESOLUTION = 0.1
+
+
+class _FetchSession(object):
+    """
+    The state of a fetch session (KIP-227) with a broker
+
+    The broker remembers the partitions of the session and the offsets
+    from which to fetch them, so that each request need only carry the
+    changes, and each response only the partitions which have any.
+
+    :ivar int id: assigned by the broker, 0 until it has
+    :ivar int epoch:
+        The number of the next request in the session. 0 asks the broker to
+        close the session, if any, and start a new one with a full request.
+        It only advances once the response to the last request arrives, so
+        there is at most one request in flight in the session: others made
+        meanwhile are sent as full requests outside of it.
+    :ivar dict partitions:
+        Map of (topic, partition) tuples to the (offset, max_bytes) tuples
+        last sent for them, as the broker holds them.
+    """
+    __slots__ = ('id', 'epoch', 'partitions', '_pending')
+
+    def __init__(self):
+        self.id = 0
+        # The partitions of the request in flight, if any
+        self._pending = None
+        self.reset()
+
+    def reset(self):
+        """Start a new session with the next request"""
+        self.epoch = 0
+        self.partitions = {}
+
+    def next_request(self, payloads):
+        """
+        Work out the next request in the session
+
+        :param list payloads:
+            :class:`~afkak.common.FetchRequest` instances for all of the
+            partitions the session is to fetch.
+        :returns:
+            A tuple of the payloads to send, the (topic, partition) tuples
+            to forget, the session ID and the epoch.
+        """
+        if self._pending is not None:
+            return payloads, [], 0, _FETCH_SESSIONLESS_EPOCH
+        wanted = {(p.topic, p.partition): (p.offset, p.max_bytes)
+                  for p in payloads}
+        if self.epoch == 0:
+            send, forgotten = payloads, []
+        else:
+            send = [p for p in payloads
+                    if self.partitions.get((p.topic, p.partition)) !=
+                    (p.offset, p.max_bytes)]
+            forgotten = [tp for tp in self.partitions if tp not in wanted]
+        self._pending = wanted
+        return send, forgotten, self.id, self.epoch
+
+    def handle_response(self, epoch, error, session_id):
+        """
+        Track the session from the header of a response to it
+
+        :param int epoch: the epoch of the request, from :meth:`next_request`
+        :param int error: the response's top-level error code
+        :param int session_id: the session ID from the response
+        """
+        if epoch == _FETCH_SESSIONLESS_EPOCH:
+            return
+        wanted, self._pending = self._pending, None
+        if error:
+            # The session was lost: replace it.
+            self.reset()
+        elif not session_id:
+            # The broker didn't create a session, so stick to full requests.
+            self.id = 0
+            self.reset()
+        else:
+            if epoch == 0 or session_id != self.id:
+                # The broker created a session in response to a full
+                # request.
+                self.id = session_id
+                self.epoch = 1
+            else:
+                self.epoch = epoch % _FETCH_SESSION_MAX_EPOCH + 1
+            self.partitions = wanted
+
+    def handle_failure(self, epoch):
+        """
+        Track the session when a request in it failed to get a response
+
+        :param int epoch: the epoch of the request, from :meth:`next_request`
+        """
+        if epoch == _FETCH_SESSIONLESS_EPOCH:
+            return
+        self._pending = None
+        # The broker may or may not have seen the request.
+        self.reset()
+
+
+class _Deadlines(object):
+    """
+    Deadlines of requests, grouped in buckets
+
+    Rather than a DelayedCall per request, which the reactor keeps in
+    a heap, each deadline is rounded up to a multiple of the resolution and
+    put in the bucket for that time, so adding and removing one are dict
+    operations. A single DelayedCall, for the earliest bucket, expires all
+    of the deadlines in it together.
+    """
+    __slots__ = ('_reactor', '_resolution', '_buckets', '_ticks', '_count',
+                 '_call')
+
+    def __init__(self, reactor, resolution):
+        self._reactor = reactor
+        self._resolution = resolution
+        self._buckets = {}  # tick -> {token: callable}
+        self._ticks = []  # heap of the keys of _buckets
+        self._count = 0  # The number of deadlines in _buckets
+        self._call = None  # DelayedCall for the first of _ticks
+
+    def __len__(self):
+        return self._count
+
+    def add(self, delay, expire):
+        """
+        Call *expire* with no arguments after *delay* seconds, or a little
+        later, unless the deadline is removed first
+
+        :returns: a token with which to :meth:`remove` the deadline
+        """
+        tick = int(math.ceil(
+            (self._reactor.seconds() + delay) / self._resolution))
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            bucket = self._buckets[tick] = {}
+            heappush(self._ticks, tick)
+            if self._ticks[0] == tick:
+                self._schedule()
+        token = (tick, object())
+        bucket[token] = expire
+        self._count += 1
+        return token
+
+    def remove(self, token):
+        """Remove a deadline, if it hasn't expired"""
+        bucket = self._buckets.get(token[0])
+        if bucket is not None and bucket.pop(token, None) is not None:
+            self._count -= 1
+            if not self._count:
+                self.clear()
+
+    def clear(self):
+        """Remove all deadlines"""
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self._buckets.clear()
+        del self._ticks[:]
+        self._count = 0
+
+    def _schedule(self):
+        if self._call is not None:
+            self._call.cancel()
+        delay = self._ticks[0] * self._resolution - self._reactor.seconds()
+        self._call = self._reactor.callLater(max(delay, 0), self._expire)
+
+    def _expire(self):
+        self._call = None
+        now = self._reactor.seconds()
+        while self._ticks and self._ticks[0] * self._resolution <= now:
+            bucket = self._buckets.pop(heappop(self._ticks))
+            self._count -= len(bucket)
+            for expire in bucket.values():
+                expire()
+        if not self._count:
+            self.clear()
+        elif self._call is None:
+            self._schedule()
+
 
 class KafkaClient(object):
     """Cluster-aware Kafka client.
@@ -67,6 +271,46 @@ class KafkaClient(object):
     :type clients:
         :class:`dict` of (:class:`str`, :class:`int`) to
         :class:`_KafkaBrokerClient`
+    :ivar decode_threadpool:
+        :class:`~twisted.python.threadpool.ThreadPool` in which fetch
+        responses are decoded, as passed to the constructor, or `None` to
+        decode them on the reactor thread. Decompressing a large response
+        can block the reactor for tens of milliseconds. zlib, Snappy, LZ4
+        and Zstandard release the GIL while they work, so other connections
+        are serviced meanwhile. The caller starts and stops the pool, and
+        its size bounds the number of responses decoded at once.
+    :ivar int decode_thread_min_bytes:
+        Fetch responses smaller than this are decoded on the reactor thread
+        even when there is a `decode_threadpool`, as handing them off would
+        cost more than it saves.
+    :ivar bool negotiate_api_versions:
+        Ask each broker which request versions it supports with an
+        ApiVersions request, once per connection, and use the newest of
+        those which :class:`~afkak.kafkacodec.KafkaCodec` implements for
+        produce and fetch requests. This requires Kafka 0.10 or later:
+        earlier brokers drop the connection when they receive an ApiVersions
+        request, so the handshake fails, and the oldest suitable versions
+        are used. That is remembered, so such a broker is only asked once. Fetch v4 and later return
+        RecordBatches, whose CRC32C checksums take far too long to verify
+        without the `crc32c` package (the ``crc32c`` setuptools extra), so
+        unless it is installed fetches are negotiated no further than v3,
+        and a warning is logged.
+    :ivar int fetch_connections:
+        Number of connections to each broker dedicated to fetch requests, in
+        addition to the one which carries the rest. A broker handles the
+        requests on a connection one at a time, so a fetch which waits up to
+        `max_wait_time` for messages delays any produce, offset commit or
+        metadata request behind it on the same connection. With 0 (the
+        default) everything shares one connection. Each fetch goes on the
+        fetch connection with the fewest requests outstanding.
+    :ivar int max_in_flight:
+        The most requests to have outstanding on each connection, or `None`
+        (the default) for no limit. Further requests wait in a queue, in the
+        order they were made, and are only written once responses make room
+        for them. This bounds the data buffered in the socket and the broker
+        when requests are made faster than it handles them. Callers which
+        can hold on to their data meanwhile can wait for room with
+        :meth:`wait_for_capacity`, as :class:`~afkak.producer.Producer` does.
     """
 
     # This is the __CLIENT_SIDE__ timeout that's used when making requests
@@ -90,11 +334,17 @@ class KafkaClient(object):
     clientId = u"afkak-client"
     _clientIdBytes = clientId.encode()
 
+    decode_thread_min_bytes = 64 * 1024
+
     def __init__(self, hosts, clientId=None,
                  timeout=DEFAULT_REQUEST_TIMEOUT_MSECS,
                  disconnect_on_timeout=False,
                  correlation_id=0,
-                 reactor=None):
+                 reactor=None,
+                 decode_threadpool=None,
+                 negotiate_api_versions=False,
+                 fetch_connections=0,
+                 max_in_flight=None):
 
         if timeout is not None:
             if not isinstance(timeout, Real):
@@ -110,6 +360,7 @@ class KafkaClient(object):
 
         # Setup all our initial attributes
         self.clients = {}  # (host,port) -> _KafkaBrokerClient instance
+        self._fetch_clients = {}  # (host,port) -> [_KafkaBrokerClient, ...]
         self.topics_to_brokers = {}  # TopicAndPartition -> BrokerMetadata
         self.partition_meta = {}  # TopicAndPartition -> PartitionMetadata
         self.consumer_group_to_brokers = {}  # consumer_group -> BrokerMetadata
@@ -128,6 +379,25 @@ class KafkaClient(object):
         if reactor is None:
             from twisted.internet import reactor
         self.reactor = reactor
+        self.decode_threadpool = decode_threadpool
+        self.negotiate_api_versions = negotiate_api_versions
+        self.fetch_connections = fetch_connections
+        self.max_in_flight = max_in_flight
+        # _KafkaBrokerClient -> dict of API key -> (min, max) versions (empty
+        # if the broker couldn't say), or a Deferred while it is being asked
+        self._api_versions = {}
+        if negotiate_api_versions and not has_crc32c():
+            log.warning("%r: The crc32c package is not installed, so fetch "
+                        "requests won't be negotiated to versions which "
+                        "return message format v2. Install afkak[crc32c].",
+                        self)
+        self._fetch_sessions = {}  # _KafkaBrokerClient -> _FetchSession
+        # Timeouts of the requests in flight
+        self._deadlines = _Deadlines(self.reactor, _TIMEOUT_RESOLUTION)
+        # DelayedCall which checks the reactor isn't starved while requests
+        # are in flight, and when it last did
+        self._probe_call = None
+        self._probe_last = None
 
     @property
     def clock(self):
@@ -210,6 +480,48 @@ class KafkaClient(object):
         return self.topic_errors.get(
             _coerce_topic(topic), UnknownTopicOrPartitionError.errno)
 
+    def wait_for_capacity(self, payloads):
+        """
+        Wait for room for another request on the connections to the leaders
+        of the partitions of the payloads (see `max_in_flight`)
+
+        :param list payloads:
+            Objects with ``topic`` and ``partition`` attributes, like
+            :class:`~afkak.common.ProduceRequest`. Partitions whose leader
+            isn't known are ignored.
+        :returns:
+            :class:`Deferred` which fires with ``None`` once each of those
+            connections has room for a request. It may be cancelled.
+        """
+        waiting = []
+        host_keys = set()
+        for payload in payloads:
+            leader = self.topics_to_brokers.get(
+                TopicAndPartition(payload.topic, payload.partition))
+            if leader is None:
+                continue
+            host_key = (nativeString(leader.host), leader.port)
+            if host_key in self.clients and host_key not in host_keys:
+                host_keys.add(host_key)
+                waiting.append(self.clients[host_key].waitForRoom())
+        if not waiting:
+            return succeed(None)
+
+        def cancel(d):
+            # Fail first, as cancelling the waiters completes the list.
+            # DeferredList only cancels them itself in newer Twisted.
+            d.errback(t_CancelledError())
+            for waiter in waiting:
+                waiter.cancel()
+
+        def done(_):
+            if not d.called:
+                d.callback(None)
+
+        d = Deferred(cancel)
+        DeferredList(waiting, consumeErrors=True).addCallback(done)
+        return d
+
     def partition_fully_replicated(self, topic_and_part):
         if topic_and_part not in self.partition_meta:
             return False
@@ -416,7 +728,8 @@ class KafkaClient(object):
     @inlineCallbacks
     def send_produce_request(self, payloads=None, acks=1,
                              timeout=DEFAULT_REPLICAS_ACK_MSECS,
-                             fail_on_error=True, callback=None):
+                             fail_on_error=True, callback=None,
+                             compression_level=None):
         """
         Encode and send some ProduceRequests
 
@@ -439,6 +752,9 @@ class KafkaClient(object):
         callback:
             function, instead of returning the ProduceResponse,
             first pass it through this function
+        compression_level:
+            Level at which to compress RecordBatches (magic 2 messages) for
+            codecs which have levels, or None for the codec's default.
 
         Return
         ------
@@ -447,20 +763,44 @@ class KafkaClient(object):
         Raises
         ------
         FailedPayloadsError, LeaderUnavailableError, PartitionUnavailableError
+
+        The request version follows the newest message format in the
+        payloads: Produce v3 for magic 2 (RecordBatches), v2 for magic 1, as
+        earlier versions may not carry them, and v0 otherwise. Produce v7
+        (Kafka 2.1+) is used for Zstandard-compressed RecordBatches. When
+        the client negotiates API versions, newer versions which carry the
+        same message format are used if the broker supports them.
         """
+        magic = 0
+        zstd = False
+        for payload in payloads or ():
+            for message in payload.messages:
+                magic = max(magic, message.magic)
+                zstd = zstd or (message.attributes & ATTRIBUTE_CODEC_MASK == CODEC_ZSTD)
+        if zstd:
+            api_version = _PRODUCE_VERSION_ZSTD
+        else:
+            api_version = _PRODUCE_VERSION_FOR_MAGIC[magic]
 
         encoder = partial(
             KafkaCodec.encode_produce_request,
             acks=acks,
-            timeout=timeout)
+            timeout=timeout,
+            api_version=api_version,
+            compression_level=compression_level)
 
         if acks == 0:
             decoder = None
         else:
-            decoder = KafkaCodec.decode_produce_response
+            decoder = partial(KafkaCodec.decode_produce_response,
+                              api_version=api_version)
 
+        # Produce v3+ encode messages as RecordBatches, so don't negotiate
+        # legacy messages into them.
         resps = yield self._send_broker_aware_request(
-            payloads, encoder, decoder)
+            payloads, encoder, decoder, api_key=KafkaCodec.PRODUCE_KEY,
+            min_version=api_version,
+            max_version=2 if api_version < 3 else None)
 
         returnValue(self._handle_responses(resps, fail_on_error, callback))
 
@@ -468,13 +808,57 @@ class KafkaClient(object):
     def send_fetch_request(self, payloads=None, fail_on_error=True,
                            callback=None,
                            max_wait_time=DEFAULT_FETCH_SERVER_WAIT_MSECS,
-                           min_bytes=DEFAULT_FETCH_MIN_BYTES):
+                           min_bytes=DEFAULT_FETCH_MIN_BYTES,
+                           api_version=0, max_bytes=None, session=False,
+                           partition_callback=None):
         """
         Encode and send a FetchRequest
 
         Payloads are grouped by topic and partition so they can be pipelined
         to the same brokers.
 
+        Pass an `api_version` of 2 to receive messages in the format they
+        were written (magic 0 or 1); with earlier versions Kafka 0.10+ brokers
+        down-convert magic 1 messages, which is expensive for the broker.
+        Version 4 receives RecordBatches (magic 2) too. When the client
+        negotiates API versions, `api_version` is the oldest to use: the
+        newest version the broker supports is used instead.
+
+        Pass `max_bytes` to bound the size of each response, however many
+        partitions it covers, rather than only that of each partition. It
+        applies to each broker's response separately. Partitions are filled
+        in the order of the payloads, so rotate them between requests to
+        avoid starving the last. This requires Fetch v3 (Kafka 0.10.1+),
+        which is used unless `api_version` is newer.
+
+        Pass `session` to fetch within a fetch session (KIP-227, Kafka 1.1+)
+        with each broker. The client keeps one per broker: it sends only the
+        partitions which were added or whose offset or `max_bytes` changed
+        since the last request in the session, and removes those missing
+        from the payloads. The responses include only the partitions with
+        new messages or errors. This pays off when fetching many mostly
+        idle partitions, if they are all fetched from the same place: two
+        callers fetching different partitions from the same broker would
+        keep replacing each other's. There is one request in flight in each
+        session: fetches made meanwhile are sent in full, outside of it. If
+        the broker has lost track of the session, it is started over and the
+        fetch retried, once. It requires Fetch v10, which is used unless
+        `api_version` is newer.
+
+        The request goes on one of each broker's fetch connections, if the
+        client has any (see `fetch_connections`), so that it doesn't hold up
+        other requests while it waits. Each of those has its own session.
+
+        Pass `partition_callback` to have each partition's
+        :class:`~afkak.common.FetchResponse` as soon as its part of a
+        broker's response has arrived, rather than waiting for all of it,
+        which may take a while for a large response. It is called once for
+        each partition in the responses (if the connection is lost and the
+        request retried, only with the partitions not seen already), and
+        before the returned Deferred fires. Errors in a response are only
+        reported by that Deferred. The responses it fires with are decoded
+        afresh, so their messages can be iterated again.
+
         Raises
         ======
         FailedPayloadsError, LeaderUnavailableError, PartitionUnavailableError
@@ -485,15 +869,38 @@ class KafkaClient(object):
                 "%r: max_wait_time: %d must be less than client.timeout by "
                 "at least 100 milliseconds.", self, max_wait_time)
 
+        if max_bytes is not None and api_version < 3:
+            api_version = 3
+        if session and api_version < _FETCH_VERSION_SESSION:
+            api_version = _FETCH_VERSION_SESSION
+
         encoder = partial(KafkaCodec.encode_fetch_request,
                           max_wait_time=max_wait_time,
-                          min_bytes=min_bytes)
+                          min_bytes=min_bytes,
+                          api_version=api_version,
+                          max_bytes=max_bytes)
+        decoder = partial(KafkaCodec.decode_fetch_response,
+                          api_version=api_version)
+        thread_decoder = None
+        if self.decode_threadpool is not None:
+            thread_decoder = partial(KafkaCodec.decode_fetch_response,
+                                     api_version=api_version, buffered=True)
+
+        # Don't negotiate into RecordBatches unless their CRCs can be
+        # checked at a reasonable speed.
+        max_version = None
+        if api_version < _FETCH_VERSION_MAGIC2 and not has_crc32c():
+            max_version = _FETCH_VERSION_MAGIC2 - 1
 
         # resps is a list of FetchResponse() objects, each of which can hold
         # 1-n messages.
         resps = yield self._send_broker_aware_request(
-            payloads, encoder,
-            KafkaCodec.decode_fetch_response)
+            payloads, encoder, decoder, thread_decode_fn=thread_decoder,
+            api_key=KafkaCodec.FETCH_KEY, min_version=api_version,
+            max_version=max_version,
+            fetch_session=session, long_poll=True,
+            part_decode_fn=KafkaCodec.fetch_response_parser,
+            part_callback=partition_callback)
 
         returnValue(self._handle_responses(resps, fail_on_error, callback))
 
@@ -599,9 +1006,32 @@ class KafkaClient(object):
             self.clients[host_key] = _KafkaBrokerClient(
                 self.reactor, host, port, self.clientId,
                 subscriber=self._update_broker_state,
+                maxInFlight=self.max_in_flight,
             )
         return self.clients[host_key]
 
+    def _get_fetch_brokerclient(self, host, port):
+        """
+        Get the least busy of the connections to a broker dedicated to fetch
+        requests, creating them as needed, along with the broker's main
+        connection so that they are closed together.
+        """
+        host_key = (nativeString(host), port)
+        self._get_brokerclient(host, port)
+        if host_key not in self._fetch_clients:
+            log.debug("%r: creating %d fetch clients for %s:%d",
+                      self, self.fetch_connections, host, port)
+            self._fetch_clients[host_key] = [
+                _KafkaBrokerClient(
+                    self.reactor, host, port, self.clientId,
+                    subscriber=self._update_fetch_broker_state,
+                    maxInFlight=self.max_in_flight,
+                )
+                for _ in range(self.fetch_connections)
+            ]
+        return min(self._fetch_clients[host_key],
+                   key=lambda brokerclient: len(brokerclient.requests))
+
     def _update_broker_state(self, broker, connected, reason):
         """
         Handle updates of a broker's connection state.  If we get an update
@@ -620,6 +1050,7 @@ class KafkaClient(object):
         # change. Make sure we check...
         if not connected:
             self.reset_all_metadata()
+            self._forget_api_versions(broker)
             if not self._closing:
                 # If we're not shutting down, and we're not already doing a
                 # lookup, then mark ourselves as needing to re-resolve, and
@@ -630,10 +1061,33 @@ class KafkaClient(object):
                 d = self.load_metadata_for_topics()
                 d.addErrback(_md_load_on_disconnect_failure)
 
+    def _update_fetch_broker_state(self, broker, connected, reason):
+        """
+        Handle updates of the state of a broker's fetch connection. The main
+        connection to the broker notices metadata changes, so only the
+        state of this connection is updated.
+        """
+        state = "Connected" if connected else "Disconnected"
+        log.debug("Fetch connection:%r state changed:%s for reason:%r",
+                  broker, state, reason)
+        if not connected:
+            self._forget_api_versions(broker)
+
+    def _forget_api_versions(self, broker):
+        """
+        Forget which versions a broker which disconnected supports, as it may
+        be upgraded or downgraded while it's down. But if it couldn't say (it
+        is older than 0.10, which drops the connection) don't ask it again.
+        """
+        versions = self._api_versions.get(broker)
+        if isinstance(versions, dict) and versions:
+            del self._api_versions[broker]
+
     def _close_brokerclients(self, brokers):
         """
-        Pop each of the supplied brokers from self.clients
-        Close that broker, and manage the completion of those operations
+        Pop each of the supplied brokers from self.clients, along with its
+        fetch connections. Close them, and manage the completion of those
+        operations
         """
         def _log_close_failure(failure, brokerclient):
             log.debug(
@@ -654,11 +1108,14 @@ class KafkaClient(object):
             dList = [self.close_dlist]
         for broker in list(brokers):
             # broker better be in self.clients if not, weirdness
-            brokerClient = self.clients.pop(broker)
-            log.debug("Calling close on: %r", brokerClient)
-            dList.append(
-                brokerClient.close().addErrback(
-                    _log_close_failure, brokerClient))
+            brokerClients = [self.clients.pop(broker)]
+            brokerClients.extend(self._fetch_clients.pop(broker, ()))
+            for brokerClient in brokerClients:
+                self._fetch_sessions.pop(brokerClient, None)
+                log.debug("Calling close on: %r", brokerClient)
+                dList.append(
+                    brokerClient.close().addErrback(
+                        _log_close_failure, brokerClient))
         self.close_dlist = DeferredList(dList)
         self.close_dlist.addBoth(_clean_close_dlist, self.close_dlist)
 
@@ -722,6 +1179,75 @@ class KafkaClient(object):
 
         returnValue(self.consumer_group_to_brokers.get(consumer_group))
 
+    def _get_api_versions(self, broker):
+        """
+        Find out which versions of each API a broker supports
+
+        The broker is asked once, and again after each connection over
+        which it answered is lost. Concurrent callers share the request. If
+        the broker couldn't answer, it isn't asked again: the ApiVersions
+        request isn't resent when the connection is lost, as brokers older
+        than 0.10 close it in response.
+
+        :returns:
+            :class:`Deferred` which fires with a :class:`dict` mapping API
+            keys to ``(min_version, max_version)`` tuples. It is empty if
+            the broker couldn't be asked.
+        """
+        versions = self._api_versions.get(broker)
+        if isinstance(versions, dict):
+            return succeed(versions)
+        if versions is None:
+            versions = self._api_versions[broker] = Deferred()
+            requestId = self._next_id()
+            request = KafkaCodec.encode_api_versions_request(
+                self._clientIdBytes, requestId)
+            d = self._make_request_to_broker(broker, requestId, request,
+                                             retry=False)
+            d.addCallback(KafkaCodec.decode_api_versions_response)
+
+            def _handleApiVersionsErr(err):
+                log.warning("%r: Failed to get API versions from %r: %r",
+                            self, broker, err)
+                return {}
+
+            def _storeApiVersions(result, pending):
+                self._api_versions[broker] = result
+                pending.callback(None)
+
+            d.addErrback(_handleApiVersionsErr)
+            d.addCallback(_storeApiVersions, versions)
+        # Chain a new Deferred, so that callers don't alter the result.
+        d = Deferred()
+
+        def _fire(_):
+            result = self._api_versions.get(broker)
+            d.callback(result if isinstance(result, dict) else {})
+
+        versions.addCallback(_fire)
+        return d
+
+    @inlineCallbacks
+    def _negotiate_version(self, broker, api_key, min_version, max_version):
+        """
+        Pick the version of a request to send to a broker
+
+        :returns:
+            :class:`Deferred` which fires with the newest version, no older
+            than `min_version` and no newer than `max_version` (unless it is
+            `None`), which both the broker and
+            :class:`~afkak.kafkacodec.KafkaCodec` support. If there is no such
+            version `min_version` is used regardless.
+        """
+        versions = yield self._get_api_versions(broker)
+        broker_min, broker_max = versions.get(api_key, (0, -1))
+        candidates = [
+            v for v in KafkaCodec.supported_versions(api_key)
+            if max(min_version, broker_min) <= v <= broker_max and
+            (max_version is None or v <= max_version)
+        ]
+        returnValue(max(candidates) if candidates else min_version)
+
     def _next_id(self):
         """Generate a new correlation id."""
         # modulo to keep within int32 (signed)
@@ -743,17 +1269,12 @@ class KafkaClient(object):
             if self._disconnect_on_timeout:
                 broker.disconnect()
 
-        def _alert_blocked_reactor(timeout, start):
-            """Complain if this timer didn't fire before the timeout elapsed"""
-            now = self.reactor.seconds()
-            if now >= (start + timeout):
-                log.error('Reactor was starved for %f seconds during request.',
-                          now - start)
-
-        def _cancel_timeout(_, dc):
-            """Request completed/cancelled, cancel the timeout delayedCall."""
-            if dc.active():
-                dc.cancel()
+        def _cancel_timeout(_, token):
+            """Request completed/cancelled, remove its deadline."""
+            self._deadlines.remove(token)
+            if not self._deadlines and self._probe_call is not None:
+                self._probe_call.cancel()
+                self._probe_call = None
             return _
 
         # Make the request to the specified broker
@@ -761,18 +1282,99 @@ class KafkaClient(object):
                   requestId, broker)
         d = broker.makeRequest(requestId, request, **kwArgs)
         if self.timeout is not None:
-            # Set a delayedCall to fire if we don't get a reply in time
-            dc = self.reactor.callLater(
-                self.timeout, _timeout_request, broker, requestId)
-            # Set a delayedCall to complain if the reactor has been blocked
-            rc = self.reactor.callLater(
-                (self.timeout * 0.9), _alert_blocked_reactor, self.timeout,
-                self.reactor.seconds())
-            # Setup a callback on the request deferred to cancel both callLater
-            d.addBoth(_cancel_timeout, dc)
-            d.addBoth(_cancel_timeout, rc)
+            # Cancel the request if we don't get a reply in time
+            token = self._deadlines.add(
+                self.timeout, partial(_timeout_request, broker, requestId))
+            # Complain if the reactor is blocked meanwhile
+            if self._probe_call is None:
+                self._probe_last = self.reactor.seconds()
+                self._probe_call = self.reactor.callLater(
+                    self.timeout * 0.1, self._probe_reactor)
+            d.addBoth(_cancel_timeout, token)
         return d
 
+    def _make_session_request(self, broker, session, payloads, encoder_fn,
+                              requestKwArgs, retry=True):
+        """
+        Make a fetch request to a broker within the fetch session with it
+
+        If the broker rejects the request because it lost track of the
+        session, start a new one and make the request again, once.
+        """
+        send, forgotten, session_id, epoch = session.next_request(payloads)
+        requestId = self._next_id()
+        request = encoder_fn(client_id=self._clientIdBytes,
+                             correlation_id=requestId, payloads=send,
+                             forgotten=forgotten, session_id=session_id,
+                             session_epoch=epoch)
+
+        def _handle_response(response):
+            try:
+                error, session_id = KafkaCodec.decode_fetch_session(response)
+            except Exception:
+                session.handle_failure(epoch)
+                raise
+            session.handle_response(epoch, error, session_id)
+            if retry and error in _FETCH_SESSION_ERRORS:
+                log.debug('%r: Fetch session with %r lost (error %d), '
+                          'starting over', self, broker, error)
+                return self._make_session_request(
+                    broker, session, payloads, encoder_fn, requestKwArgs,
+                    retry=False)
+            return response
+
+        def _handle_failure(failure):
+            session.handle_failure(epoch)
+            return failure
+
+        d = self._make_request_to_broker(broker, requestId, request,
+                                         **requestKwArgs)
+        d.addCallbacks(_handle_response, _handle_failure)
+        return d
+
+    def _probe_reactor(self):
+        """
+        Complain if the reactor was blocked for a tenth of the request
+        timeout or more since the last probe, and probe again later if
+        there are requests in flight
+        """
+        interval = self.timeout * 0.1
+        now = self.reactor.seconds()
+        if now - self._probe_last >= 2 * interval:
+            log.error('Reactor was starved for %f seconds during request.',
+                      now - self._probe_last)
+        self._probe_last = now
+        if self._deadlines:
+            self._probe_call = self.reactor.callLater(
+                interval, self._probe_reactor)
+        else:
+            self._probe_call = None
+
+    def _response_part_handler(self, make_decoder, callback, delivered):
+        """
+        Make a partCallback for _KafkaBrokerClient.makeRequest which decodes
+        the response as it arrives, and passes each response object which
+        isn't in delivered (by topic and partition) to callback
+        """
+        current = [None, None]  # The response buffer, and its decoder
+
+        def handle_part(response, received):
+            if response is not current[0]:
+                # A new response, if the request was retried
+                current[:] = [response, make_decoder()]
+            for resp in current[1].feed(response[:received]):
+                key = (resp.topic, resp.partition)
+                if key in delivered:
+                    continue
+                delivered.add(key)
+                try:
+                    callback(resp)
+                except Exception:
+                    log.exception('%r: Failure in callback for %r',
+                                  self, key)
+
+        return handle_part
+
     @inlineCallbacks
     def _send_broker_unaware_request(self, requestId, request):
         """
@@ -821,7 +1423,11 @@ class KafkaClient(object):
 
     @inlineCallbacks
     def _send_broker_aware_request(self, payloads, encoder_fn, decode_fn,
-                                   consumer_group=None):
+                                   consumer_group=None, thread_decode_fn=None,
+                                   api_key=None, min_version=0,
+                                   max_version=None, fetch_session=False,
+                                   long_poll=False, part_decode_fn=None,
+                                   part_callback=None):
         """
         Group a list of request payloads by topic+partition and send them to
         the leader broker for that partition using the supplied encode/decode
@@ -841,6 +1447,25 @@ class KafkaClient(object):
         consumer_group: [string], optional. Indicates the request should be
                    directed to the Offset Coordinator for the specified
                    consumer_group.
+        thread_decode_fn: optional. Like decode_fn, but returns a list and
+                   is run in decode_threadpool for responses of at least
+                   decode_thread_min_bytes.
+        api_key:   optional. The API of the request. When the client
+                   negotiates API versions, the version for each broker
+                   is picked from min_version to max_version and passed
+                   to encode_fn, decode_fn and thread_decode_fn as
+                   api_version.
+        fetch_session: optional. Send fetch requests within a fetch session
+                   with each broker: encode_fn receives only the changed
+                   payloads, and the session details.
+        long_poll: optional. The request may wait at the broker, like
+                   a fetch, so send it on one of the broker's fetch
+                   connections, if the client has any.
+        part_decode_fn: optional. Creates a decoder of a response as it
+                   arrives, like KafkaCodec.fetch_response_parser. It is
+                   passed the same keyword arguments as decode_fn.
+        part_callback: optional. Called with each response object which
+                   part_decode_fn decodes, as the response arrives.
 
         Return
         ======
@@ -908,23 +1533,54 @@ class KafkaClient(object):
         inFlight = []
         # and the payloads that go along with them
         payloadsList = []
+        # and the keyword arguments with which to decode their responses
+        decodeKwArgsList = []
+        # The (topic, partition) of the responses passed to part_callback
+        partsDelivered = set()
         # For each broker, send the list of request payloads,
         for broker_meta, payloads in payloads_by_broker.items():
-            broker = self._get_brokerclient(broker_meta.host, broker_meta.port)
-            requestId = self._next_id()
-            request = encoder_fn(client_id=self._clientIdBytes,
-                                 correlation_id=requestId, payloads=payloads)
+            if long_poll and self.fetch_connections:
+                broker = self._get_fetch_brokerclient(broker_meta.host,
+                                                      broker_meta.port)
+            else:
+                broker = self._get_brokerclient(broker_meta.host,
+                                                broker_meta.port)
+            kwArgs = {}
+            if api_key is not None and self.negotiate_api_versions:
+                kwArgs['api_version'] = yield self._negotiate_version(
+                    broker, api_key, min_version, max_version)
+            requestKwArgs = {'expectResponse': expectResponse}
+            if part_callback is not None:
+                requestKwArgs['partCallback'] = self._response_part_handler(
+                    partial(part_decode_fn, **kwArgs), part_callback,
+                    partsDelivered)
 
             # Make the request
-            d = self._make_request_to_broker(broker, requestId, request,
-                                             expectResponse=expectResponse)
+            if fetch_session:
+                session = self._fetch_sessions.get(broker)
+                if session is None:
+                    session = self._fetch_sessions[broker] = _FetchSession()
+                d = self._make_session_request(
+                    broker, session, payloads, partial(encoder_fn, **kwArgs),
+                    requestKwArgs)
+            else:
+                requestId = self._next_id()
+                request = encoder_fn(client_id=self._clientIdBytes,
+                                     correlation_id=requestId,
+                                     payloads=payloads, **kwArgs)
+                d = self._make_request_to_broker(broker, requestId, request,
+                                                 **requestKwArgs)
             inFlight.append(d)
             payloadsList.append(payloads)
+            decodeKwArgsList.append(kwArgs)
 
         # Wait for all the responses to come back, or the requests to fail
         results = yield DeferredList(inFlight, consumeErrors=True)
+        # Deferreds which fire with the decoded responses
+        decoding = []
         # We now have a list of (succeeded, response/Failure) tuples. Check 'em
-        for (success, response), payloads in zip(results, payloadsList):
+        for (success, response), payloads, kwArgs in zip(
+                results, payloadsList, decodeKwArgsList):
             if not success:
                 # The brokerclient deferred was errback()'d:
                 #   The send failed, or this request was cancelled (by timeout)
@@ -934,8 +1590,21 @@ class KafkaClient(object):
                 continue
             if not expectResponse:
                 continue
-            # Successful request/response. Decode it and store by topic/part
-            for response in decode_fn(response):
+            # Successful request/response. Decode it off the reactor thread
+            # if it's big enough to be worth it.
+            if thread_decode_fn is not None and \
+                    len(response) >= self.decode_thread_min_bytes:
+                decoding.append(deferToThreadPool(
+                    self.reactor, self.decode_threadpool,
+                    thread_decode_fn, response, **kwArgs))
+            else:
+                decoding.append(succeed(decode_fn(response, **kwArgs)))
+
+        # Store the decoded responses by topic/part
+        for success, decoded in (yield DeferredList(decoding, consumeErrors=True)):
+            if not success:
+                decoded.raiseException()
+            for response in decoded:
                 acc[(response.topic, response.partition)] = response
 
         # Order the accumulated responses by the original key order
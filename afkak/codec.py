@@ -2,13 +2,9 @@
 # Copyright 2015 Cyan, Inc.
 # Copyright 2016, 2017, 2018 Ciena Corporation
 
-try:
-    from cStringIO import StringIO as BytesIO
-except ImportError:
-    from io import BytesIO
-
-import gzip
 import struct
+import threading
+import zlib
 
 # A header which indicates that the data was encoded with the blocking mode
 # of the xerial snappy library. ("Blocking" in this context means "split
@@ -34,12 +30,54 @@ import struct
 # See https://github.com/dpkp/kafka-python/pull/127 for background.
 _XERIAL_HEADER = b'\x82SNAPPY\x00\x00\x00\x00\x01\x00\x00\x00\x01'
 
+# The magic number which begins an LZ4 frame, followed by the frame
+# descriptor: the FLG and BD bytes, optionally the content size, and a header
+# checksum byte.
+#
+# Kafka before 0.10 computed the header checksum incorrectly, over the magic
+# number as well as the descriptor. Per KIP-57 the broken checksum is still
+# expected in magic 0 messages, and the correct one in magic 1 messages and
+# RecordBatches.
+_LZ4_MAGIC = b'\x04\x22\x4d\x18'
+_LZ4_FLG_CONTENT_SIZE = 0x08
+
 try:
     import snappy
     _has_snappy = True
 except ImportError:
     _has_snappy = False
 
+try:
+    # python-snappy 0.7 and later wrap cramjam, whose raw Snappy functions
+    # read from any buffer and can write into a preallocated one.
+    from cramjam import snappy as _cramjam_snappy
+except ImportError:
+    _cramjam_snappy = None
+
+try:
+    import lz4.frame as lz4_frame
+    _has_lz4 = True
+except ImportError:
+    _has_lz4 = False
+
+try:
+    import zstandard
+    _has_zstd = True
+except ImportError:
+    _has_zstd = False
+
+# The compression level used by gzip_encode() when none is given. This is
+# what gzip.GzipFile defaults to: it compresses best, but is the slowest.
+GZIP_DEFAULT_LEVEL = 9
+
+# The compression level used by zstd_encode() when none is given, which is
+# also Kafka's default.
+ZSTD_DEFAULT_LEVEL = 3
+
+# Per-thread zstd contexts, which are expensive to create and can't be
+# shared between threads.
+_zstd_contexts = threading.local()
+
 
 def has_gzip():
     return True
@@ -49,21 +87,81 @@ def has_snappy():
     return _has_snappy
 
 
-def gzip_encode(payload):
-    buffer = BytesIO()
-    handle = gzip.GzipFile(fileobj=buffer, mode="w")
-    handle.write(payload)
-    handle.close()
-    return buffer.getvalue()
+def has_lz4():
+    return _has_lz4
+
+
+def has_zstd():
+    return _has_zstd
+
+
+# zlib window bits value which selects the gzip container format
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def gzip_encode(payload, level=None):
+    """
+    Compress data in the gzip format.
+
+    :param payload: data to compress, as any bytes-like object
+    :param int level:
+        Compression level from 0 (none) through 1 (fastest) to 9 (smallest),
+        or ``None`` for :data:`GZIP_DEFAULT_LEVEL`.
+    :returns: a single gzip member, as :class:`bytes`
+    """
+    if level is None:
+        level = GZIP_DEFAULT_LEVEL
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(payload) + compressor.flush()
+
+
+# Input is fed to zlib in slices of this size, because the input it can't
+# consume when output is limited is copied to unconsumed_tail.
+_GZIP_INPUT_SIZE = 16 * 1024
+# Default limit on the size of the chunks yielded by gzip_decode_chunks()
+GZIP_CHUNK_SIZE = 64 * 1024
+
+
+def gzip_decode_chunks(payload, chunk_size=GZIP_CHUNK_SIZE):
+    """
+    Incrementally decompress gzip data.
+
+    Decompression happens as the returned iterator is consumed, so a large
+    payload need not be decompressed in one piece. Like
+    :class:`gzip.GzipFile`, this accepts several concatenated gzip members,
+    and ignores zero padding after the last.
+
+    :param payload: compressed data, as any bytes-like object
+    :param int chunk_size:
+        Maximum size of each chunk, or 0 for no limit.
+    :returns: iterator of :class:`bytes`
+    :raises EOFError: when the data is truncated
+    :raises zlib.error: when the data is corrupt
+    """
+    view = memoryview(payload)
+    while True:
+        decompressor = zlib.decompressobj(_GZIP_WBITS)
+        pos = 0
+        pending = b''
+        while not decompressor.eof:
+            if not pending and pos < len(view):
+                pending = view[pos:pos + _GZIP_INPUT_SIZE]
+                pos += len(pending)
+            chunk = decompressor.decompress(pending, chunk_size)
+            pending = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+            elif not pending and pos >= len(view) and not decompressor.eof:
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
+        rest = decompressor.unused_data + pending + view[pos:].tobytes()
+        if not rest.strip(b'\x00'):
+            return
+        view = memoryview(rest)
 
 
 def gzip_decode(payload):
-    buffer = BytesIO(payload)
-    handle = gzip.GzipFile(fileobj=buffer, mode='r')
-    result = handle.read()
-    handle.close()
-    buffer.close()
-    return result
+    return b''.join(gzip_decode_chunks(payload, 0))
 
 
 def snappy_encode(payload, xerial_compatible=False,
@@ -71,7 +169,7 @@ def snappy_encode(payload, xerial_compatible=False,
     """
     Compress the given data with the Snappy algorithm.
 
-    :param bytes payload: Data to compress.
+    :param payload: Data to compress, as any bytes-like object.
     :param bool xerial_compatible:
         If set then the stream is broken into length-prefixed blocks in
         a fashion compatible with the xerial snappy library.
@@ -94,48 +192,252 @@ def snappy_encode(payload, xerial_compatible=False,
     if not has_snappy():  # FIXME This should be static, not checked every call.
         raise NotImplementedError("Snappy codec is not available")
 
-    if xerial_compatible:
-        def _chunker():
-            for i in range(0, len(payload), xerial_blocksize):
-                yield payload[i:i+xerial_blocksize]
-
-        out = BytesIO()
-        out.write(_XERIAL_HEADER)
-
-        for chunk in _chunker():
-            block = snappy.compress(chunk)
-            out.write(struct.pack('!i', len(block)))
-            out.write(block)
-
-        out.seek(0)
-        return out.read()
-
-    else:
+    if not xerial_compatible:
         return snappy.compress(payload)
 
+    # Each block is compressed from a view of the payload, and the blocks
+    # are copied only once, to join them.
+    view = memoryview(payload)
+    out = [_XERIAL_HEADER]
+    for i in range(0, len(view), xerial_blocksize):
+        chunk = view[i:i + xerial_blocksize]
+        if _cramjam_snappy is None:
+            # Older python-snappy doesn't accept a memoryview, so we must copy.
+            block = snappy.compress(chunk.tobytes())
+        else:
+            block = _cramjam_snappy.compress_raw(chunk)
+        out.append(struct.pack('!i', len(block)))
+        out.append(block)
+    return b''.join(out)
+
 
 def snappy_decode(payload):
+    """
+    Decompress Snappy data, which may be in xerial framing.
+
+    :param payload: Compressed data, as any bytes-like object.
+    :returns:
+        Decompressed bytes. This is a :class:`bytearray` when python-snappy
+        is built on cramjam, as the blocks are decompressed directly into
+        it.
+    """
     if not has_snappy():
         raise NotImplementedError("Snappy codec is not available")
 
-    if payload.startswith(_XERIAL_HEADER):
-        # TODO ? Should become a fileobj ?
-        view = memoryview(payload)
-        out = []
-        length = len(payload)
-
-        cursor = 16
-        while cursor < length:
+    view = memoryview(payload)
+    if view[:len(_XERIAL_HEADER)] == _XERIAL_HEADER:
+        blocks = []
+        cursor = len(_XERIAL_HEADER)
+        while cursor < len(view):
             block_size = struct.unpack_from('!i', view, cursor)[0]
             # Skip the block size
             cursor += 4
-            end = cursor + block_size
-            # XXX snappy requires a bytes-like object but doesn't accept
-            # a memoryview, so we must copy.
-            out.append(snappy.decompress(view[cursor:end].tobytes()))
-            cursor = end
+            blocks.append(view[cursor:cursor + block_size])
+            cursor += block_size
+    else:
+        blocks = [view]
 
+    if _cramjam_snappy is None:
+        # Older python-snappy doesn't accept a memoryview, so we must copy.
         # See https://atleastfornow.net/blog/not-all-bytes/
-        return b''.join(out)
-    else:
-        return snappy.decompress(payload)
+        return b''.join(snappy.decompress(block.tobytes()) for block in blocks)
+
+    if len(blocks) == 1:
+        out = bytearray(_cramjam_snappy.decompress_raw_len(blocks[0]))
+        _cramjam_snappy.decompress_raw_into(blocks[0], out)
+        return out
+
+    sizes = [_cramjam_snappy.decompress_raw_len(block) for block in blocks]
+    out = bytearray(sum(sizes))
+    out_view = memoryview(out)
+    cursor = 0
+    for block, size in zip(blocks, sizes):
+        _cramjam_snappy.decompress_raw_into(block, out_view[cursor:cursor + size])
+        cursor += size
+    return out
+
+
+_XXH_PRIME32_1 = 2654435761
+_XXH_PRIME32_2 = 2246822519
+_XXH_PRIME32_3 = 3266489917
+_XXH_PRIME32_4 = 668265263
+_XXH_PRIME32_5 = 374761393
+
+
+def _xxh32(data, seed=0):
+    """
+    Compute the 32-bit xxHash of a short byte string
+
+    This is used only to checksum LZ4 frame descriptors, which are a few
+    bytes long, so inputs of 16 bytes or more are not supported.
+    """
+    data = bytearray(data)
+    length = len(data)
+    if length >= 16:
+        raise ValueError('_xxh32 supports inputs shorter than 16 bytes')
+
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & 0xffffffff
+
+    h = (seed + _XXH_PRIME32_5 + length) & 0xffffffff
+    i = 0
+    while i + 4 <= length:
+        (lane,) = struct.unpack_from('<I', data, i)
+        h = (h + lane * _XXH_PRIME32_3) & 0xffffffff
+        h = (rotl(h, 17) * _XXH_PRIME32_4) & 0xffffffff
+        i += 4
+    while i < length:
+        h = (h + data[i] * _XXH_PRIME32_5) & 0xffffffff
+        h = (rotl(h, 11) * _XXH_PRIME32_1) & 0xffffffff
+        i += 1
+    h ^= h >> 15
+    h = (h * _XXH_PRIME32_2) & 0xffffffff
+    h ^= h >> 13
+    h = (h * _XXH_PRIME32_3) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def _lz4_header_size(frame):
+    """
+    Size of the LZ4 frame header, including the magic number and the header
+    checksum byte
+    """
+    if len(frame) < 7 or frame[:4] != _LZ4_MAGIC:
+        raise ValueError('Not an LZ4 frame')
+    if bytearray(frame[4:5])[0] & _LZ4_FLG_CONTENT_SIZE:
+        return 15
+    return 7
+
+
+def _lz4_set_header_checksum(frame, broken):
+    """
+    Replace the header checksum of an LZ4 frame
+
+    :param bool broken:
+        If true, write the checksum computed the way Kafka before 0.10 did,
+        over the magic number and descriptor. Otherwise write the correct
+        checksum, computed over the descriptor alone.
+    """
+    end = _lz4_header_size(frame) - 1
+    start = 0 if broken else 4
+    checksum = (_xxh32(frame[start:end]) >> 8) & 0xff
+    return b''.join([frame[:end], struct.pack('B', checksum), frame[end + 1:]])
+
+
+def lz4_encode(payload, broken_checksum=False):
+    """
+    Compress the given data into an LZ4 frame as Kafka expects it.
+
+    Blocks are compressed independently, and the frame header omits the
+    content size, as Kafka's Java LZ4 implementation supports neither
+    linked blocks nor (before 0.10) the content size field.
+
+    :param bytes payload: Data to compress.
+    :param bool broken_checksum:
+        Write the incorrect frame header checksum which Kafka expects in
+        magic 0 messages.
+
+    :returns: Compressed bytes.
+    :rtype: :class:`bytes`
+    """
+    if not has_lz4():
+        raise NotImplementedError("LZ4 codec is not available")
+
+    frame = lz4_frame.compress(
+        payload, block_linked=False, content_checksum=False, store_size=False)
+    if broken_checksum:
+        frame = _lz4_set_header_checksum(frame, broken=True)
+    return frame
+
+
+def lz4_decode(payload, broken_checksum=False):
+    """
+    Decompress an LZ4 frame.
+
+    :param payload: Compressed data, as any bytes-like object.
+    :param bool broken_checksum:
+        Accept the incorrect frame header checksum found in magic 0
+        messages. The checksum is ignored rather than verified, as Kafka
+        itself does.
+
+    :returns: Decompressed bytes.
+    :rtype: :class:`bytes`
+    """
+    if not has_lz4():
+        raise NotImplementedError("LZ4 codec is not available")
+
+    if not broken_checksum:
+        return lz4_frame.decompress(payload)
+
+    # Correct the checksum in a copy of the header alone, and feed the rest
+    # of the frame to the decompressor as-is to avoid copying it.
+    view = memoryview(payload)
+    size = _lz4_header_size(payload)
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    decompressor.decompress(
+        _lz4_set_header_checksum(view[:size].tobytes(), broken=False))
+    result = decompressor.decompress(view[size:])
+    if not decompressor.eof:
+        raise RuntimeError("LZ4 frame incomplete")
+    return result
+
+
+def _zstd_compressor(level):
+    try:
+        compressors = _zstd_contexts.compressors
+    except AttributeError:
+        compressors = _zstd_contexts.compressors = {}
+    try:
+        return compressors[level]
+    except KeyError:
+        compressor = compressors[level] = zstandard.ZstdCompressor(level=level)
+        return compressor
+
+
+def zstd_encode(payload, level=None):
+    """
+    Compress the given data with Zstandard.
+
+    Kafka accepts Zstandard compression in RecordBatches (message format v2)
+    only, and only from Kafka 2.1.
+
+    :param bytes payload: Data to compress.
+    :param int level:
+        Compression level, from 1 (fastest) to 22 (smallest output).
+        Defaults to :data:`ZSTD_DEFAULT_LEVEL`. Negative levels trade even
+        more ratio for speed.
+
+    :returns: Compressed bytes.
+    :rtype: :class:`bytes`
+    """
+    if not has_zstd():
+        raise NotImplementedError("Zstandard codec is not available")
+    if level is None:
+        level = ZSTD_DEFAULT_LEVEL
+    return _zstd_compressor(level).compress(payload)
+
+
+def zstd_decode(payload):
+    """
+    Decompress a Zstandard frame.
+
+    Unlike ``ZstdDecompressor.decompress()`` this doesn't require the
+    frame header to record the decompressed size, which Kafka's Java
+    client omits.
+
+    :param bytes payload: Compressed data.
+    :returns: Decompressed bytes.
+    :rtype: :class:`bytes`
+    """
+    if not has_zstd():
+        raise NotImplementedError("Zstandard codec is not available")
+    try:
+        decompressor = _zstd_contexts.decompressor
+    except AttributeError:
+        decompressor = _zstd_contexts.decompressor = zstandard.ZstdDecompressor()
+    decompressobj = decompressor.decompressobj()
+    result = decompressobj.decompress(payload)
+    if not decompressobj.eof:
+        raise RuntimeError("Zstandard frame incomplete")
+    return result
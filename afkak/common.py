@@ -85,7 +85,11 @@ PartitionMetadata = namedtuple("PartitionMetadata",
 
 # Other useful structs
 OffsetAndMessage = namedtuple("OffsetAndMessage", ["offset", "message"])
-Message = namedtuple("Message", ["magic", "attributes", "key", "value"])
+# The timestamp (in milliseconds since the epoch) is only present in magic 1
+# messages; it is None otherwise.
+Message = namedtuple("Message", ["magic", "attributes", "key", "value",
+                                 "timestamp"])
+Message.__new__.__defaults__ = (None,)
 TopicAndPartition = namedtuple("TopicAndPartition", ["topic", "partition"])
 SourcedMessage = namedtuple(
     "SourcedMessage", TopicAndPartition._fields + OffsetAndMessage._fields)
@@ -561,6 +565,26 @@ class ListenerNotFound(RetriableBrokerResponseError):
     message = 'LISTENER_NOT_FOUND'
 
 
+class TopicDeletionDisabled(BrokerResponseError):
+    errno = 73
+    message = 'TOPIC_DELETION_DISABLED'
+
+
+class FencedLeaderEpoch(RetriableBrokerResponseError):
+    errno = 74
+    message = 'FENCED_LEADER_EPOCH'
+
+
+class UnknownLeaderEpoch(RetriableBrokerResponseError):
+    errno = 75
+    message = 'UNKNOWN_LEADER_EPOCH'
+
+
+class UnsupportedCompressionType(BrokerResponseError):
+    errno = 76
+    message = 'UNSUPPORTED_COMPRESSION_TYPE'
+
+
 class KafkaUnavailableError(KafkaError):
     pass
 
@@ -700,6 +724,10 @@ BrokerResponseError.errnos = {
     70: FetchSessionIdNotFound,
     71: InvalidFetchSessionEpoch,
     72: ListenerNotFound,
+    73: TopicDeletionDisabled,
+    74: FencedLeaderEpoch,
+    75: UnknownLeaderEpoch,
+    76: UnsupportedCompressionType,
 }
 
 
@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 import sys
 import logging
+from collections import deque
 from numbers import Integral
 
 from twisted.python.failure import Failure
@@ -19,8 +20,9 @@ from afkak.common import (
     KafkaError, ConsumerFetchSizeTooSmall, InvalidConsumerGroupError,
     OperationInProgress, RestartError, RestopError,
     OFFSET_EARLIEST, OFFSET_LATEST, OFFSET_COMMITTED, TIMESTAMP_INVALID,
-    OFFSET_NOT_COMMITTED,
+    OFFSET_NOT_COMMITTED, UnsupportedCompressionType,
 )
+from afkak.kafkacodec import _check_message
 from afkak.util import _coerce_topic
 from afkak.util import _coerce_consumer_group
 
@@ -34,6 +36,16 @@ REQUEST_RETRY_FACTOR = 1.20205  # Factor by which we increase our delay
 FETCH_MIN_BYTES = 64 * 1024  # server waits for min. 64K bytes of messages
 FETCH_MAX_WAIT_TIME = 100  # server waits 100 millisecs for messages
 FETCH_BUFFER_SIZE_BYTES = 128 * 1024  # Our initial fetch buffer size
+# The buffer size adapts to this many recent fetches: it is halved when none
+# of them filled more than a quarter of it, as long as the largest message
+# they held still fits.
+_BUFFER_SIZE_WINDOW = 16
+
+# The Fetch request version which returns each message format without
+# broker-side down-conversion
+_FETCH_VERSION_FOR_MAGIC = {0: 0, 1: 2, 2: 4}
+# The Fetch request version which may return Zstandard-compressed batches
+_FETCH_VERSION_ZSTD = 10
 
 # How often we auto-commit (msgs, millisecs)
 AUTO_COMMIT_MSG_COUNT = 100
@@ -66,7 +78,8 @@ class Consumer(object):
 
     :ivar client:
         Connected :class:`KafkaClient` for submitting requests to the Kafka
-        cluster.
+        cluster. Give it a `decode_threadpool` to decompress large fetch
+        responses off the reactor thread.
     :ivar bytes topic:
         The topic from which to consume messages.
     :ivar int partition:
@@ -99,7 +112,12 @@ class Consumer(object):
         bytes.
     :ivar int buffer_size:
         default 128K. Initial number of bytes to tell Kafka we have
-        available. This will be raised x16 up to 1MB then double up to...
+        available. When a fetch ends with part of a message larger than
+        this, it is raised to fit that message. When the size of a message
+        isn't known, this will be raised x16 up to 1MB then double up to...
+        :attr:`max_buffer_size`. Once recent fetches use only a small part
+        of it and hold no messages that large, it is halved again, but
+        never below its initial size.
     :ivar int max_buffer_size:
         Max number of bytes to tell Kafka we have available.  `None` means
         no limit (the default). Must be larger than the largest message we
@@ -115,6 +133,14 @@ class Consumer(object):
         Maximum number of attempts to make for any request. Default of zero
         means retry forever; other values must be positive and indicate
         the number of attempts to make before returning failure.
+    :ivar int message_version:
+        The newest message format to request from Kafka: 0 (the default),
+        1 for Kafka 0.10+ brokers or 2 for Kafka 0.11+ brokers. Brokers
+        down-convert newer messages for older requests, which is expensive,
+        so this should match the format the topic's producers write.
+        With version 2 the consumer switches to a newer fetch request if
+        the broker reports that the topic holds Zstandard-compressed batches
+        (which requires Kafka 2.1+).
 
     """
     def __init__(self, client, topic, partition, processor,
@@ -128,7 +154,8 @@ class Consumer(object):
                  max_buffer_size=None,
                  request_retry_init_delay=REQUEST_RETRY_MIN_DELAY,
                  request_retry_max_delay=REQUEST_RETRY_MAX_DELAY,
-                 request_retry_max_attempts=0):
+                 request_retry_max_attempts=0,
+                 message_version=0):
         # Store away parameters
         self.client = client  # KafkaClient
         self.topic = topic = _coerce_topic(topic)
@@ -170,6 +197,9 @@ class Consumer(object):
         self.fetch_max_wait_time = int(fetch_max_wait_time)
         self.buffer_size = buffer_size
         self.max_buffer_size = max_buffer_size
+        self._min_buffer_size = buffer_size
+        # (bytes fetched, largest message) of recent fetches
+        self._fetch_history = deque(maxlen=_BUFFER_SIZE_WINDOW)
         # request retry timing
         self.retry_delay = float(request_retry_init_delay)  # fetch only
         self.retry_init_delay = float(request_retry_init_delay)
@@ -180,6 +210,11 @@ class Consumer(object):
             raise ValueError(
                 'request_retry_max_attempts must be non-negative integer')
         self._fetch_attempt_count = 1
+        if message_version not in _FETCH_VERSION_FOR_MAGIC:
+            raise ValueError(
+                "message_version: {!r} unsupported".format(message_version))
+        self.message_version = message_version
+        self._fetch_version = _FETCH_VERSION_FOR_MAGIC[message_version]
 
         # # Internal state tracking attributes
         self._fetch_offset = None  # We don't know at what offset to fetch yet
@@ -714,6 +749,16 @@ class Consumer(object):
         if self._stopping and failure.check(CancelledError):
             # Not really an error
             return
+        if (failure.check(UnsupportedCompressionType) and
+                self.message_version == 2 and
+                self._fetch_version < _FETCH_VERSION_ZSTD):
+            # Only brokers which support Zstandard know to complain about
+            # it, so the broker supports the fetch version which returns it.
+            log.info("%r: Switching to Fetch v%d for Zstandard messages",
+                     self, _FETCH_VERSION_ZSTD)
+            self._fetch_version = _FETCH_VERSION_ZSTD
+            self._retry_fetch(after=0)
+            return
         # Do we need to abort?
         if (self.request_retry_max_attempts != 0 and
                 self._fetch_attempt_count >= self.request_retry_max_attempts):
@@ -774,12 +819,17 @@ class Consumer(object):
                 for message in resp.messages:
                     # Check for messages included which are from prior to our
                     # desired offset: can happen due to compressed message sets
+                    # Skipping is cheap: the message's key and value are only
+                    # decoded if they are accessed.
                     if message.offset < self._fetch_offset:
                         log.debug(
                             'Skipping message at offset: %d, because its '
                             'offset is less that our fetch offset: %d.',
                             message.offset, self._fetch_offset)
                         continue
+                    # A corrupt message fails the fetch, which is retried
+                    # from it, so check before moving past it.
+                    _check_message(message.message)
                     # Create a 'SourcedMessage' and add it to the messages list
                     messages.append(
                         SourcedMessage(
@@ -788,14 +838,19 @@ class Consumer(object):
                             partition=self.partition))
                     # Update our notion of from where to fetch.
                     self._fetch_offset = message.offset + 1
+                self._adapt_buffer_size(resp.messages)
         except ConsumerFetchSizeTooSmall:
             # A message was too large for us to receive, given our current
-            # buffer size. Grow it until it works, or we hit our max
+            # buffer size. If the decoder saw its size, grow to fit it.
+            # Otherwise grow it until it works, or we hit our max
             # Grow by 16x up to 1MB (could result in 16MB buf), then by 2x
             factor = 2
             if self.buffer_size <= 2**20:
                 factor = 16
-            if self.max_buffer_size is None:
+            if self._fit_buffer_size(resp.messages):
+                # Its size is known, so the next fetch will receive it.
+                pass
+            elif self.max_buffer_size is None:
                 # No limit, increase until we succeed or fail to alloc RAM
                 self.buffer_size *= factor
             elif (self.max_buffer_size is not None and
@@ -816,7 +871,7 @@ class Consumer(object):
 
             log.debug(
                 "Next message larger than fetch size, increasing "
-                "to %d (~2x) and retrying", self.buffer_size)
+                "to %d and retrying", self.buffer_size)
 
         finally:
             # If we were able to extract any messages, deliver them to the
@@ -828,6 +883,61 @@ class Consumer(object):
         # start another fetch, if needed, but use callLater to avoid recursion
         self._retry_fetch(0)
 
+    def _adapt_buffer_size(self, messages):
+        """Adapt the buffer size to the messages of a fetch response
+
+        Grow the buffer size if the response ended with part of a message
+        too large for the next fetch. Shrink it if recent fetches have
+        used little of it.
+
+        :param messages:
+            The messages of a :class:`~afkak.common.FetchResponse`, after
+            iteration.
+        """
+        try:
+            fetched = messages.bytes_consumed + messages.partial_bytes
+            largest = max(messages.max_entry_size, messages.partial_size or 0)
+        except AttributeError:
+            # Not from the decoder, so there's nothing to go on.
+            return
+        self._fetch_history.append((fetched, largest))
+
+        if self._fit_buffer_size(messages):
+            log.debug("%r: Next message larger than fetch size, "
+                      "increasing to %d", self, self.buffer_size)
+            return
+        if len(self._fetch_history) < self._fetch_history.maxlen:
+            return
+        fetched = max(f for f, _ in self._fetch_history)
+        largest = max(m for _, m in self._fetch_history)
+        size = max(self.buffer_size // 2, largest, self._min_buffer_size)
+        if fetched * 4 <= self.buffer_size and size < self.buffer_size:
+            log.debug("%r: Recent fetches used at most %d bytes, decreasing "
+                      "fetch size to %d", self, fetched, size)
+            self.buffer_size = size
+            # Let the next decision rest on fetches of the new size.
+            self._fetch_history.clear()
+
+    def _fit_buffer_size(self, messages):
+        """Grow the buffer size to fit a partial message exactly
+
+        :param messages:
+            The messages of a :class:`~afkak.common.FetchResponse`, after
+            iteration. If they ended with part of a message, the decoder
+            may know how large the whole message is.
+        :returns:
+            `True` if the buffer size was grown to fit the message, `False`
+            if it is unknown, already fits, or would exceed
+            :attr:`max_buffer_size`.
+        """
+        size = getattr(messages, 'partial_size', None)
+        if size is None or size <= self.buffer_size:
+            return False
+        if self.max_buffer_size is not None and size > self.max_buffer_size:
+            return False
+        self.buffer_size = size
+        return True
+
     def _process_messages(self, messages):
         """Send messages to the `processor` callback to be processed
 
@@ -933,7 +1043,8 @@ class Consumer(object):
             # Send request and add handlers for the response
             self._request_d = self.client.send_fetch_request(
                 [request], max_wait_time=self.fetch_max_wait_time,
-                min_bytes=self.fetch_min_bytes)
+                min_bytes=self.fetch_min_bytes,
+                api_version=self._fetch_version)
             # We need a temp for this because if the response is already
             # available, _handle_fetch_response() will clear self._request_d
             d = self._request_d
@@ -6,36 +6,398 @@ from __future__ import absolute_import
 
 import logging
 import struct
+import sys
 import zlib
 
+from six import reraise
 from twisted.python.compat import nativeString
 
-from .codec import gzip_decode, gzip_encode, snappy_decode, snappy_encode
+from .codec import (gzip_decode_chunks, gzip_encode, lz4_decode, lz4_encode,
+                    snappy_decode, snappy_encode, zstd_decode)
 from .common import (BrokerMetadata, BufferUnderflowError, ChecksumError,
                      ConsumerFetchSizeTooSmall, ConsumerMetadataResponse,
-                     FetchResponse, InvalidMessageError, Message,
-                     OffsetAndMessage, OffsetCommitResponse,
-                     OffsetFetchResponse, OffsetResponse, PartitionMetadata,
-                     ProduceResponse, ProtocolError, TopicMetadata,
-                     UnsupportedCodecError)
-from .util import (group_by_topic_and_partition, read_int_string,
-                   read_short_ascii, read_short_bytes, relative_unpack,
-                   write_int_string, write_short_ascii, write_short_bytes)
+                     FetchResponse, Message, OffsetAndMessage,
+                     OffsetCommitResponse, OffsetFetchResponse, OffsetResponse,
+                     PartitionMetadata, ProduceResponse, ProtocolError,
+                     TopicAndPartition, TopicMetadata, UnsupportedCodecError,
+                     _check_error)
+from .records import (MAGIC_OFFSET, EncodedRecordBatch, decode_record_batch,
+                      encode_record_batch)
+from .schema import (Array, Bytes, Int8, Int16, Int32, Int64, ShortBytes,
+                     String, Struct, compile_decoder, compile_encoder)
+from .util import group_by_topic_and_partition, write_int_string
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
-ATTRIBUTE_CODEC_MASK = 0x03
+ATTRIBUTE_CODEC_MASK = 0x07
+# Set in a magic 1 message's attributes when the broker has overwritten its
+# timestamp with the time it was appended to the log (LogAppendTime) rather
+# than the time it was created.
+ATTRIBUTE_TIMESTAMP_LOG_APPEND = 0x08
 CODEC_NONE = 0x00
 CODEC_GZIP = 0x01
 CODEC_SNAPPY = 0x02
-ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY)
+CODEC_LZ4 = 0x03
+# Zstandard is only valid in RecordBatches (message format v2)
+CODEC_ZSTD = 0x04
+ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4, CODEC_ZSTD)
 MAX_BROKERS = 1024
 
 # Default number of msecs the lead-broker will wait for replics to
 # ack produce requests before failing the request
 DEFAULT_REPLICAS_ACK_TIMEOUT_MSECS = 1000
 
+# Response size limit sent in Fetch v3+ requests by default: effectively
+# unlimited, so that only the per-partition limits apply, as with earlier
+# versions.
+DEFAULT_FETCH_RESPONSE_MAX_BYTES = 0x7fffffff
+
+# Precompiled structures used by the MessageSet decoder. These are applied
+# with unpack_from() directly to a memoryview over the response so that no
+# intermediate slices are allocated per field.
+_MESSAGE_SET_ENTRY = struct.Struct('>qi')  # Offset MessageSize
+_MESSAGE_HEADER = struct.Struct('>IBB')  # Crc MagicByte Attributes
+_MESSAGE_HEADER_V1 = struct.Struct('>IBBq')  # Crc MagicByte Attributes Timestamp
+_INT32 = struct.Struct('>i')
+# CorrelationId ThrottleTimeMs ErrorCode SessionId of a Fetch v7+ response
+_FETCH_SESSION_HEADER = struct.Struct('>iihi')
+_MAGIC = struct.Struct('>b')
+
+# Request and response layouts. Each is compiled to an encoder or decoder
+# function when this module is imported; see afkak.schema.
+_REQUEST_HEADER = [
+    ('api_key', Int16),
+    ('api_version', Int16),
+    ('correlation_id', Int32),
+    ('client_id', ShortBytes),
+]
+
+
+def _topics(name, partition_fields):
+    """
+    Declare the ubiquitous array of topics, each with an array of partitions
+    """
+    return Array(Struct(name + 'Topic', [
+        ('topic', String),
+        ('partitions', Array(Struct(name + 'Partition', partition_fields))),
+    ]))
+
+
+_encode_request_header = compile_encoder(
+    Struct('RequestHeader', _REQUEST_HEADER))
+
+_encode_produce_request_v0 = compile_encoder(Struct('ProduceRequestV0', _REQUEST_HEADER + [
+    ('acks', Int16),
+    ('timeout', Int32),
+    ('topics', _topics('ProduceRequest', [
+        ('partition', Int32),
+        ('message_set', Bytes),
+    ])),
+]))
+
+_decode_produce_response_v0 = compile_decoder(Struct('ProduceResponseV0', [
+    ('correlation_id', Int32),
+    ('topics', _topics('ProduceResponse', [
+        ('partition', Int32),
+        ('error', Int16),
+        ('offset', Int64),
+    ])),
+]))
+
+_decode_produce_response_v1 = compile_decoder(Struct('ProduceResponseV1', [
+    ('correlation_id', Int32),
+    ('topics', _topics('ProduceResponseV1', [
+        ('partition', Int32),
+        ('error', Int16),
+        ('offset', Int64),
+    ])),
+    ('throttle_time_ms', Int32),
+]))
+
+# Produce v3 adds the transactional ID. Its payloads are RecordBatches and
+# its response is the same as v2.
+_encode_produce_request_v3 = compile_encoder(Struct('ProduceRequestV3', _REQUEST_HEADER + [
+    ('transactional_id', String),
+    ('acks', Int16),
+    ('timeout', Int32),
+    ('topics', _topics('ProduceRequestV3', [
+        ('partition', Int32),
+        ('records', Bytes),
+    ])),
+]))
+
+_decode_produce_response_v2 = compile_decoder(Struct('ProduceResponseV2', [
+    ('correlation_id', Int32),
+    ('topics', _topics('ProduceResponseV2', [
+        ('partition', Int32),
+        ('error', Int16),
+        ('offset', Int64),
+        ('log_append_time', Int64),
+    ])),
+    ('throttle_time_ms', Int32),
+]))
+
+# Produce v5 adds the log start offset to the response. The request is the
+# same from v3 to v7; v7 is the first which may carry Zstandard compression.
+_decode_produce_response_v5 = compile_decoder(Struct('ProduceResponseV5', [
+    ('correlation_id', Int32),
+    ('topics', _topics('ProduceResponseV5', [
+        ('partition', Int32),
+        ('error', Int16),
+        ('offset', Int64),
+        ('log_append_time', Int64),
+        ('log_start_offset', Int64),
+    ])),
+    ('throttle_time_ms', Int32),
+]))
+
+_encode_fetch_request_v0 = compile_encoder(Struct('FetchRequestV0', _REQUEST_HEADER + [
+    ('replica_id', Int32),
+    ('max_wait_time', Int32),
+    ('min_bytes', Int32),
+    ('topics', _topics('FetchRequest', [
+        ('partition', Int32),
+        ('offset', Int64),
+        ('max_bytes', Int32),
+    ])),
+]))
+
+# The layout of each partition of a fetch response is declared separately,
+# as _FetchResponseParser decodes partitions one at a time.
+_FETCH_RESPONSE_PARTITION_V0 = [
+    ('partition', Int32),
+    ('error', Int16),
+    ('highwater_mark_offset', Int64),
+    ('message_set', Bytes),
+]
+
+_decode_fetch_response_v0 = compile_decoder(Struct('FetchResponseV0', [
+    ('correlation_id', Int32),
+    ('topics', _topics('FetchResponse', _FETCH_RESPONSE_PARTITION_V0)),
+]))
+
+# Fetch v3 adds a limit on the total response size. Its response is the same
+# as v1.
+_encode_fetch_request_v3 = compile_encoder(Struct('FetchRequestV3', _REQUEST_HEADER + [
+    ('replica_id', Int32),
+    ('max_wait_time', Int32),
+    ('min_bytes', Int32),
+    ('max_bytes', Int32),
+    ('topics', _topics('FetchRequestV3', [
+        ('partition', Int32),
+        ('offset', Int64),
+        ('max_bytes', Int32),
+    ])),
+]))
+
+# Fetch v4 adds the isolation level, and may return RecordBatches.
+_encode_fetch_request_v4 = compile_encoder(Struct('FetchRequestV4', _REQUEST_HEADER + [
+    ('replica_id', Int32),
+    ('max_wait_time', Int32),
+    ('min_bytes', Int32),
+    ('max_bytes', Int32),
+    ('isolation_level', Int8),
+    ('topics', _topics('FetchRequestV4', [
+        ('partition', Int32),
+        ('offset', Int64),
+        ('max_bytes', Int32),
+    ])),
+]))
+
+_FETCH_RESPONSE_PARTITION_V4 = [
+    ('partition', Int32),
+    ('error', Int16),
+    ('highwater_mark_offset', Int64),
+    ('last_stable_offset', Int64),
+    ('aborted_transactions', Array(Struct('AbortedTransaction', [
+        ('producer_id', Int64),
+        ('first_offset', Int64),
+    ]))),
+    ('records', Bytes),
+]
+
+_decode_fetch_response_v4 = compile_decoder(Struct('FetchResponseV4', [
+    ('correlation_id', Int32),
+    ('throttle_time_ms', Int32),
+    ('topics', _topics('FetchResponseV4', _FETCH_RESPONSE_PARTITION_V4)),
+]))
+
+# Fetch v10 is the first version which may return Zstandard-compressed
+# RecordBatches. On the way it gained the log start offset (v5), fetch
+# sessions (v7, KIP-227) and the leader epoch (v9). Passing a session ID of
+# 0 and epoch of -1 opts out of sessions.
+_encode_fetch_request_v10 = compile_encoder(Struct('FetchRequestV10', _REQUEST_HEADER + [
+    ('replica_id', Int32),
+    ('max_wait_time', Int32),
+    ('min_bytes', Int32),
+    ('max_bytes', Int32),
+    ('isolation_level', Int8),
+    ('session_id', Int32),
+    ('session_epoch', Int32),
+    ('topics', _topics('FetchRequestV10', [
+        ('partition', Int32),
+        ('current_leader_epoch', Int32),
+        ('offset', Int64),
+        ('log_start_offset', Int64),
+        ('max_bytes', Int32),
+    ])),
+    ('forgotten_topics', Array(Struct('FetchRequestForgottenTopic', [
+        ('topic', String),
+        ('partitions', Array(Int32)),
+    ]))),
+]))
+
+_FETCH_RESPONSE_PARTITION_V10 = [
+    ('partition', Int32),
+    ('error', Int16),
+    ('highwater_mark_offset', Int64),
+    ('last_stable_offset', Int64),
+    ('log_start_offset', Int64),
+    ('aborted_transactions', Array(Struct('AbortedTransactionV10', [
+        ('producer_id', Int64),
+        ('first_offset', Int64),
+    ]))),
+    ('records', Bytes),
+]
+
+_decode_fetch_response_v10 = compile_decoder(Struct('FetchResponseV10', [
+    ('correlation_id', Int32),
+    ('throttle_time_ms', Int32),
+    ('error', Int16),
+    ('session_id', Int32),
+    ('topics', _topics('FetchResponseV10', _FETCH_RESPONSE_PARTITION_V10)),
+]))
+
+# Fetch v2 differs from v1 only in that the broker may return magic 1
+# messages rather than down-converting them.
+_decode_fetch_response_v1 = compile_decoder(Struct('FetchResponseV1', [
+    ('correlation_id', Int32),
+    ('throttle_time_ms', Int32),
+    ('topics', _topics('FetchResponseV1', _FETCH_RESPONSE_PARTITION_V0)),
+]))
+
+# Pieces of fetch responses, for _FetchResponseParser. The headers run up to
+# and including the number of topics.
+_FETCH_RESPONSE_HEADER_V0 = struct.Struct('>ii')  # CorrelationId Topics
+_FETCH_RESPONSE_HEADER_V1 = struct.Struct('>iii')  # ... ThrottleTimeMs ...
+_FETCH_RESPONSE_HEADER_V7 = struct.Struct('>iihii')  # ... Error SessionId ...
+_decode_fetch_response_topic = compile_decoder(Struct('FetchResponseTopic', [
+    ('topic', String),
+    ('partitions', Int32),
+]))
+_decode_fetch_response_partition_v0 = compile_decoder(Struct(
+    'FetchResponsePartition', _FETCH_RESPONSE_PARTITION_V0))
+_decode_fetch_response_partition_v4 = compile_decoder(Struct(
+    'FetchResponsePartitionV4', _FETCH_RESPONSE_PARTITION_V4))
+_decode_fetch_response_partition_v10 = compile_decoder(Struct(
+    'FetchResponsePartitionV10', _FETCH_RESPONSE_PARTITION_V10))
+
+_encode_offset_request_v0 = compile_encoder(Struct('OffsetRequestV0', _REQUEST_HEADER + [
+    ('replica_id', Int32),
+    ('topics', _topics('OffsetRequest', [
+        ('partition', Int32),
+        ('time', Int64),
+        ('max_offsets', Int32),
+    ])),
+]))
+
+_decode_offset_response_v0 = compile_decoder(Struct('OffsetResponseV0', [
+    ('correlation_id', Int32),
+    ('topics', _topics('OffsetResponse', [
+        ('partition', Int32),
+        ('error', Int16),
+        ('offsets', Array(Int64)),
+    ])),
+]))
+
+_encode_metadata_request_v0 = compile_encoder(Struct('MetadataRequestV0', _REQUEST_HEADER + [
+    ('topics', Array(String)),
+]))
+
+_decode_metadata_response_v0 = compile_decoder(Struct('MetadataResponseV0', [
+    ('correlation_id', Int32),
+    ('brokers', Array(Struct('MetadataResponseBroker', [
+        ('node_id', Int32),
+        ('host', String),
+        ('port', Int32),
+    ]), max_length=MAX_BROKERS)),
+    ('topics', Array(Struct('MetadataResponseTopic', [
+        ('error', Int16),
+        ('topic', String),
+        ('partitions', Array(Struct('MetadataResponsePartition', [
+            ('error', Int16),
+            ('partition', Int32),
+            ('leader', Int32),
+            ('replicas', Array(Int32)),
+            ('isr', Array(Int32)),
+        ]))),
+    ]))),
+]))
+
+_encode_consumermetadata_request_v0 = compile_encoder(Struct('ConsumerMetadataRequestV0', _REQUEST_HEADER + [
+    ('group', String),
+]))
+
+_decode_consumermetadata_response_v0 = compile_decoder(Struct('ConsumerMetadataResponseV0', [
+    ('correlation_id', Int32),
+    ('error', Int16),
+    ('node_id', Int32),
+    ('host', String),
+    ('port', Int32),
+]))
+
+_encode_offset_commit_request_v1 = compile_encoder(Struct('OffsetCommitRequestV1', _REQUEST_HEADER + [
+    ('group', String),
+    ('group_generation_id', Int32),
+    ('consumer_id', String),
+    ('topics', _topics('OffsetCommitRequest', [
+        ('partition', Int32),
+        ('offset', Int64),
+        ('timestamp', Int64),
+        ('metadata', ShortBytes),
+    ])),
+]))
+
+_decode_offset_commit_response_v1 = compile_decoder(Struct('OffsetCommitResponseV1', [
+    ('correlation_id', Int32),
+    ('topics', _topics('OffsetCommitResponse', [
+        ('partition', Int32),
+        ('error', Int16),
+    ])),
+]))
+
+_encode_offset_fetch_request_v1 = compile_encoder(Struct('OffsetFetchRequestV1', _REQUEST_HEADER + [
+    ('group', String),
+    ('topics', Array(Struct('OffsetFetchRequestTopic', [
+        ('topic', String),
+        ('partitions', Array(Int32)),
+    ]))),
+]))
+
+_decode_offset_fetch_response_v1 = compile_decoder(Struct('OffsetFetchResponseV1', [
+    ('correlation_id', Int32),
+    ('topics', _topics('OffsetFetchResponse', [
+        ('partition', Int32),
+        ('offset', Int64),
+        ('metadata', ShortBytes),
+        ('error', Int16),
+    ])),
+]))
+
+_encode_api_versions_request_v0 = compile_encoder(
+    Struct('ApiVersionsRequestV0', _REQUEST_HEADER))
+
+_decode_api_versions_response_v0 = compile_decoder(Struct('ApiVersionsResponseV0', [
+    ('correlation_id', Int32),
+    ('error', Int16),
+    ('api_versions', Array(Struct('ApiVersionsResponseApi', [
+        ('api_key', Int16),
+        ('min_version', Int16),
+        ('max_version', Int16),
+    ]))),
+]))
+
 
 class KafkaCodec(object):
     """
@@ -51,6 +413,7 @@ class KafkaCodec(object):
     OFFSET_COMMIT_KEY = 8
     OFFSET_FETCH_KEY = 9
     CONSUMER_METADATA_KEY = 10
+    API_VERSIONS_KEY = 18
 
     ###################
     #   Private API   #
@@ -62,12 +425,8 @@ class KafkaCodec(object):
         """
         Encode the common request envelope
         """
-        return (struct.pack('>hhih',
-                            request_key,          # ApiKey
-                            api_version,          # ApiVersion
-                            correlation_id,       # CorrelationId
-                            len(client_id)) +     # ClientId size
-                client_id)                        # ClientId
+        return _encode_request_header((
+            request_key, api_version, correlation_id, client_id))
 
     @classmethod
     def _encode_message_set(cls, messages, offset=None):
@@ -86,7 +445,7 @@ class KafkaCodec(object):
             offset = 0
         for message in messages:
             encoded_message = KafkaCodec._encode_message(message)
-            message_set.append(struct.pack('>qi', offset, len(encoded_message)))
+            message_set.append(_MESSAGE_SET_ENTRY.pack(offset, len(encoded_message)))
             message_set.append(encoded_message)
             offset += incr
         return b''.join(message_set)
@@ -96,25 +455,35 @@ class KafkaCodec(object):
         """
         Encode a single message.
 
-        The magic number of a message is a format version number.  The only
-        supported magic number right now is zero.  Format::
+        The magic number of a message is a format version number. Magic
+        0 and 1 are supported. Format::
 
-            Message => Crc MagicByte Attributes Key Value
+            Message => Crc MagicByte Attributes [Timestamp] Key Value
               Crc => int32
               MagicByte => int8
               Attributes => int8
+              Timestamp => int64 (magic 1 only)
               Key => bytes
               Value => bytes
+
+        A magic 1 message without a timestamp is encoded with a timestamp of
+        -1, meaning "no timestamp".
         """
         if message.magic == 0:
-            msg = struct.pack('>BB', message.magic, message.attributes)
-            msg += write_int_string(message.key)
-            msg += write_int_string(message.value)
-            crc = zlib.crc32(msg) & 0xffffffff  # Ensure unsigned
-            msg = struct.pack('>I', crc) + msg
+            header = struct.pack('>BB', message.magic, message.attributes)
+        elif message.magic == 1:
+            timestamp = -1 if message.timestamp is None else message.timestamp
+            header = struct.pack('>BBq', message.magic, message.attributes,
+                                 timestamp)
         else:
             raise ProtocolError("Unexpected magic number: %d" % message.magic)
-        return msg
+        msg = b''.join([
+            header,
+            write_int_string(message.key),
+            write_int_string(message.value),
+        ])
+        crc = zlib.crc32(msg) & 0xffffffff  # Ensure unsigned
+        return struct.pack('>I', crc) + msg
 
     @classmethod
     def _decode_message_set_iter(cls, data):
@@ -125,32 +494,82 @@ class KafkaCodec(object):
         to decode a single message. Since compressed messages contain futher
         MessageSets, these two methods have been decoupled so that they may
         recurse easily.
+
+        Fetch v4+ responses may contain RecordBatches (magic 2) as well as
+        legacy messages. They are framed the same way, and are told apart by
+        the magic byte.
+
+        :param data:
+            A bytes-like object. It is wrapped in a :class:`memoryview`, so
+            passing a view over a larger buffer (like a fetch response) does
+            not copy it.
+        :returns:
+            :class:`_MessageSetIterator` of :class:`OffsetAndMessage`
         """
-        cur = 0
+        return _MessageSetIterator(memoryview(data))
+
+    @classmethod
+    def _decode_message_set_chunks(cls, chunks):
+        """
+        Iteratively decode a MessageSet which arrives in pieces
+
+        This is the counterpart of :meth:`_decode_message_set_iter` for
+        a MessageSet which is being decompressed incrementally: rather than
+        the whole set, only the chunk being decoded and the start of
+        a message which straddles chunks need be held in memory.
+
+        :param chunks: iterable of :class:`bytes`
+        """
+        entry_size = _MESSAGE_SET_ENTRY.size
+        pieces = []  # Undecoded data
+        have = 0  # Length of the undecoded data
+        need = entry_size  # Length required to decode the next entry
         read_message = False
-        while cur < len(data):
-            try:
-                ((offset, ), cur) = relative_unpack('>q', data, cur)
-                (msg, cur) = read_int_string(data, cur)
-                msgIter = KafkaCodec._decode_message(msg, offset)
-                for (offset, message) in msgIter:
+        for chunk in chunks:
+            pieces.append(chunk)
+            have += len(chunk)
+            if have < need:
+                continue
+            view = memoryview(b''.join(pieces) if len(pieces) > 1 else chunk)
+            cur = 0
+            while have - cur >= entry_size:
+                offset, msg_size = _MESSAGE_SET_ENTRY.unpack_from(view, cur)
+                end = cur + entry_size + msg_size
+                if msg_size < 5:
+                    # Garbage, as in _decode_message_set_iter()
+                    if read_message is False:
+                        raise ConsumerFetchSizeTooSmall()
+                    return
+                if end > have:
+                    break
+                for (offset, message) in cls._decode_message_set_entry(
+                        view, cur, end, offset):
                     read_message = True
                     yield OffsetAndMessage(offset, message)
-            except BufferUnderflowError:
-                # NOTE: Not sure this is correct error handling:
-                # Is it possible to get a BUE if the message set is somewhere
-                # in the middle of the fetch response? If so, we probably have
-                # an issue that's not fetch size too small.
-                # Aren't we ignoring errors if we fail to unpack data by
-                # raising StopIteration()?
-                # If _decode_message() raises a ChecksumError, couldn't that
-                # also be due to the fetch size being too small?
-                if read_message is False:
-                    # If we get a partial read of a message, but haven't
-                    # yielded anything there's a problem
-                    raise ConsumerFetchSizeTooSmall()
-                else:
-                    raise StopIteration()
+                cur = end
+            rest = view[cur:]
+            pieces = [rest.tobytes()] if rest else []
+            have = len(rest)
+            if have >= entry_size:
+                need = entry_size + _MESSAGE_SET_ENTRY.unpack_from(rest, 0)[1]
+            else:
+                need = entry_size
+        if have and read_message is False:
+            # A partial message at the end, as in _decode_message_set_iter()
+            raise ConsumerFetchSizeTooSmall()
+
+    @classmethod
+    def _decode_message_set_entry(cls, view, start, end, offset):
+        """
+        Decode the MessageSet entry in ``view[start:end]``, which is either
+        a legacy message or a RecordBatch, depending on its magic.
+
+        :returns: iterable of ``(offset, message)`` tuples
+        """
+        if _MAGIC.unpack_from(view, start + MAGIC_OFFSET)[0] == 2:
+            return decode_record_batch(view[start:end])
+        return cls._decode_message(
+            view[start + _MESSAGE_SET_ENTRY.size:end], offset)
 
     @classmethod
     def _decode_message(cls, data, offset):
@@ -161,32 +580,76 @@ class KafkaCodec(object):
         They are decoupled to support nested messages (compressed MessageSets).
         The offset is actually read from decode_message_set_iter (it is part
         of the MessageSet payload).
-        """
-        ((crc, magic, att), cur) = relative_unpack('>IBB', data, 0)
-        if crc != zlib.crc32(data[4:]) & 0xffffffff:
-            raise ChecksumError("Message checksum failed")
 
-        (key, cur) = read_int_string(data, cur)
-        (value, cur) = read_int_string(data, cur)
+        Uncompressed messages are yielded as :class:`_LazyMessage` instances
+        which defer the CRC check and key/value extraction until first use.
+        Compressed wrapper messages are checked immediately, as their value
+        must be decompressed to produce the inner messages.
 
+        The inner messages of a magic 0 gzip wrapper are yielded as they are
+        decompressed. Those of a magic 1 wrapper carry offsets relative to
+        the first of them, and the wrapper carries the absolute offset of the
+        last, so the whole inner set is decoded before any of it is yielded.
+        """
+        view = memoryview(data)
+        if len(view) < _MESSAGE_HEADER.size:
+            raise BufferUnderflowError("Not enough data left")
+        crc, magic, att = _MESSAGE_HEADER.unpack_from(view, 0)
+        if magic == 0:
+            timestamp = None
+            cur = _MESSAGE_HEADER.size
+        elif magic == 1:
+            if len(view) < _MESSAGE_HEADER_V1.size:
+                raise BufferUnderflowError("Not enough data left")
+            timestamp = _MESSAGE_HEADER_V1.unpack_from(view, 0)[3]
+            cur = _MESSAGE_HEADER_V1.size
+        else:
+            # Garbage is far more likely than a format we don't know about.
+            if crc != zlib.crc32(view[4:]) & 0xffffffff:
+                raise ChecksumError("Message checksum failed")
+            raise ProtocolError("Unexpected magic number: %d" % magic)
         codec = att & ATTRIBUTE_CODEC_MASK
 
         if codec == CODEC_NONE:
-            yield (offset, Message(magic, att, key, value))
+            yield (offset, _LazyMessage(view, magic, att, timestamp))
+            return
 
-        elif codec == CODEC_GZIP:
-            gz = gzip_decode(value)
-            for (offset, msg) in KafkaCodec._decode_message_set_iter(gz):
-                yield (offset, msg)
+        if crc != zlib.crc32(view[4:]) & 0xffffffff:
+            raise ChecksumError("Message checksum failed")
 
-        elif codec == CODEC_SNAPPY:
-            snp = snappy_decode(value)
-            for (offset, msg) in KafkaCodec._decode_message_set_iter(snp):
-                yield (offset, msg)
+        (key, cur) = _read_int_view(view, cur)
+        (value, cur) = _read_int_view(view, cur)
 
+        if codec == CODEC_GZIP:
+            inner = KafkaCodec._decode_message_set_chunks(
+                gzip_decode_chunks(value))
+        elif codec == CODEC_SNAPPY:
+            inner = KafkaCodec._decode_message_set_iter(snappy_decode(value))
+        elif codec == CODEC_LZ4:
+            inner = KafkaCodec._decode_message_set_iter(
+                lz4_decode(value, broken_checksum=magic == 0))
+        elif codec == CODEC_ZSTD:
+            # Kafka never puts Zstandard in a legacy message, but there's no
+            # harm in decoding it.
+            inner = KafkaCodec._decode_message_set_iter(zstd_decode(value))
         else:
             raise ProtocolError('Unsupported codec 0b{:b}'.format(codec))
 
+        if magic == 0:
+            for (offset, msg) in inner:
+                yield (offset, msg)
+            return
+
+        messages = list(inner)
+        if not messages:
+            return
+        base = offset - messages[-1].offset
+        log_append = att & ATTRIBUTE_TIMESTAMP_LOG_APPEND
+        for (relative_offset, msg) in messages:
+            if log_append:
+                msg = _with_timestamp(msg, timestamp)
+            yield (base + relative_offset, msg)
+
     ##################
     #   Public API   #
     ##################
@@ -198,13 +661,15 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        return correlation_id
+        if len(data) < _INT32.size:
+            raise BufferUnderflowError("Not enough data left")
+        return _INT32.unpack_from(data, 0)[0]
 
     @classmethod
     def encode_produce_request(cls, client_id, correlation_id,
                                payloads=None, acks=1,
-                               timeout=DEFAULT_REPLICAS_ACK_TIMEOUT_MSECS):
+                               timeout=DEFAULT_REPLICAS_ACK_TIMEOUT_MSECS,
+                               api_version=0, compression_level=None):
         """
         Encode some ProduceRequest structs
 
@@ -223,49 +688,73 @@ class KafkaCodec(object):
         :param int timeout:
             Maximum time the server will wait for acks from replicas.  This is
             _not_ a socket timeout.
+        :param int api_version:
+            0 to 7. The request layout is the same for 0 through 2, but only
+            version 2 may carry magic 1 messages. Versions 3 and up carry
+            magic 2 messages, encoded as one RecordBatch per partition,
+            unless the messages are an
+            :class:`~afkak.records.EncodedRecordBatch`. Only version 7 may
+            carry Zstandard-compressed batches.
+        :param int compression_level:
+            Level at which RecordBatches are compressed, for codecs which
+            have one. ``None`` means the codec's default.
         """
+        if (cls.PRODUCE_KEY, api_version) not in _RESPONSE_DECODERS:
+            raise ValueError('Unsupported Produce version {!r}'.format(api_version))
         if not isinstance(client_id, bytes):
             raise TypeError('client_id={!r} should be bytes'.format(client_id))
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.PRODUCE_KEY)
-
-        message += struct.pack('>hii', acks, timeout, len(grouped_payloads))
-
-        for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_ascii(topic)
-
-            message += struct.pack('>i', len(topic_payloads))
-            for partition, payload in topic_payloads.items():
-                msg_set = KafkaCodec._encode_message_set(payload.messages)
-                message += struct.pack('>ii', partition, len(msg_set))
-                message += msg_set
-
-        return message
+        if api_version >= 3:
+            def encode_messages(messages):
+                if len(messages) == 1 and isinstance(messages[0], EncodedRecordBatch):
+                    return messages[0].data
+                return encode_record_batch(
+                    messages, compression_level=compression_level)
+        else:
+            encode_messages = KafkaCodec._encode_message_set
+        topics = [
+            (topic, [
+                (partition, encode_messages(payload.messages))
+                for partition, payload in topic_payloads.items()
+            ])
+            for topic, topic_payloads in grouped_payloads.items()
+        ]
+        if api_version >= 3:
+            return _encode_produce_request_v3((
+                KafkaCodec.PRODUCE_KEY, api_version, correlation_id, client_id,
+                None,  # transactional id
+                acks, timeout, topics,
+            ))
+        return _encode_produce_request_v0((
+            KafkaCodec.PRODUCE_KEY, api_version, correlation_id, client_id,
+            acks, timeout, topics,
+        ))
 
     @classmethod
-    def decode_produce_response(cls, data):
+    def decode_produce_response(cls, data, api_version=0):
         """
         Decode bytes to a ProduceResponse
 
         :param bytes data: bytes to decode
+        :param int api_version: version of the request this responds to
         :returns: iterable of `afkak.common.ProduceResponse`
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
-
-        for i in range(num_topics):
-            topic, cur = read_short_ascii(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
-            for i in range(num_partitions):
-                ((partition, error, offset), cur) = relative_unpack('>ihq', data, cur)
+        response, _ = _RESPONSE_DECODERS[cls.PRODUCE_KEY, api_version](data)
+        if api_version >= 1:
+            _log_throttle('Produce', response[-1])
 
-                yield ProduceResponse(topic, partition, error, offset)
+        for topic, partitions in response[1]:
+            for partition in partitions:
+                yield ProduceResponse(topic, partition[0], partition[1],
+                                      partition[2])
 
     @classmethod
     def encode_fetch_request(cls, client_id, correlation_id, payloads=None,
-                             max_wait_time=100, min_bytes=4096):
+                             max_wait_time=100, min_bytes=4096, api_version=0,
+                             max_bytes=None, session_id=0, session_epoch=-1,
+                             forgotten=()):
         """
         Encodes some FetchRequest structs
 
@@ -276,72 +765,170 @@ class KafkaCodec(object):
         :param int min_bytes:
             the minimum number of bytes to accumulate before returning the
             response
+        :param int api_version:
+            0, 1, 2, 3, 4 or 10. The request layout is the same for 0 through
+            2. Version 2 tells the broker it may return magic 1 messages
+            rather than down-converting them, version 3 adds `max_bytes`, and
+            version 4 tells the broker it may return RecordBatches (magic 2).
+            Version 10 may also return Zstandard compressed batches. Versions
+            4 and 10 read uncommitted transactional messages.
+        :param int max_bytes:
+            Limit on the size of the whole response, for versions 3 and up,
+            or ``None`` for no limit. The partitions are filled in the order
+            of the payloads until it is reached, but the broker returns the
+            first message of the first partition with any even if it's larger.
+        :param int session_id:
+            Fetch session (KIP-227) of which the request is part, for
+            version 10. 0 means none, or a new one when `session_epoch` is 0.
+        :param int session_epoch:
+            The number of the request within the fetch session, or -1 to
+            fetch outside of a session.
+        :param forgotten:
+            Iterable of ``(topic, partition)`` tuples to remove from the
+            fetch session.
         """
+        if (cls.FETCH_KEY, api_version) not in _RESPONSE_DECODERS:
+            raise ValueError('Unsupported Fetch version {!r}'.format(api_version))
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.FETCH_KEY)
-
         assert isinstance(max_wait_time, int)
-
-        # -1 is the replica id
-        message += struct.pack('>iiii', -1, max_wait_time, min_bytes,
-                               len(grouped_payloads))
-
-        for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_ascii(topic)
-            message += struct.pack('>i', len(topic_payloads))
-            for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqi', partition, payload.offset,
-                                       payload.max_bytes)
-
-        return message
+        if max_bytes is None:
+            max_bytes = DEFAULT_FETCH_RESPONSE_MAX_BYTES
+
+        topics = [
+            (topic, [
+                (partition, payload.offset, payload.max_bytes)
+                for partition, payload in topic_payloads.items()
+            ])
+            for topic, topic_payloads in grouped_payloads.items()
+        ]
+        if api_version >= 10:
+            return _encode_fetch_request_v10((
+                KafkaCodec.FETCH_KEY, api_version, correlation_id, client_id,
+                -1,  # replica id
+                max_wait_time, min_bytes, max_bytes,
+                0,  # isolation level: read uncommitted
+                session_id, session_epoch,
+                [(topic, [
+                    # No current leader epoch or log start offset
+                    (partition, -1, offset, -1, max_bytes)
+                    for (partition, offset, max_bytes) in partitions
+                ]) for (topic, partitions) in topics],
+                [(topic, list(partitions)) for topic, partitions in
+                 group_by_topic_and_partition(
+                     TopicAndPartition(*tp) for tp in forgotten).items()],
+            ))
+        if api_version >= 4:
+            return _encode_fetch_request_v4((
+                KafkaCodec.FETCH_KEY, api_version, correlation_id, client_id,
+                -1,  # replica id
+                max_wait_time, min_bytes, max_bytes,
+                0,  # isolation level: read uncommitted
+                topics,
+            ))
+        if api_version >= 3:
+            return _encode_fetch_request_v3((
+                KafkaCodec.FETCH_KEY, api_version, correlation_id, client_id,
+                -1,  # replica id
+                max_wait_time, min_bytes, max_bytes, topics,
+            ))
+        return _encode_fetch_request_v0((
+            KafkaCodec.FETCH_KEY, api_version, correlation_id, client_id,
+            -1,  # replica id
+            max_wait_time, min_bytes, topics,
+        ))
 
     @classmethod
-    def decode_fetch_response(cls, data):
+    def decode_fetch_response(cls, data, api_version=0, buffered=False):
         """
         Decode bytes to a FetchResponse
 
         :param bytes data: bytes to decode
+        :param int api_version: version of the request this responds to
+        :param bool buffered:
+            Decode (and decompress) all of the message sets now, rather than
+            as they are iterated. An error decoding a message set is still
+            raised only once the messages preceding it have been iterated.
+            This is used to decode responses in a worker thread.
+
+        The message sets yielded are decoded lazily from a :class:`memoryview`
+        over *data*, so the response itself is never copied.
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        responses = cls._decode_fetch_response_iter(data, api_version)
+        if not buffered:
+            return responses
+        responses = list(responses)
+        for resp in responses:
+            resp.messages.buffer()
+        return responses
 
-        for i in range(num_topics):
-            (topic, cur) = read_short_ascii(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+    @classmethod
+    def _decode_fetch_response_iter(cls, data, api_version):
+        response, _ = _RESPONSE_DECODERS[cls.FETCH_KEY, api_version](data)
+        if api_version >= 1:
+            _log_throttle('Fetch', response[1])
+        if api_version >= 7:
+            # A top-level error (about the fetch session) means no partitions
+            _check_error(response[2])
+
+        for topic, partitions in response[-1]:
+            for p in partitions:
+                # The partition, error and high water mark come first and the
+                # messages last in all versions.
+                yield FetchResponse(
+                    topic, p[0], p[1], p[2],
+                    KafkaCodec._decode_message_set_iter(p[-1]))
 
-            for i in range(num_partitions):
-                ((partition, error, highwater_mark_offset), cur) = \
-                    relative_unpack('>ihq', data, cur)
+    @classmethod
+    def fetch_response_parser(cls, api_version=0):
+        """
+        Create a decoder for a FetchResponse which decodes it as it arrives
+
+        :param int api_version: version of the request it responds to
+        :returns:
+            An object with a ``feed(data)`` method, which is passed the part
+            of the response received so far each time more arrives. It
+            returns a list of :class:`~afkak.common.FetchResponse` for each
+            of the partitions which have arrived since the last call. Their
+            message sets are decoded lazily, as with
+            :meth:`decode_fetch_response`. Errors in the response are only
+            detected by decoding it once it is complete.
+        """
+        return _FetchResponseParser(api_version)
 
-                (message_set, cur) = read_int_string(data, cur)
+    @classmethod
+    def decode_fetch_session(cls, data):
+        """
+        Decode the fetch session details of a Fetch v7+ response
 
-                yield FetchResponse(
-                    topic, partition, error,
-                    highwater_mark_offset,
-                    KafkaCodec._decode_message_set_iter(message_set))
+        :param bytes data: bytes to decode
+        :returns:
+            A tuple of the top-level error code and the ID of the fetch
+            session, which is 0 if the broker didn't create one.
+        """
+        if len(data) < _FETCH_SESSION_HEADER.size:
+            raise BufferUnderflowError("Not enough data left")
+        _, _, error, session_id = _FETCH_SESSION_HEADER.unpack_from(data, 0)
+        return error, session_id
 
     @classmethod
     def encode_offset_request(cls, client_id, correlation_id, payloads=None):
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.OFFSET_KEY)
-
-        # -1 is the replica id
-        message += struct.pack('>ii', -1, len(grouped_payloads))
-
-        for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_ascii(topic)
-            message += struct.pack('>i', len(topic_payloads))
-
-            for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqi', partition, payload.time,
-                                       payload.max_offsets)
-
-        return message
+        topics = [
+            (topic, [
+                (partition, payload.time, payload.max_offsets)
+                for partition, payload in topic_payloads.items()
+            ])
+            for topic, topic_payloads in grouped_payloads.items()
+        ]
+        return _encode_offset_request_v0((
+            KafkaCodec.OFFSET_KEY, 0, correlation_id, client_id,
+            -1,  # replica id
+            topics,
+        ))
 
     @classmethod
     def decode_offset_response(cls, data):
@@ -350,22 +937,11 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        (correlation_id, topics), _ = _decode_offset_response_v0(data)
 
-        for i in range(num_topics):
-            (topic, cur) = read_short_ascii(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
-
-            for i in range(num_partitions):
-                ((partition, error, num_offsets,), cur) = \
-                    relative_unpack('>ihi', data, cur)
-
-                offsets = []
-                for j in range(num_offsets):
-                    ((offset,), cur) = relative_unpack('>q', data, cur)
-                    offsets.append(offset)
-
-                yield OffsetResponse(topic, partition, error, tuple(offsets))
+        for topic, partitions in topics:
+            for partition, error, offsets in partitions:
+                yield OffsetResponse(topic, partition, error, offsets)
 
     @classmethod
     def encode_metadata_request(cls, client_id, correlation_id, topics=None):
@@ -377,14 +953,8 @@ class KafkaCodec(object):
         :param list topics: list of text
         """
         topics = [] if topics is None else topics
-        message = [
-            cls._encode_message_header(client_id, correlation_id,
-                                       KafkaCodec.METADATA_KEY),
-            struct.pack('>i', len(topics)),
-        ]
-        for topic in topics:
-            message.append(write_short_ascii(topic))
-        return b''.join(message)
+        return _encode_metadata_request_v0((
+            KafkaCodec.METADATA_KEY, 0, correlation_id, client_id, topics))
 
     @classmethod
     def decode_metadata_response(cls, data):
@@ -393,46 +963,23 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id, numbrokers), cur) = relative_unpack('>ii', data, 0)
-
-        # In testing, I saw this routine swap my machine to death when
-        # passed bad data. So, some checks are in order...
-        if numbrokers > MAX_BROKERS:
-            raise InvalidMessageError(
-                "Brokers:{} exceeds max:{}".format(numbrokers, MAX_BROKERS))
+        # Array lengths are checked against the remaining data (and the number
+        # of brokers against MAX_BROKERS) before anything is allocated, so
+        # bad data can't swap the machine to death.
+        (correlation_id, broker_list, topic_list), _ = \
+            _decode_metadata_response_v0(data)
 
-        # Broker info
         brokers = {}
-        for i in range(numbrokers):
-            ((nodeId, ), cur) = relative_unpack('>i', data, cur)
-            (host, cur) = read_short_ascii(data, cur)
-            ((port,), cur) = relative_unpack('>i', data, cur)
-            brokers[nodeId] = BrokerMetadata(nodeId, nativeString(host), port)
-
-        # Topic info
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
-        topic_metadata = {}
+        for node_id, host, port in broker_list:
+            brokers[node_id] = BrokerMetadata(node_id, nativeString(host), port)
 
-        for i in range(num_topics):
-            ((topic_error,), cur) = relative_unpack('>h', data, cur)
-            (topic_name, cur) = read_short_ascii(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+        topic_metadata = {}
+        for topic_error, topic_name, partitions in topic_list:
             partition_metadata = {}
-
-            for j in range(num_partitions):
-                ((partition_error_code, partition, leader, numReplicas),
-                 cur) = relative_unpack('>hiii', data, cur)
-
-                (replicas, cur) = relative_unpack(
-                    '>%di' % numReplicas, data, cur)
-
-                ((num_isr,), cur) = relative_unpack('>i', data, cur)
-                (isr, cur) = relative_unpack('>%di' % num_isr, data, cur)
-
-                partition_metadata[partition] = \
-                    PartitionMetadata(
-                        topic_name, partition, partition_error_code, leader,
-                        replicas, isr)
+            for partition_error_code, partition, leader, replicas, isr in partitions:
+                partition_metadata[partition] = PartitionMetadata(
+                    topic_name, partition, partition_error_code, leader,
+                    replicas, isr)
 
             topic_metadata[topic_name] = TopicMetadata(
                 topic_name, topic_error, partition_metadata)
@@ -449,10 +996,9 @@ class KafkaCodec(object):
         :param int correlation_id: int
         :param str consumer_group: string
         """
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.CONSUMER_METADATA_KEY)
-        message += write_short_ascii(consumer_group)
-        return message
+        return _encode_consumermetadata_request_v0((
+            KafkaCodec.CONSUMER_METADATA_KEY, 0, correlation_id, client_id,
+            consumer_group))
 
     @classmethod
     def decode_consumermetadata_response(cls, data):
@@ -461,10 +1007,8 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        (correlation_id, error_code, node_id), cur = \
-            relative_unpack('>ihi', data, 0)
-        host, cur = read_short_ascii(data, cur)
-        (port,), cur = relative_unpack('>i', data, cur)
+        (correlation_id, error_code, node_id, host, port), _ = \
+            _decode_consumermetadata_response_v0(data)
 
         return ConsumerMetadataResponse(
             error_code, node_id, nativeString(host), port)
@@ -485,26 +1029,17 @@ class KafkaCodec(object):
         """
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(
-            client_id, correlation_id, KafkaCodec.OFFSET_COMMIT_KEY,
-            api_version=1,
-        )
-
-        message += write_short_ascii(group)
-        message += struct.pack('>i', group_generation_id)
-        message += write_short_ascii(consumer_id)
-        message += struct.pack('>i', len(grouped_payloads))
-
-        for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_ascii(topic)
-            message += struct.pack('>i', len(topic_payloads))
-
-            for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqq', partition, payload.offset,
-                                       payload.timestamp)
-                message += write_short_bytes(payload.metadata)
-
-        return message
+        topics = [
+            (topic, [
+                (partition, payload.offset, payload.timestamp, payload.metadata)
+                for partition, payload in topic_payloads.items()
+            ])
+            for topic, topic_payloads in grouped_payloads.items()
+        ]
+        return _encode_offset_commit_request_v1((
+            KafkaCodec.OFFSET_COMMIT_KEY, 1, correlation_id, client_id,
+            group, group_generation_id, consumer_id, topics,
+        ))
 
     @classmethod
     def decode_offset_commit_response(cls, data):
@@ -513,15 +1048,10 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
-
-        for i in range(num_topics):
-            (topic, cur) = read_short_ascii(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+        (correlation_id, topics), _ = _decode_offset_commit_response_v1(data)
 
-            for i in range(num_partitions):
-                ((partition, error), cur) = relative_unpack('>ih', data, cur)
+        for topic, partitions in topics:
+            for partition, error in partitions:
                 yield OffsetCommitResponse(topic, partition, error)
 
     @classmethod
@@ -536,47 +1066,424 @@ class KafkaCodec(object):
         :param list payloads: list of :class:`OffsetFetchRequest`
         """
         grouped_payloads = group_by_topic_and_partition(payloads)
-        message = cls._encode_message_header(
-            client_id, correlation_id, KafkaCodec.OFFSET_FETCH_KEY,
-            api_version=1)
 
-        message += write_short_ascii(group)
-        message += struct.pack('>i', len(grouped_payloads))
+        topics = [
+            (topic, list(topic_payloads))
+            for topic, topic_payloads in grouped_payloads.items()
+        ]
+        return _encode_offset_fetch_request_v1((
+            KafkaCodec.OFFSET_FETCH_KEY, 1, correlation_id, client_id,
+            group, topics,
+        ))
 
-        for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_ascii(topic)
-            message += struct.pack('>i', len(topic_payloads))
+    @classmethod
+    def decode_offset_fetch_response(cls, data):
+        """
+        Decode bytes to an OffsetFetchResponse
 
-            for partition, payload in topic_payloads.items():
-                message += struct.pack('>i', partition)
+        :param bytes data: bytes to decode
+        """
+        (correlation_id, topics), _ = _decode_offset_fetch_response_v1(data)
 
-        return message
+        for topic, partitions in topics:
+            for partition, offset, metadata, error in partitions:
+                yield OffsetFetchResponse(topic, partition, offset,
+                                          metadata, error)
 
     @classmethod
-    def decode_offset_fetch_response(cls, data):
+    def encode_api_versions_request(cls, client_id, correlation_id):
         """
-        Decode bytes to an OffsetFetchResponse
+        Encode an ApiVersionsRequest (Kafka 0.10+)
+
+        :param bytes client_id:
+        :param int correlation_id:
+        """
+        return _encode_api_versions_request_v0((
+            KafkaCodec.API_VERSIONS_KEY, 0, correlation_id, client_id))
+
+    @classmethod
+    def decode_api_versions_response(cls, data):
+        """
+        Decode bytes to the versions of each API which a broker supports
 
         :param bytes data: bytes to decode
+        :returns:
+            :class:`dict` mapping API keys to ``(min_version, max_version)``
+            tuples
+        :raises BrokerResponseError: for an error response
         """
+        (correlation_id, error, api_versions), _ = \
+            _decode_api_versions_response_v0(data)
+        _check_error(error)
+        return {api_key: (min_version, max_version)
+                for api_key, min_version, max_version in api_versions}
 
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+    @classmethod
+    def supported_versions(cls, api_key):
+        """
+        Get the request versions implemented for an API
 
-        for i in range(num_topics):
-            (topic, cur) = read_short_ascii(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+        :param int api_key: one of the ``*_KEY`` constants
+        :returns: sorted :class:`list` of versions, empty for an unknown API
+        """
+        return sorted(version for (key, version) in _RESPONSE_DECODERS
+                      if key == api_key)
+
+
+# Response decoders by API key and request version. This is the registry of
+# the request versions implemented here: KafkaClient picks from it when it
+# negotiates versions with a broker.
+_RESPONSE_DECODERS = {
+    (KafkaCodec.PRODUCE_KEY, 0): _decode_produce_response_v0,
+    (KafkaCodec.PRODUCE_KEY, 1): _decode_produce_response_v1,
+    (KafkaCodec.PRODUCE_KEY, 2): _decode_produce_response_v2,
+    (KafkaCodec.PRODUCE_KEY, 3): _decode_produce_response_v2,
+    (KafkaCodec.PRODUCE_KEY, 4): _decode_produce_response_v2,
+    (KafkaCodec.PRODUCE_KEY, 5): _decode_produce_response_v5,
+    (KafkaCodec.PRODUCE_KEY, 6): _decode_produce_response_v5,
+    (KafkaCodec.PRODUCE_KEY, 7): _decode_produce_response_v5,
+    (KafkaCodec.FETCH_KEY, 0): _decode_fetch_response_v0,
+    (KafkaCodec.FETCH_KEY, 1): _decode_fetch_response_v1,
+    (KafkaCodec.FETCH_KEY, 2): _decode_fetch_response_v1,
+    (KafkaCodec.FETCH_KEY, 3): _decode_fetch_response_v1,
+    (KafkaCodec.FETCH_KEY, 4): _decode_fetch_response_v4,
+    (KafkaCodec.FETCH_KEY, 10): _decode_fetch_response_v10,
+    (KafkaCodec.OFFSET_KEY, 0): _decode_offset_response_v0,
+    (KafkaCodec.METADATA_KEY, 0): _decode_metadata_response_v0,
+    (KafkaCodec.OFFSET_COMMIT_KEY, 1): _decode_offset_commit_response_v1,
+    (KafkaCodec.OFFSET_FETCH_KEY, 1): _decode_offset_fetch_response_v1,
+    (KafkaCodec.CONSUMER_METADATA_KEY, 0): _decode_consumermetadata_response_v0,
+    (KafkaCodec.API_VERSIONS_KEY, 0): _decode_api_versions_response_v0,
+}
+
+# Header and partition decoders by Fetch version, for _FetchResponseParser
+_FETCH_RESPONSE_PIECES = {
+    0: (_FETCH_RESPONSE_HEADER_V0, _decode_fetch_response_partition_v0),
+    1: (_FETCH_RESPONSE_HEADER_V1, _decode_fetch_response_partition_v0),
+    2: (_FETCH_RESPONSE_HEADER_V1, _decode_fetch_response_partition_v0),
+    3: (_FETCH_RESPONSE_HEADER_V1, _decode_fetch_response_partition_v0),
+    4: (_FETCH_RESPONSE_HEADER_V1, _decode_fetch_response_partition_v4),
+    10: (_FETCH_RESPONSE_HEADER_V7, _decode_fetch_response_partition_v10),
+}
+
+
+def _log_throttle(api, throttle_time_ms):
+    if throttle_time_ms:
+        log.debug("%s request was throttled by a broker quota for %d ms",
+                  api, throttle_time_ms)
+
+
+def _with_timestamp(message, timestamp):
+    """
+    Set the timestamp of a decoded message
 
-            for i in range(num_partitions):
-                ((partition, offset), cur) = relative_unpack('>iq', data, cur)
-                (metadata, cur) = read_short_bytes(data, cur)
-                ((error,), cur) = relative_unpack('>h', data, cur)
+    This is used to apply a compressed wrapper's LogAppendTime to the
+    messages within it.
+    """
+    if isinstance(message, _LazyMessage):
+        message._timestamp = timestamp
+        return message
+    return message._replace(timestamp=timestamp)
 
-                yield OffsetFetchResponse(topic, partition, offset,
-                                          metadata, error)
 
+def _read_int_view(view, cur):
+    """
+    Read an int32 length-prefixed byte string from a :class:`memoryview`
 
-def create_message(payload, key=None):
+    :returns:
+        A tuple of a :class:`memoryview` slice of *view* (or ``None`` for the
+        null string) and the position following it.
+    """
+    if len(view) < cur + _INT32.size:
+        raise BufferUnderflowError("Not enough data left")
+    (strlen,) = _INT32.unpack_from(view, cur)
+    cur += _INT32.size
+    if strlen == -1:
+        return None, cur
+    end = cur + strlen
+    if strlen < 0 or len(view) < end:
+        raise BufferUnderflowError("Not enough data left")
+    return view[cur:end], end
+
+
+class _FetchResponseParser(object):
+    """
+    Decoder of a fetch response as it arrives, a partition at a time
+
+    :meth:`feed` is passed the part of the response received so far each
+    time more of it arrives, and returns the partitions which are complete
+    in it and weren't in the last part it was passed.
+    """
+    __slots__ = ('_header', '_decode_partition', '_pos', '_topics', '_topic',
+                 '_partitions')
+
+    def __init__(self, api_version):
+        self._header, self._decode_partition = \
+            _FETCH_RESPONSE_PIECES[api_version]
+        self._pos = 0  # Where the next piece starts
+        self._topics = None  # Topics left, None until the header is decoded
+        self._topic = None  # The topic whose partitions are being decoded
+        self._partitions = 0  # Partitions of that topic left
+
+    def feed(self, data):
+        """
+        Decode the partitions which have arrived
+
+        :param data:
+            The start of the response: a bytes-like object which extends
+            the one last passed.
+        :returns: :class:`list` of :class:`~afkak.common.FetchResponse`
+        """
+        view = memoryview(data)
+        responses = []
+        try:
+            while True:
+                if self._partitions:
+                    partition, self._pos = self._decode_partition(
+                        view, self._pos)
+                    self._partitions -= 1
+                    responses.append(FetchResponse(
+                        self._topic, partition[0], partition[1], partition[2],
+                        KafkaCodec._decode_message_set_iter(partition[-1])))
+                elif self._topics:
+                    (self._topic, self._partitions), self._pos = \
+                        _decode_fetch_response_topic(view, self._pos)
+                    self._topics -= 1
+                elif self._topics is None:
+                    if len(view) < self._header.size:
+                        break
+                    # A top-level error (about the fetch session) comes with
+                    # no topics.
+                    self._topics = self._header.unpack_from(view, 0)[-1]
+                    self._pos = self._header.size
+                else:
+                    break
+        except BufferUnderflowError:
+            pass  # The rest of the piece hasn't arrived yet.
+        return responses
+
+
+class _MessageSetIterator(object):
+    """
+    Iterator over the messages of a MessageSet, which records how far
+    decoding got
+
+    A fetch response usually ends with a partial message, as the broker
+    fills the requested number of bytes without regard to where messages
+    end. The attributes describe it once iteration is complete.
+
+    :ivar int bytes_consumed:
+        Length of the complete MessageSet entries decoded so far.
+    :ivar int max_entry_size:
+        Length of the largest of those entries.
+    :ivar int partial_bytes:
+        Length of the incomplete entry at the end of the set, if any.
+    :ivar int partial_size:
+        Length that entry would have, were it complete, or `None` when no
+        entry is incomplete or its header is. A fetch of this many bytes
+        from the entry's offset would receive it.
+    :ivar int next_offset:
+        The offset following the last message decoded, or `None` when no
+        message was.
+    """
+    __slots__ = ('bytes_consumed', 'max_entry_size', 'partial_bytes',
+                 'partial_size', 'next_offset', '_messages')
+
+    def __init__(self, view):
+        self.bytes_consumed = 0
+        self.max_entry_size = 0
+        self.partial_bytes = 0
+        self.partial_size = None
+        self.next_offset = None
+        self._messages = self._decode(view)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._messages)
+
+    next = __next__
+
+    def buffer(self):
+        """
+        Decode the rest of the messages now, for replay later
+
+        If decoding raises an exception, it is reraised after the messages
+        which preceded it have been iterated.
+        """
+        decoded = []
+        exc_info = None
+        try:
+            for message in self._messages:
+                decoded.append(message)
+        except Exception:
+            exc_info = sys.exc_info()
+        self._messages = _replay_messages(decoded, exc_info)
+
+    def _decode(self, view):
+        size = len(view)
+        cur = 0
+        try:
+            while cur < size:
+                if cur + _MESSAGE_SET_ENTRY.size > size:
+                    self.partial_bytes = size - cur
+                    raise BufferUnderflowError("Not enough data left")
+                start = cur
+                offset, msg_size = _MESSAGE_SET_ENTRY.unpack_from(view, cur)
+                cur += _MESSAGE_SET_ENTRY.size
+                end = cur + msg_size
+                if msg_size < 5:
+                    raise BufferUnderflowError("Not enough data left")
+                if end > size:
+                    self.partial_bytes = size - start
+                    self.partial_size = end - start
+                    raise BufferUnderflowError("Not enough data left")
+                for (offset, message) in KafkaCodec._decode_message_set_entry(
+                        view, start, end, offset):
+                    self.next_offset = offset + 1
+                    yield OffsetAndMessage(offset, message)
+                if end - start > self.max_entry_size:
+                    self.max_entry_size = end - start
+                cur = self.bytes_consumed = end
+        except BufferUnderflowError:
+            # NOTE: Not sure this is correct error handling:
+            # Is it possible to get a BUE if the message set is somewhere
+            # in the middle of the fetch response? If so, we probably have
+            # an issue that's not fetch size too small.
+            # If _decode_message() raises a ChecksumError, couldn't that
+            # also be due to the fetch size being too small?
+            if self.next_offset is None:
+                # If we get a partial read of a message, but haven't
+                # yielded anything there's a problem
+                raise ConsumerFetchSizeTooSmall()
+            # Otherwise the broker sent a partial message at the end of the
+            # set, which is normal: the rest will come with the next fetch.
+
+
+def _replay_messages(decoded, exc_info):
+    for message in decoded:
+        yield message
+    if exc_info is not None:
+        reraise(*exc_info)
+
+
+class _LazyMessage(Message):
+    """
+    A :class:`~afkak.common.Message` whose key and value are copied out of
+    its buffer on demand
+
+    Only the magic byte, attributes and timestamp are read when the message
+    is decoded from a MessageSet. The key and value are copied out of the
+    underlying buffer on first access to either of them, and the reference
+    to the buffer is then dropped, so messages which are skipped (for
+    example, those preceding the requested offset in a compressed wrapper)
+    cost next to nothing. The CRC is verified by :func:`_check_message`,
+    or failing that on first access to the key or value.
+
+    It compares, hashes and unpacks as the equivalent :class:`Message` does.
+    Being a tuple, it can't have slots of its own, so it has a ``__dict__``.
+
+    :raises ChecksumError:
+        on first access to :attr:`key` or :attr:`value` when the CRC doesn't
+        match the message contents.
+    """
+
+    def __new__(cls, view, magic, attributes, timestamp=None):
+        self = Message.__new__(cls, magic, attributes, None, None, timestamp)
+        self._view = view
+        self._checked = False
+        self._key = self._value = None
+        self._timestamp = timestamp
+        return self
+
+    def _check(self):
+        if not self._checked:
+            view = self._view
+            crc = _MESSAGE_HEADER.unpack_from(view, 0)[0]
+            if crc != zlib.crc32(view[4:]) & 0xffffffff:
+                raise ChecksumError("Message checksum failed")
+            self._checked = True
+
+    def _decode(self):
+        self._check()
+        view = self._view
+        if self.magic == 0:
+            cur = _MESSAGE_HEADER.size
+        else:
+            cur = _MESSAGE_HEADER_V1.size
+        (key, cur) = _read_int_view(view, cur)
+        (value, cur) = _read_int_view(view, cur)
+        self._key = None if key is None else key.tobytes()
+        self._value = None if value is None else value.tobytes()
+        self._view = None  # Release the buffer
+
+    @property
+    def key(self):
+        if self._view is not None:
+            self._decode()
+        return self._key
+
+    @property
+    def value(self):
+        if self._view is not None:
+            self._decode()
+        return self._value
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    def _astuple(self):
+        return Message(self.magic, self.attributes, self.key, self.value,
+                       self._timestamp)
+
+    def _replace(self, **kwargs):
+        return self._astuple()._replace(**kwargs)
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __getitem__(self, index):
+        return self._astuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, tuple):
+            return self._astuple() == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __reduce__(self):
+        return (Message, tuple(self._astuple()))
+
+    def __repr__(self):
+        return repr(self._astuple())
+
+
+def _check_message(message):
+    """
+    Verify the CRC of a decoded message, if it hasn't been already
+
+    The CRC of an uncompressed message in a MessageSet is otherwise only
+    checked when its key or value is first accessed. Other messages have
+    been checked already, or (like those of a RecordBatch, whose CRC32C
+    covers the batch) have no CRC of their own.
+
+    :raises ChecksumError: when the CRC doesn't match the message contents
+    """
+    if isinstance(message, _LazyMessage):
+        message._check()
+
+
+def create_message(payload, key=None, magic=0, timestamp=None):
     """
     Construct a :class:`Message`
 
@@ -585,13 +1492,38 @@ def create_message(payload, key=None):
     :param key: A key used to route the message when partitioning and to
         determine message identity on a compacted topic.
     :type key: :class:`bytes` or ``None``
+    :param int magic: The message format version, 0 or 1.
+    :param int timestamp:
+        Creation time in milliseconds since the epoch. Only magic 1 messages
+        carry a timestamp; it is ignored for magic 0.
     """
     assert payload is None or isinstance(payload, bytes), 'payload={!r} should be bytes or None'.format(payload)
     assert key is None or isinstance(key, bytes), 'key={!r} should be bytes or None'.format(key)
-    return Message(0, 0, key, payload)
+    if magic == 0:
+        return Message(0, 0, key, payload)
+    return Message(magic, 0, key, payload, timestamp)
 
 
-def create_gzip_message(message_set):
+def _create_compressed_message(message_set, codec, encode, magic):
+    """
+    Wrap *message_set* in a single message compressed with *encode*
+
+    In a magic 1 wrapper the inner messages are given offsets relative to the
+    first, which lets the broker assign offsets without recompressing, and
+    the wrapper takes the latest of their timestamps.
+    """
+    if magic == 0:
+        encoded_message_set = KafkaCodec._encode_message_set(message_set)
+        return Message(0, 0x00 | codec, None, encode(encoded_message_set))
+
+    encoded_message_set = KafkaCodec._encode_message_set(message_set, offset=0)
+    timestamps = [m.timestamp for m in message_set if m.timestamp is not None]
+    timestamp = max(timestamps) if timestamps else None
+    return Message(magic, 0x00 | codec, None, encode(encoded_message_set),
+                   timestamp)
+
+
+def create_gzip_message(message_set, magic=0, compression_level=None):
     """
     Construct a gzip-compressed message containing multiple messages
 
@@ -599,16 +1531,19 @@ def create_gzip_message(message_set):
     message to Kafka.
 
     :param list message_set: a list of :class:`Message` instances
+    :param int magic: The format version of the wrapper message.
+    :param int compression_level:
+        gzip level, from 1 (fastest) to 9 (smallest), or ``None`` for
+        :data:`afkak.codec.GZIP_DEFAULT_LEVEL`.
     """
-    encoded_message_set = KafkaCodec._encode_message_set(message_set)
-
-    gzipped = gzip_encode(encoded_message_set)
     codec = ATTRIBUTE_CODEC_MASK & CODEC_GZIP
 
-    return Message(0, 0x00 | codec, None, gzipped)
+    def encode(payload):
+        return gzip_encode(payload, level=compression_level)
+    return _create_compressed_message(message_set, codec, encode, magic)
 
 
-def create_snappy_message(message_set):
+def create_snappy_message(message_set, magic=0):
     """
     Construct a Snappy-compressed message containing multiple messages
 
@@ -616,16 +1551,33 @@ def create_snappy_message(message_set):
     message to Kafka.
 
     :param list message_set: a list of :class:`Message` instances
+    :param int magic: The format version of the wrapper message.
     """
-    encoded_message_set = KafkaCodec._encode_message_set(message_set)
-
-    snapped = snappy_encode(encoded_message_set)
     codec = ATTRIBUTE_CODEC_MASK & CODEC_SNAPPY
+    return _create_compressed_message(message_set, codec, snappy_encode, magic)
 
-    return Message(0, 0x00 | codec, None, snapped)
+
+def create_lz4_message(message_set, magic=0):
+    """
+    Construct an LZ4-compressed message containing multiple messages
+
+    The given messages will be encoded, compressed, and sent as a single atomic
+    message to Kafka. LZ4 requires Kafka 0.8.2 or later.
+
+    :param list message_set: a list of :class:`Message` instances
+    :param int magic:
+        The format version of the wrapper message. A magic 0 message carries
+        the incorrect LZ4 frame checksum that Kafka before 0.10 expects.
+    """
+    codec = ATTRIBUTE_CODEC_MASK & CODEC_LZ4
+
+    def encode(payload):
+        return lz4_encode(payload, broken_checksum=magic == 0)
+    return _create_compressed_message(message_set, codec, encode, magic)
 
 
-def create_message_set(requests, codec=CODEC_NONE):
+def create_message_set(requests, codec=CODEC_NONE, magic=0, timestamp=None,
+                       compression_level=None):
     """
     Create a message set from a list of requests.
 
@@ -639,18 +1591,52 @@ def create_message_set(requests, codec=CODEC_NONE):
           * :const:`CODEC_NONE`
           * :const:`CODEC_GZIP`
           * :const:`CODEC_SNAPPY`
+          * :const:`CODEC_LZ4`
+          * :const:`CODEC_ZSTD`, for magic 2 only
+
+    :param int magic:
+        The message format version. Magic 1 messages (Kafka 0.10+) carry
+        a timestamp. Magic 2 messages (Kafka 0.11+) are sent in
+        a RecordBatch, which is compressed as a whole: rather than wrapping
+        them in a compressed message, the codec is recorded in each
+        message's attributes.
+    :param int timestamp:
+        Creation time of the messages in milliseconds since the epoch, for
+        magic 1 and 2.
+    :param int compression_level:
+        Level for :const:`CODEC_GZIP`, or ``None`` for the default. Below
+        magic 2 other codecs ignore it; in a RecordBatch it is applied when
+        the batch is encoded, see :func:`afkak.records.encode_record_batch`.
 
     :raises: :exc:`UnsupportedCodecError` for an unsupported codec
     """
     msglist = []
-    for req in requests:
-        msglist.extend([create_message(m, key=req.key) for m in req.messages])
+    if magic == 2:
+        if codec not in ALL_CODECS:
+            raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
+        for req in requests:
+            msglist.extend([Message(2, codec, req.key, m, timestamp)
+                            for m in req.messages])
+        return msglist
+    elif magic == 0:
+        for req in requests:
+            msglist.extend([create_message(m, key=req.key) for m in req.messages])
+    else:
+        for req in requests:
+            msglist.extend([create_message(m, key=req.key, magic=magic,
+                                           timestamp=timestamp)
+                            for m in req.messages])
 
     if codec == CODEC_NONE:
         return msglist
     elif codec == CODEC_GZIP:
-        return [create_gzip_message(msglist)]
+        return [create_gzip_message(msglist, magic, compression_level)]
     elif codec == CODEC_SNAPPY:
-        return [create_snappy_message(msglist)]
+        return [create_snappy_message(msglist, magic)]
+    elif codec == CODEC_LZ4:
+        return [create_lz4_message(msglist, magic)]
+    elif codec == CODEC_ZSTD:
+        raise UnsupportedCodecError(
+            "Zstandard compression requires message format v2 (magic 2)")
     else:
         raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
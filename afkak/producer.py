@@ -11,10 +11,11 @@ from collections import defaultdict
 
 from twisted.python.failure import Failure
 from twisted.internet.defer import (
-    Deferred, DeferredList, inlineCallbacks, returnValue, fail,
+    Deferred, DeferredList, inlineCallbacks, returnValue, fail, succeed,
     CancelledError as tid_CancelledError,
     )
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
 
 from .common import (
     ProduceRequest, UnsupportedCodecError, NoResponseError,
@@ -27,7 +28,9 @@ from .common import (
     )
 from .util import _coerce_topic
 from .partitioner import (RoundRobinPartitioner)
-from .kafkacodec import CODEC_NONE, ALL_CODECS, create_message_set
+from .kafkacodec import (ALL_CODECS, CODEC_GZIP, CODEC_NONE, CODEC_ZSTD,
+                         create_message_set)
+from .records import EncodedRecordBatch
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -42,7 +45,10 @@ class Producer(object):
     Parameters
     ==========
     client:
-        The Kafka client instance to use
+        The Kafka client instance to use. When it limits the requests in
+        flight on each connection (max_in_flight), each batch waits for room
+        on its leaders' connections before it is sent, and messages
+        accumulate in the next batch meanwhile.
     partitioner_class:
         CLASS which will be used to instantiate partitioners for topics, as
         needed. Constructor should take a topic and list of partitions.
@@ -58,7 +64,29 @@ class Producer(object):
     retry_interval:
         Initial retry interval in seconds, defaults to INIT_RETRY_INTERVAL.
     codec:
-        What compression codec to apply to messages. Default: CODEC_NONE
+        What compression codec to apply to messages. Default: CODEC_NONE.
+        CODEC_ZSTD requires message_version=2 and Kafka 2.1+ brokers.
+    compression_level:
+        The compression level for codecs which have one (CODEC_GZIP and
+        CODEC_ZSTD), or None (the default) for the codec's default level.
+        Lower levels compress faster: gzip levels range from 1 (fastest) to
+        9 (smallest, and the default).
+    compression_threadpool:
+        A :class:`twisted.python.threadpool.ThreadPool` in which to compress
+        messages, or None (the default) to compress them on the reactor
+        thread, where compressing a large batch blocks all I/O. Each
+        partition's messages are compressed separately, so the size of the
+        pool limits how many are compressed at once. The caller starts and
+        stops the pool. Only message sets of at least
+        compression_thread_min_bytes (16 KiB by default) are compressed in
+        the pool.
+    message_version:
+        The message format to produce: 0 (the default), 1 for Kafka 0.10+
+        brokers or 2 for Kafka 0.11+ brokers. Magic 1 and 2 messages are
+        timestamped with the time they are sent and are produced with Produce
+        v2 or v3 respectively, so the broker can store them without
+        converting or recompressing them. Magic 2 messages are sent as one
+        RecordBatch per partition, which has much lower per-message overhead.
     batch_send:
         If True, messages are sent in batches.
     batch_every_n:
@@ -76,6 +104,10 @@ class Producer(object):
     DEFAULT_REQ_ATTEMPTS = 10  # Send request up to 10 times before failing
     INIT_RETRY_INTERVAL = 0.25  # Initial retry interval in seconds
     RETRY_INTERVAL_FACTOR = 1.20205  # Factor by which we increase our delay
+    # Message sets smaller than this are compressed on the reactor thread
+    # even with a compression_threadpool, as handing them off would cost more
+    # than it saves.
+    compression_thread_min_bytes = 16 * 1024
 
     def __init__(self, client,
                  partitioner_class=RoundRobinPartitioner,
@@ -84,6 +116,9 @@ class Producer(object):
                  max_req_attempts=DEFAULT_REQ_ATTEMPTS,
                  retry_interval=INIT_RETRY_INTERVAL,
                  codec=None,
+                 compression_level=None,
+                 compression_threadpool=None,
+                 message_version=0,
                  batch_send=False,
                  batch_every_n=BATCH_SEND_MSG_COUNT,
                  batch_every_b=BATCH_SEND_MSG_BYTES,
@@ -151,6 +186,24 @@ class Producer(object):
             raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
         self.codec = codec
 
+        if message_version not in (0, 1, 2):
+            raise ValueError(
+                "message_version: {!r} unsupported".format(message_version))
+        self.message_version = message_version
+        if codec == CODEC_ZSTD and message_version != 2:
+            raise UnsupportedCodecError(
+                "Zstandard compression requires message_version=2")
+
+        if not (compression_level is None or isinstance(compression_level, Integral)):
+            raise TypeError(
+                "compression_level: {!r} unsupported".format(compression_level))
+        if codec == CODEC_GZIP and compression_level is not None and \
+                not 0 <= compression_level <= 9:
+            raise ValueError(
+                "compression_level: {!r} out of range for gzip".format(compression_level))
+        self.compression_level = compression_level
+        self.compression_threadpool = compression_threadpool
+
     def __repr__(self):
         return '<Producer {}:{}:{}:{}>'.format(self.partitioner_class,
                                                self.batchDesc, self.req_acks,
@@ -291,6 +344,24 @@ class Producer(object):
         partition = self.partitioners[topic].partition(key, partitions)
         returnValue(partition)
 
+    def _create_message_set(self, reqs, timestamp):
+        """Build (and compress) the message set for one topic/partition
+
+        :returns:
+            Deferred which fires with the message set, which is computed in
+            the compression_threadpool if it's big enough.
+        """
+        args = (reqs, self.codec, self.message_version, timestamp,
+                self.compression_level)
+        if self.compression_threadpool is None or self.codec == CODEC_NONE:
+            return succeed(create_message_set(*args))
+        size = sum(len(m) for req in reqs for m in req.messages if m is not None)
+        if size < self.compression_thread_min_bytes:
+            return succeed(_create_message_set(*args))
+        return deferToThreadPool(self.client.reactor,
+                                 self.compression_threadpool,
+                                 _create_message_set, *args)
+
     def _send_requests(self, parts_results, requests):
         """Send the requests
 
@@ -301,7 +372,6 @@ class Producer(object):
         # destined to the same topic/partition into one request
         # the messages & deferreds, both by topic+partition
         reqsByTopicPart = defaultdict(list)
-        payloadsByTopicPart = defaultdict(list)
         deferredsByTopicPart = defaultdict(list)
 
         # We now have a list of (succeeded/failed, partition/None) tuples
@@ -329,27 +399,64 @@ class Producer(object):
             reqsByTopicPart[topicPart].append(req)
             deferredsByTopicPart[topicPart].append(req.deferred)
 
-        # Build list of payloads grouped by topic/partition
-        # That is, we bundle all the messages destined for a given
-        # topic/partition, even if they were submitted by different
-        # requests into a single 'payload', and then we submit all the
-        # payloads as a list to the client for sending to the various
-        # brokers. The finest granularity of success/failure is at the
-        # payload (topic/partition) level.
+        # Build the message set for each topic/partition. That is, we bundle
+        # all the messages destined for a given topic/partition, even if they
+        # were submitted by different requests, into a single 'payload'.
+        timestamp = None
+        if self.message_version > 0:
+            timestamp = int(self.client.reactor.seconds() * 1000)
+        topicParts = list(reqsByTopicPart)
+        msgSetDs = [
+            self._create_message_set(reqsByTopicPart[topicPart], timestamp)
+            for topicPart in topicParts]
+        # A batch cancelled while it's compressed mustn't be sent. The
+        # compression threads can't be stopped, but without a canceller,
+        # this deferred fails at once when cancelled, and ignores their
+        # results when they arrive.
+        d = Deferred()
+        DeferredList(msgSetDs, consumeErrors=True).chainDeferred(d)
+        d.addCallback(self._send_message_sets, topicParts,
+                      deferredsByTopicPart)
+        return d
+
+    def _send_message_sets(self, msgSets, topicParts, deferredsByTopicPart):
+        """Send the message sets of a batch
+
+        We submit all the payloads as a list to the client for sending to
+        the various brokers. The finest granularity of success/failure is at
+        the payload (topic/partition) level. The requests whose message set
+        couldn't be created fail, and the rest are sent without them.
+        """
         payloads = []
-        for (topic, partition), reqs in reqsByTopicPart.items():
-            msgSet = create_message_set(reqs, self.codec)
-            req = ProduceRequest(topic, partition, msgSet)
-            topicPart = TopicAndPartition(topic, partition)
+        payloadsByTopicPart = {}
+        for topicPart, (success, msgSet) in zip(topicParts, msgSets):
+            if not success:
+                for d in deferredsByTopicPart.pop(topicPart):
+                    # The request may have been cancelled meanwhile
+                    if not d.called:
+                        d.errback(msgSet)
+                continue
+            req = ProduceRequest(topicPart.topic, topicPart.partition, msgSet)
             payloads.append(req)
             payloadsByTopicPart[topicPart] = req
         # Make sure we have some payloads to send
         if not payloads:
             return
+        # Don't queue up more requests than the client's connections to the
+        # leaders will take: this batch's messages were taken from
+        # _batch_reqs already, but more can accumulate for the next one.
+        d = self.client.wait_for_capacity(payloads)
+        d.addCallback(self._send_payloads, payloads, payloadsByTopicPart,
+                      deferredsByTopicPart)
+        return d
+
+    def _send_payloads(self, _, payloads, payloadsByTopicPart,
+                       deferredsByTopicPart):
+        """Send the payloads of a batch, once the client has room"""
         # send the request
         d = self.client.send_produce_request(
             payloads, acks=self.req_acks, timeout=self.ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=self.compression_level)
         self._req_attempts += 1
         # add our handlers
         d.addBoth(self._handle_send_response, payloadsByTopicPart,
@@ -501,7 +608,7 @@ class Producer(object):
             # failed for retry
             d = self.client.send_produce_request(
                 payloads, acks=self.req_acks, timeout=self.ack_timeout,
-                fail_on_error=False)
+                fail_on_error=False, compression_level=self.compression_level)
             self._req_attempts += 1
             # add our handlers
             d.addBoth(self._handle_send_response, payloadsByTopicPart,
@@ -638,3 +745,18 @@ class Producer(object):
         for d in list(self._outstanding):
             d.addErrback(lambda _: None)  # Eat any uncaught errors
             d.cancel()
+
+
+def _create_message_set(requests, codec, magic, timestamp, compression_level):
+    """
+    Create a message set, compressing it completely
+
+    This is :func:`~afkak.kafkacodec.create_message_set`, except that
+    magic 2 messages are encoded as an :class:`EncodedRecordBatch`, as
+    otherwise they would be compressed only when the request is encoded.
+    """
+    msgSet = create_message_set(requests, codec, magic, timestamp,
+                                compression_level)
+    if magic == 2 and codec != CODEC_NONE:
+        msgSet = [EncodedRecordBatch.encode(msgSet, compression_level)]
+    return msgSet
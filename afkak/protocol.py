@@ -4,13 +4,16 @@
 from __future__ import absolute_import
 
 import logging
+import struct
 
 from twisted.internet.error import ConnectionDone
-from twisted.protocols.basic import Int32StringReceiver
+from twisted.protocols.basic import Int32StringReceiver, StringTooLongError
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+_PREFIX = struct.Struct(Int32StringReceiver.structFormat)
+
 
 class KafkaProtocol(Int32StringReceiver):
     """
@@ -18,14 +21,118 @@ class KafkaProtocol(Int32StringReceiver):
     Simply knows to call its factory.handleResponse()
     method with the string received by stringReceived() and
     to cleanup the factory reference when the connection is lost
+
+    The strings received are :class:`memoryview` objects rather than
+    :class:`bytes`, see :meth:`dataReceived`. As a string arrives in pieces,
+    the factory's handleResponsePart() method is called with what has
+    arrived so far, so that it can be decoded as it arrives.
+
+    Strings sent during one pass of the reactor are written together, at
+    the start of the next, so the factory must have a `clock`, unless they
+    are flushed first.
     """
     factory = None
     closing = False  # set by factory so we know to expect connectionLost
     MAX_LENGTH = 2 ** 31 - 1  # Max a signed Int32 can represent
+    _flushCall = None  # DelayedCall which writes _pending
+    _pending = None  # Length prefixes and strings waiting to be written
+    _header = b''  # The part of a length prefix received so far
+    _buffer = None  # memoryview of the bytearray a string is received into
+    _filled = 0  # How much of _buffer has been received
+
+    def dataReceived(self, data):
+        """
+        Split the data received into strings, without copying them
+
+        A string which arrives whole within one chunk of data is passed on
+        as a view of that chunk. Others are received into a bytearray, which
+        is allocated at the size given by the length prefix, so however many
+        chunks one arrives in, each byte is copied once, and no buffer is
+        grown or re-sliced.
+        """
+        view = memoryview(data)
+        pos, end = 0, len(view)
+        while pos < end:
+            if self._buffer is None:
+                if self._header or end - pos < _PREFIX.size:
+                    take = min(_PREFIX.size - len(self._header), end - pos)
+                    self._header += view[pos:pos + take].tobytes()
+                    pos += take
+                    if len(self._header) < _PREFIX.size:
+                        return
+                    (length,) = _PREFIX.unpack(self._header)
+                    self._header = b''
+                else:
+                    (length,) = _PREFIX.unpack_from(view, pos)
+                    pos += _PREFIX.size
+                if length > self.MAX_LENGTH:
+                    self.lengthLimitExceeded(length)
+                    return
+                if end - pos >= length:
+                    pos += length
+                    self.stringReceived(view[pos - length:pos])
+                    continue
+                self._buffer = memoryview(bytearray(length))
+                self._filled = 0
+            take = min(end - pos, len(self._buffer) - self._filled)
+            self._buffer[self._filled:self._filled + take] = \
+                view[pos:pos + take]
+            self._filled += take
+            pos += take
+            if self._filled == len(self._buffer):
+                string, self._buffer = self._buffer, None
+                self.stringReceived(string)
+            else:
+                self.stringPartReceived(self._buffer, self._filled)
+
+    def sendString(self, string):
+        """
+        Queue a length-prefixed string to be written
+
+        Rather than each string costing a write of its own, and a copy to
+        put the length prefix in front of it, the prefixes and strings are
+        passed to a single `writeSequence` call with all of the others sent
+        during this pass of the reactor.
+        """
+        if len(string) >= 2 ** (8 * self.prefixLength):
+            raise StringTooLongError(
+                "Try to send %s bytes whereas maximum is %s" % (
+                    len(string), 2 ** (8 * self.prefixLength)))
+        if self._flushCall is None:
+            self._pending = []
+            self._flushCall = self.factory.clock.callLater(0, self._flush)
+        self._pending.append(_PREFIX.pack(len(string)))
+        self._pending.append(string)
+
+    def flush(self):
+        """
+        Write the strings queued by :meth:`sendString` now, rather than at
+        the start of the next pass of the reactor
+        """
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flush()
+
+    def _flush(self):
+        self._flushCall = None
+        pending, self._pending = self._pending, None
+        self.transport.writeSequence(pending)
 
     def stringReceived(self, string):
         self.factory.handleResponse(string)
 
+    def stringPartReceived(self, string, received):
+        """
+        Part of a string has arrived
+
+        :param memoryview string:
+            The buffer the string is being received into. It is the same
+            object each time this is called for a string, and is passed to
+            :meth:`stringReceived` once the string is complete.
+        :param int received: how many bytes of it have arrived
+        """
+        self.factory.handleResponsePart(string, received)
+
     def connectionLost(self, reason=None):
         # If we are closing, or if the connection was cleanly closed (as
         # Kafka brokers will do after 10 minutes of idle connection) we log
@@ -37,6 +144,11 @@ class KafkaProtocol(Int32StringReceiver):
         else:
             log.warning("Lost Connection to Kafka Broker: %r", reason)
 
+        # The factory resends the requests awaiting responses, whether or
+        # not they were written.
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = self._pending = None
         self.factory = None
 
     def lengthLimitExceeded(self, length):
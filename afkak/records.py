@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+"""
+Kafka message format v2 (magic 2): the RecordBatch
+
+Kafka 0.11 replaced MessageSets of individually framed messages with
+batches: a single header, shared by all of the records in the batch and
+covered by one CRC32C, followed by compactly varint-encoded records::
+
+    RecordBatch =>
+      BaseOffset => int64
+      Length => int32
+      PartitionLeaderEpoch => int32
+      Magic => int8 (2)
+      CRC => uint32 (CRC32C of everything from Attributes onwards)
+      Attributes => int16
+      LastOffsetDelta => int32
+      FirstTimestamp => int64
+      MaxTimestamp => int64
+      ProducerId => int64
+      ProducerEpoch => int16
+      BaseSequence => int32
+      Records => [Record] (the records, but not their count, are compressed)
+
+    Record =>
+      Length => varint
+      Attributes => int8
+      TimestampDelta => varlong
+      OffsetDelta => varint
+      Key => varint length, bytes
+      Value => varint length, bytes
+      Headers => [varint length, bytes, varint length, bytes]
+
+Records are represented as :class:`afkak.common.Message` with a magic of 2.
+The attributes of a record are those of its batch, so a message's codec
+bits say how the batch it came from (or will go into) is compressed.
+Record headers are not supported: they are skipped when decoding.
+
+The CRC32C is computed by the `crc32c`_ package, which must be installed
+(see the ``crc32c`` setuptools extra) to use this format at any reasonable
+speed. Without it the CRC32C is computed in pure Python, orders of magnitude
+more slowly, and a :class:`RuntimeWarning` is issued when that first happens.
+
+.. _crc32c: https://pypi.org/project/crc32c/
+"""
+
+from __future__ import absolute_import
+
+import struct
+import warnings
+from collections import namedtuple
+from functools import partial
+
+from six import PY2
+
+from .codec import (gzip_decode, gzip_encode, lz4_decode, lz4_encode,
+                    snappy_decode, snappy_encode, zstd_decode, zstd_encode)
+from .common import (BufferUnderflowError, ChecksumError, Message,
+                     UnsupportedCodecError)
+
+try:
+    from crc32c import crc32c as _crc32c_native
+except ImportError:
+    _crc32c_native = None
+
+# Attributes of a RecordBatch
+BATCH_CODEC_MASK = 0x07
+BATCH_TIMESTAMP_LOG_APPEND = 0x08
+BATCH_TRANSACTIONAL = 0x10
+BATCH_CONTROL = 0x20
+
+# Offset of the magic byte, which is at the same place in a RecordBatch and
+# a legacy MessageSet entry, so it can be used to tell them apart.
+MAGIC_OFFSET = 16
+
+_BATCH_HEADER = struct.Struct('>qiibIhiqqqhii')
+# The part of the header covered by the CRC, which starts at Attributes
+_BATCH_HEADER_CRC_START = 21
+_BATCH_PREFIX = struct.Struct('>qiibI')
+_BATCH_SUFFIX = struct.Struct('>hiqqqhii')
+
+_NO_PRODUCER_ID = -1
+_NO_PRODUCER_EPOCH = -1
+_NO_SEQUENCE = -1
+_NO_PARTITION_LEADER_EPOCH = -1
+_NO_TIMESTAMP = -1
+
+
+def has_crc32c():
+    """
+    Is an accelerated CRC32C implementation available?
+    """
+    return _crc32c_native is not None
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82F63B78  # Castagnoli polynomial, reversed
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def _crc32c_python(data):
+    crc = 0xffffffff
+    table = _CRC32C_TABLE
+    for b in bytearray(data):
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def crc32c(data):
+    """
+    Compute the CRC32C (Castagnoli) checksum of a bytes-like object
+    """
+    if _crc32c_native is not None:
+        return _crc32c_native(data)
+    warnings.warn(
+        "The crc32c package is not installed: computing CRC32C in pure "
+        "Python, which is very slow. Install afkak[crc32c] to use message "
+        "format v2.", RuntimeWarning,
+    )
+    return _crc32c_python(data)
+
+
+def encode_varint(value):
+    """
+    Encode a signed integer as a zigzag varint, as used by Protocol Buffers
+    """
+    value = (value << 1) ^ (value >> 63)
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, pos):
+    """
+    Decode a zigzag varint
+
+    :param data:
+        buffer to read from, whose items are ints: a :class:`bytearray`,
+        or on Python 3 any bytes-like object
+    :param int pos: position of the varint in *data*
+    :returns: the value and the position following it
+    :raises IndexError: when *data* ends within the varint
+    """
+    result = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), pos
+
+
+def _encode_varbytes(b):
+    if b is None:
+        return encode_varint(-1)
+    return encode_varint(len(b)) + b
+
+
+def _decode_varbytes(data, view, pos):
+    length, pos = decode_varint(data, pos)
+    if length < 0:
+        return None, pos
+    end = pos + length
+    if end > len(data):
+        raise IndexError(end)
+    return view[pos:end].tobytes(), end
+
+
+_COMPRESSORS = {
+    0x00: None,
+    0x01: gzip_encode,
+    0x02: snappy_encode,
+    0x03: lz4_encode,
+    0x04: zstd_encode,
+}
+# Compressors which take a compression level
+_LEVEL_COMPRESSORS = {
+    0x01: gzip_encode,
+    0x04: zstd_encode,
+}
+_DECOMPRESSORS = {
+    0x01: gzip_decode,
+    0x02: snappy_decode,
+    0x03: lz4_decode,
+    0x04: zstd_decode,
+}
+
+
+def encode_record_batch(messages, base_offset=0, compression_level=None):
+    """
+    Encode a RecordBatch
+
+    :param list messages:
+        :class:`~afkak.common.Message` instances. The batch is compressed
+        according to the codec in the attributes of the first; the
+        attributes of the rest are ignored.
+    :param int base_offset:
+        Offset of the first message. The broker assigns offsets to the
+        batches it receives, so this only matters to tests.
+    :param int compression_level:
+        Level for codecs which have one, or ``None`` for the codec's
+        default. Ignored for other codecs.
+    :returns: the encoded batch as :class:`bytes`
+    :raises UnsupportedCodecError: for an unknown codec
+    """
+    codec = messages[0].attributes & BATCH_CODEC_MASK if messages else 0
+    try:
+        compress = _COMPRESSORS[codec]
+    except KeyError:
+        raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
+    if compression_level is not None and codec in _LEVEL_COMPRESSORS:
+        compress = partial(_LEVEL_COMPRESSORS[codec], level=compression_level)
+
+    timestamps = [m.timestamp for m in messages if m.timestamp is not None]
+    if timestamps:
+        first_timestamp = timestamps[0]
+        max_timestamp = max(timestamps)
+    else:
+        first_timestamp = max_timestamp = _NO_TIMESTAMP
+
+    records = []
+    for offset_delta, message in enumerate(messages):
+        if message.timestamp is None:
+            timestamp_delta = 0
+        else:
+            timestamp_delta = message.timestamp - first_timestamp
+        body = b''.join([
+            b'\x00',  # Attributes (unused)
+            encode_varint(timestamp_delta),
+            encode_varint(offset_delta),
+            _encode_varbytes(message.key),
+            _encode_varbytes(message.value),
+            b'\x00',  # No headers
+        ])
+        records.append(encode_varint(len(body)))
+        records.append(body)
+    records = b''.join(records)
+    if compress is not None:
+        records = compress(records)
+
+    body = _BATCH_SUFFIX.pack(
+        codec, len(messages) - 1, first_timestamp, max_timestamp,
+        _NO_PRODUCER_ID, _NO_PRODUCER_EPOCH, _NO_SEQUENCE,
+        len(messages),
+    ) + records
+    # The length covers everything after itself: the leader epoch (4 bytes),
+    # the magic (1), the CRC (4) and the body.
+    return _BATCH_PREFIX.pack(
+        base_offset, len(body) + 9, _NO_PARTITION_LEADER_EPOCH, 2,
+        crc32c(body),
+    ) + body
+
+
+class EncodedRecordBatch(namedtuple('EncodedRecordBatch', ['attributes', 'data'])):
+    """
+    A RecordBatch encoded ahead of time
+
+    This stands in for the messages of a
+    :class:`~afkak.common.ProduceRequest`, as the only element of its
+    message list, and is sent as-is. This lets the costly encoding and
+    compression happen somewhere other than where the request is encoded,
+    such as in a worker thread, and happen only once when the request is
+    retried.
+
+    :ivar int attributes:
+        The batch's attributes, of which the codec bits matter.
+    :ivar bytes data: the encoded batch
+    """
+    __slots__ = ()
+
+    magic = 2
+
+    @classmethod
+    def encode(cls, messages, compression_level=None):
+        """
+        Encode messages as a batch, see :func:`encode_record_batch`
+        """
+        codec = messages[0].attributes & BATCH_CODEC_MASK if messages else 0
+        return cls(codec, encode_record_batch(
+            messages, compression_level=compression_level))
+
+
+def decode_record_batch(view):
+    """
+    Decode a RecordBatch
+
+    :param memoryview view: exactly one batch
+    :returns:
+        iterator of ``(offset, Message)`` tuples. Control batches (which
+        mark transaction boundaries) yield nothing.
+    :raises BufferUnderflowError: when *view* doesn't hold a complete batch
+    :raises ChecksumError: when the batch's CRC32C doesn't match
+    """
+    if len(view) < _BATCH_HEADER.size:
+        raise BufferUnderflowError("Not enough data left")
+    (base_offset, _, _, _, crc, attributes, _, first_timestamp,
+     max_timestamp, _, _, _, count) = _BATCH_HEADER.unpack_from(view, 0)
+    if crc != crc32c(view[_BATCH_HEADER_CRC_START:]):
+        raise ChecksumError("RecordBatch checksum failed")
+    if attributes & BATCH_CONTROL:
+        return
+
+    codec = attributes & BATCH_CODEC_MASK
+    records = view[_BATCH_HEADER.size:]
+    if codec:
+        try:
+            decompress = _DECOMPRESSORS[codec]
+        except KeyError:
+            raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
+        records = decompress(records)
+    # The records are decoded from a view of the batch (or of what it
+    # decompressed to), so each key and value is copied once, out of it.
+    # Items of a memoryview aren't ints on Python 2, so varints are read
+    # from a bytearray there, which snappy may have decompressed to already.
+    view = memoryview(records)
+    if not PY2:
+        data = view
+    elif isinstance(records, bytearray):
+        data = records
+    else:
+        data = bytearray(view)
+    log_append = attributes & BATCH_TIMESTAMP_LOG_APPEND
+
+    pos = 0
+    try:
+        for _ in range(count):
+            length, pos = decode_varint(data, pos)
+            end = pos + length
+            pos += 1  # Attributes (unused)
+            timestamp_delta, pos = decode_varint(data, pos)
+            offset_delta, pos = decode_varint(data, pos)
+            key, pos = _decode_varbytes(data, view, pos)
+            value, pos = _decode_varbytes(data, view, pos)
+            if end > len(data):
+                raise IndexError(end)
+            pos = end  # Skip headers
+            if log_append:
+                timestamp = max_timestamp
+            else:
+                timestamp = first_timestamp + timestamp_delta
+            yield (base_offset + offset_delta,
+                   Message(2, attributes, key, value, timestamp))
+    except IndexError:
+        raise BufferUnderflowError("RecordBatch records truncated")
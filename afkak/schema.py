@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+"""
+Declarative Kafka protocol schemas
+
+Request and response layouts are declared as data using the types in this
+module and compiled once, at import time, into specialized encoder and
+decoder functions::
+
+    PartitionOffset = Struct('PartitionOffset', [
+        ('partition', Int32),
+        ('offset', Int64),
+        ('metadata', ShortBytes),
+    ])
+    decode_partition_offset = compile_decoder(PartitionOffset)
+    encode_partition_offset = compile_encoder(PartitionOffset)
+
+Compilation generates Python source for each :class:`Struct` and
+:class:`Array`, so a decoder is straight-line code rather than an
+interpreter walking the schema. Adjacent fixed-width fields are merged into
+a single cached :class:`struct.Struct` and read or written with one call.
+
+Decoders accept :class:`bytes` or any object supporting the buffer protocol
+and never copy the input: :data:`Bytes` fields decode to a
+:class:`memoryview` slice of it. Text (:data:`String`) and :data:`ShortBytes`
+fields are copied out.
+"""
+
+from __future__ import absolute_import
+
+import struct
+
+from six import exec_, string_types
+
+from .common import BufferUnderflowError, InvalidMessageError
+
+__all__ = [
+    'Int8', 'Int16', 'Int32', 'Int64', 'String', 'ShortBytes', 'Bytes',
+    'Array', 'Struct', 'compile_decoder', 'compile_encoder',
+]
+
+_INT16 = struct.Struct('>h')
+_INT32 = struct.Struct('>i')
+
+
+class _Fixed(object):
+    """
+    A fixed-width primitive, described by a :mod:`struct` format character
+    """
+    __slots__ = ('name', 'code', 'size')
+
+    def __init__(self, name, code):
+        self.name = name
+        self.code = code
+        self.size = struct.calcsize('>' + code)
+
+    def __repr__(self):
+        return self.name
+
+
+class _Variable(object):
+    """
+    A length-prefixed primitive, read and written by helper functions
+    """
+    __slots__ = ('name', 'reader', 'writer', 'min_size')
+
+    def __init__(self, name, reader, writer, min_size):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.min_size = min_size
+
+    def __repr__(self):
+        return self.name
+
+
+class Array(object):
+    """
+    An int32 count followed by that many *item* values
+
+    Arrays of fixed-width primitives decode to a :class:`tuple`; other
+    arrays decode to a :class:`list`. A negative count decodes as empty.
+
+    :param item: schema of each element
+    :param int max_length:
+        If given, decoding raises :exc:`InvalidMessageError` when the count
+        exceeds it. Independent of this, a count which could not possibly fit
+        in the remaining input raises :exc:`BufferUnderflowError` before any
+        elements are decoded.
+    """
+    __slots__ = ('item', 'max_length')
+
+    def __init__(self, item, max_length=None):
+        self.item = item
+        self.max_length = max_length
+
+    def __repr__(self):
+        return 'Array({!r})'.format(self.item)
+
+
+class Struct(object):
+    """
+    A sequence of named fields
+
+    Structs encode from, and decode to, a sequence of field values in
+    declaration order.
+
+    :param str name: used to name the generated functions
+    :param list fields: ``(name, schema)`` pairs
+    :param factory:
+        Callable applied to the decoded field values (e.g.
+        a :func:`~collections.namedtuple`). By default a :class:`tuple` is
+        produced.
+    """
+    __slots__ = ('name', 'fields', 'factory')
+
+    def __init__(self, name, fields, factory=None):
+        self.name = name
+        self.fields = tuple(fields)
+        self.factory = factory
+
+    def __repr__(self):
+        return 'Struct({!r})'.format(self.name)
+
+
+def _check_length(view, end):
+    if end > len(view):
+        raise BufferUnderflowError("Not enough data left")
+
+
+def _read_string(view, cur):
+    (length,) = _INT16.unpack_from(view, cur)
+    cur += 2
+    if length < 0:
+        return None, cur
+    end = cur + length
+    _check_length(view, end)
+    return view[cur:end].tobytes().decode('ascii'), end
+
+
+def _read_short_bytes(view, cur):
+    (length,) = _INT16.unpack_from(view, cur)
+    cur += 2
+    if length < 0:
+        return None, cur
+    end = cur + length
+    _check_length(view, end)
+    return view[cur:end].tobytes(), end
+
+
+def _read_bytes(view, cur):
+    (length,) = _INT32.unpack_from(view, cur)
+    cur += 4
+    if length < 0:
+        return None, cur
+    end = cur + length
+    _check_length(view, end)
+    return view[cur:end], end
+
+
+def _write_short_bytes(parts, b):
+    if b is None:
+        parts.append(b'\xff\xff')
+    elif not isinstance(b, bytes):
+        raise TypeError('{!r} is not bytes'.format(b))
+    else:
+        parts.append(_INT16.pack(len(b)))
+        parts.append(b)
+
+
+def _write_string(parts, s):
+    if s is None:
+        parts.append(b'\xff\xff')
+    elif not isinstance(s, string_types):
+        raise TypeError('{!r} is not text'.format(s))
+    else:
+        _write_short_bytes(parts, s.encode('ascii'))
+
+
+def _write_bytes(parts, b):
+    if b is None:
+        parts.append(b'\xff\xff\xff\xff')
+    else:
+        parts.append(_INT32.pack(len(b)))
+        parts.append(b)
+
+
+Int8 = _Fixed('Int8', 'b')
+Int16 = _Fixed('Int16', 'h')
+Int32 = _Fixed('Int32', 'i')
+Int64 = _Fixed('Int64', 'q')
+#: Text as an int16 length-prefixed ASCII string
+String = _Variable('String', _read_string, _write_string, 2)
+#: Bytes with an int16 length prefix
+ShortBytes = _Variable('ShortBytes', _read_short_bytes, _write_short_bytes, 2)
+#: Bytes with an int32 length prefix. Decodes to a :class:`memoryview`.
+Bytes = _Variable('Bytes', _read_bytes, _write_bytes, 4)
+
+
+def _min_size(schema):
+    """
+    Smallest possible encoded size of a value of *schema*
+    """
+    if isinstance(schema, _Fixed):
+        return schema.size
+    if isinstance(schema, _Variable):
+        return schema.min_size
+    if isinstance(schema, Array):
+        return 4
+    return sum(_min_size(t) for _, t in schema.fields)
+
+
+def _read_array_count(view, cur, min_item_size, max_length):
+    (count,) = _INT32.unpack_from(view, cur)
+    cur += 4
+    if count < 0:
+        return 0, cur
+    if max_length is not None and count > max_length:
+        raise InvalidMessageError(
+            "Array length {} exceeds maximum {}".format(count, max_length))
+    if count * min_item_size > len(view) - cur:
+        raise BufferUnderflowError("Not enough data left")
+    return count, cur
+
+
+class _Compiler(object):
+    """
+    Generate the source for the functions implementing a schema
+
+    Each :class:`Struct` and :class:`Array` becomes a function taking
+    ``(view, cur)`` and returning ``(value, cur)`` (decoding) or taking
+    ``(parts, value)`` and appending encoded :class:`bytes` to the list
+    *parts* (encoding). Objects the generated code refers to are collected
+    in :attr:`namespace`.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.namespace = {
+            'BufferUnderflowError': BufferUnderflowError,
+            '_INT32': _INT32,
+            '_read_array_count': _read_array_count,
+            'struct_pack': struct.pack,
+            'struct_unpack_from': struct.unpack_from,
+        }
+        self.source = []
+        self._names = {}
+
+    def _bind(self, obj, hint):
+        name = '_{}{}'.format(hint, len(self.namespace))
+        self.namespace[name] = obj
+        return name
+
+    def _fn_name(self, schema):
+        base = getattr(schema, 'name', 'Array')
+        name = '{}_{}_{}'.format(self.prefix, base, len(self._names))
+        self._names[id(schema)] = name
+        return name
+
+    def _fixed_groups(self, fields):
+        """
+        Split *fields* into runs of adjacent fixed-width fields (yielded as
+        a list of ``(var, schema)`` pairs) and single other fields.
+        """
+        run = []
+        for var, schema in fields:
+            if isinstance(schema, _Fixed):
+                run.append((var, schema))
+                continue
+            if run:
+                yield run
+                run = []
+            yield (var, schema)
+        if run:
+            yield run
+
+    def _struct_for(self, run):
+        s = struct.Struct('>' + ''.join(schema.code for _, schema in run))
+        return self._bind(s, 's'), s.size
+
+    # Decoding
+
+    def decoder(self, schema):
+        if id(schema) in self._names:
+            return self._names[id(schema)]
+        if isinstance(schema, Struct):
+            return self._struct_decoder(schema)
+        if isinstance(schema, Array):
+            return self._array_decoder(schema)
+        raise TypeError('Cannot compile {!r}'.format(schema))
+
+    def _field_decode(self, lines, var, schema):
+        if isinstance(schema, _Variable):
+            fn = self._bind(schema.reader, 'r')
+        else:
+            fn = self.decoder(schema)
+        lines.append('    {}, cur = {}(view, cur)'.format(var, fn))
+
+    def _struct_decoder(self, schema):
+        name = self._fn_name(schema)
+        fields = [('v{}'.format(i), t) for i, (_, t) in enumerate(schema.fields)]
+        lines = ['def {}(view, cur):'.format(name)]
+        for group in self._fixed_groups(fields):
+            if isinstance(group, list):
+                s, size = self._struct_for(group)
+                lines.append('    ({},) = {}.unpack_from(view, cur)'.format(
+                    ', '.join(var for var, _ in group), s))
+                lines.append('    cur += {}'.format(size))
+            else:
+                self._field_decode(lines, *group)
+        values = ', '.join(var for var, _ in fields)
+        if schema.factory is None:
+            lines.append('    return ({},), cur'.format(values))
+        else:
+            factory = self._bind(schema.factory, 'f')
+            lines.append('    return {}({}), cur'.format(factory, values))
+        self.source.append('\n'.join(lines))
+        return name
+
+    def _array_decoder(self, schema):
+        name = self._fn_name(schema)
+        item = schema.item
+        lines = [
+            'def {}(view, cur):'.format(name),
+            '    count, cur = _read_array_count(view, cur, {}, {!r})'.format(
+                _min_size(item), schema.max_length),
+        ]
+        if isinstance(item, _Fixed):
+            lines += [
+                "    out = struct_unpack_from('>%d{}' % count, view, cur)".format(item.code),
+                '    return out, cur + count * {}'.format(item.size),
+            ]
+        else:
+            lines += [
+                '    out = []',
+                '    append = out.append',
+                '    for _ in range(count):',
+            ]
+            if isinstance(item, _Variable):
+                fn = self._bind(item.reader, 'r')
+            else:
+                fn = self.decoder(item)
+            lines += [
+                '        value, cur = {}(view, cur)'.format(fn),
+                '        append(value)',
+                '    return out, cur',
+            ]
+        self.source.append('\n'.join(lines))
+        return name
+
+    # Encoding
+
+    def encoder(self, schema):
+        if id(schema) in self._names:
+            return self._names[id(schema)]
+        if isinstance(schema, Struct):
+            return self._struct_encoder(schema)
+        if isinstance(schema, Array):
+            return self._array_encoder(schema)
+        raise TypeError('Cannot compile {!r}'.format(schema))
+
+    def _field_encode(self, lines, var, schema, indent='    '):
+        if isinstance(schema, _Variable):
+            fn = self._bind(schema.writer, 'w')
+        else:
+            fn = self.encoder(schema)
+        lines.append('{}{}(parts, {})'.format(indent, fn, var))
+
+    def _struct_encoder(self, schema):
+        name = self._fn_name(schema)
+        fields = [('v{}'.format(i), t) for i, (_, t) in enumerate(schema.fields)]
+        lines = [
+            'def {}(parts, value):'.format(name),
+            '    ({},) = value'.format(', '.join(var for var, _ in fields)),
+        ]
+        for group in self._fixed_groups(fields):
+            if isinstance(group, list):
+                s, _ = self._struct_for(group)
+                lines.append('    parts.append({}.pack({}))'.format(
+                    s, ', '.join(var for var, _ in group)))
+            else:
+                self._field_encode(lines, *group)
+        self.source.append('\n'.join(lines))
+        return name
+
+    def _array_encoder(self, schema):
+        name = self._fn_name(schema)
+        item = schema.item
+        lines = [
+            'def {}(parts, value):'.format(name),
+            '    parts.append(_INT32.pack(len(value)))',
+        ]
+        if isinstance(item, _Fixed):
+            lines.append(
+                "    parts.append(struct_pack('>%d{}' % len(value), *value))".format(item.code))
+        else:
+            lines.append('    for item in value:')
+            self._field_encode(lines, 'item', item, indent='        ')
+        self.source.append('\n'.join(lines))
+        return name
+
+    def build(self, entry):
+        source = '\n\n'.join(self.source) + '\n'
+        code = compile(source, '<afkak.schema {}>'.format(entry), 'exec')
+        exec_(code, self.namespace)
+        return self.namespace[entry]
+
+
+def compile_decoder(schema):
+    """
+    Compile a function decoding *schema*
+
+    :param schema: a :class:`Struct` or :class:`Array`
+    :returns:
+        A function taking a buffer and an optional starting position, and
+        returning a tuple of the decoded value and the position following it.
+
+        It raises :exc:`BufferUnderflowError` when the buffer ends before the
+        value does.
+    """
+    compiler = _Compiler('decode')
+    decode_value = compiler.build(compiler.decoder(schema))
+
+    def decode(data, cur=0):
+        try:
+            return decode_value(memoryview(data), cur)
+        except struct.error:
+            raise BufferUnderflowError("Not enough data left")
+
+    decode.__name__ = str('decode_' + getattr(schema, 'name', 'Array'))
+    return decode
+
+
+def compile_encoder(schema):
+    """
+    Compile a function encoding *schema*
+
+    :param schema: a :class:`Struct` or :class:`Array`
+    :returns:
+        A function taking a value and returning it encoded as :class:`bytes`.
+        The function's ``append_to`` attribute is a variant which appends the
+        encoded pieces to a list instead, for composing encoders.
+    """
+    compiler = _Compiler('encode')
+    encode_value = compiler.build(compiler.encoder(schema))
+
+    def encode(value):
+        parts = []
+        encode_value(parts, value)
+        return b''.join(parts)
+
+    encode.__name__ = str('encode_' + getattr(schema, 'name', 'Array'))
+    encode.append_to = encode_value
+    return encode
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+"""
+Microbenchmark of request tracking in
+:class:`~afkak.brokerclient._KafkaBrokerClient`
+
+Run it with::
+
+    python -m afkak.test.bench_brokerclient
+
+Requests are made through a broker client whose connection is a stub that
+discards what is sent, and answered by handing the client responses
+carrying their correlation IDs, as a :class:`~afkak.protocol.KafkaProtocol`
+would. The throughput of this is reported for windows of increasing numbers
+of requests outstanding at once, both without a limit on the requests in
+flight and with one as big as the window.
+"""
+
+from __future__ import division, print_function
+
+import struct
+import timeit
+
+from twisted.internet import task
+
+from afkak.brokerclient import _KafkaBrokerClient
+
+WINDOWS = (1, 10, 100, 1000)
+REQUESTS = 100000
+REQUEST = b'r' * 64
+
+
+class StubProtocol(object):
+    """
+    Just enough of a KafkaProtocol for a broker client
+    """
+    def sendString(self, string):
+        pass
+
+
+def make_client(max_in_flight):
+    client = _KafkaBrokerClient(task.Clock(), 'bench', 9092, 'bench',
+                                maxInFlight=max_in_flight)
+    client.proto = StubProtocol()
+    return client
+
+
+def run(window, max_in_flight):
+    client = make_client(max_in_flight)
+    responses = [struct.pack('>i', i) + b'response' for i in range(window)]
+    rounds = REQUESTS // window
+
+    def bench():
+        makeRequest = client.makeRequest
+        handleResponse = client.handleResponse
+        for _ in range(rounds):
+            for i in range(window):
+                makeRequest(i, REQUEST)
+            for response in responses:
+                handleResponse(response)
+
+    elapsed = min(timeit.repeat(bench, number=1, repeat=5))
+    return rounds * window / elapsed
+
+
+def main():
+    print('{:>8}  {:>16}  {:>16}'.format(
+        'window', 'unbounded req/s', 'bounded req/s'))
+    for window in WINDOWS:
+        print('{:>8}  {:>16,.0f}  {:>16,.0f}'.format(
+            window, run(window, None), run(window, window)))
+
+
+if __name__ == '__main__':
+    main()
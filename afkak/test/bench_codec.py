@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+"""
+Microbenchmark for the compression codecs in :mod:`afkak.codec`
+
+Run it with::
+
+    python -m afkak.test.bench_codec [codec...]
+
+For each available codec the compression ratio and the throughput of
+compression and decompression are reported for a few payloads: a batch of
+small, similar JSON-ish messages (typical of Kafka traffic), and
+incompressible random bytes. Every gzip level is measured, to show what
+each costs in throughput for what it gains in ratio.
+"""
+
+from __future__ import division, print_function
+
+import functools
+import json
+import os
+import random
+import sys
+import timeit
+
+from afkak.codec import (gzip_decode, gzip_encode, has_gzip, has_lz4,
+                         has_snappy, has_zstd, lz4_decode, lz4_encode,
+                         snappy_decode, snappy_encode, zstd_decode,
+                         zstd_encode)
+
+
+def _records(count):
+    rand = random.Random(0)
+    return b'\n'.join(json.dumps({
+        'id': i,
+        'host': 'host-{}.example.com'.format(rand.randrange(20)),
+        'level': rand.choice(['DEBUG', 'INFO', 'WARN']),
+        'latency_ms': rand.random() * 100,
+    }, sort_keys=True).encode('ascii') for i in range(count))
+
+
+PAYLOADS = [
+    ('records-16KiB', _records(150)),
+    ('records-1MiB', _records(10000)),
+    ('random-64KiB', os.urandom(64 * 1024)),
+]
+
+CODECS = [
+    ('gzip-{}'.format(level), has_gzip,
+     functools.partial(gzip_encode, level=level), gzip_decode)
+    for level in range(1, 10)
+] + [
+    ('snappy', has_snappy, snappy_encode, snappy_decode),
+    ('snappy-xerial', has_snappy,
+     functools.partial(snappy_encode, xerial_compatible=True), snappy_decode),
+    ('lz4', has_lz4, lz4_encode, lz4_decode),
+    ('lz4-broken-checksum', has_lz4,
+     lambda p: lz4_encode(p, broken_checksum=True),
+     lambda p: lz4_decode(p, broken_checksum=True)),
+    ('zstd-1', has_zstd, lambda p: zstd_encode(p, 1), zstd_decode),
+    ('zstd-3', has_zstd, zstd_encode, zstd_decode),
+    ('zstd-9', has_zstd, lambda p: zstd_encode(p, 9), zstd_decode),
+]
+
+
+def bench(fn, min_time=0.2):
+    """
+    Time a single call of *fn*.
+
+    :returns: best observed seconds per call
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(3, number)) / number
+
+
+def main(argv):
+    names = set(argv[1:])
+    print('{:<20}  {:<14}  {:>6}  {:>12}  {:>12}'.format(
+        'codec', 'payload', 'ratio', 'encode MB/s', 'decode MB/s'))
+    for name, available, encode, decode in CODECS:
+        if names and name not in names:
+            continue
+        if not available():
+            print('{:<20}  (not available)'.format(name))
+            continue
+        for payload_name, payload in PAYLOADS:
+            compressed = encode(payload)
+            assert decode(compressed) == payload
+            mb = len(payload) / 1e6
+            print('{:<20}  {:<14}  {:>6.2f}  {:>12.1f}  {:>12.1f}'.format(
+                name, payload_name, len(payload) / len(compressed),
+                mb / bench(lambda: encode(payload)),
+                mb / bench(lambda: decode(compressed))))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
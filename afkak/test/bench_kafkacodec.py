@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+"""
+Microbenchmark for the request encoders in :mod:`afkak.kafkacodec`
+
+Run it with::
+
+    python -m afkak.test.bench_kafkacodec
+
+For each encoder, the time taken to encode a request covering an increasing
+number of partitions is reported along with the time per partition.  Encode
+time should grow linearly with the partition count, so the per-partition
+column should stay roughly flat as the request grows.
+"""
+
+from __future__ import division, print_function
+
+import sys
+import timeit
+
+from afkak.common import (FetchRequest, OffsetCommitRequest,
+                          OffsetFetchRequest, OffsetRequest, ProduceRequest)
+from afkak.kafkacodec import KafkaCodec, create_message
+
+PARTITION_COUNTS = (1, 10, 100, 500, 1000, 2000)
+TOPIC_COUNT = 10
+MESSAGES_PER_PARTITION = 4
+VALUE = b'v' * 100
+
+
+def _topic_partitions(count):
+    """
+    Spread *count* partitions across `TOPIC_COUNT` topics.
+    """
+    for i in range(count):
+        yield u'topic-{}'.format(i % TOPIC_COUNT), i // TOPIC_COUNT
+
+
+def produce_request(count):
+    messages = [create_message(VALUE, b'key')] * MESSAGES_PER_PARTITION
+    payloads = [ProduceRequest(t, p, messages) for t, p in _topic_partitions(count)]
+    return lambda: KafkaCodec.encode_produce_request(b'bench', 1, payloads)
+
+
+def fetch_request(count):
+    payloads = [FetchRequest(t, p, 1234, 65536) for t, p in _topic_partitions(count)]
+    return lambda: KafkaCodec.encode_fetch_request(b'bench', 1, payloads)
+
+
+def offset_request(count):
+    payloads = [OffsetRequest(t, p, -1, 1) for t, p in _topic_partitions(count)]
+    return lambda: KafkaCodec.encode_offset_request(b'bench', 1, payloads)
+
+
+def offset_commit_request(count):
+    payloads = [OffsetCommitRequest(t, p, 1234, -1, b'metadata')
+                for t, p in _topic_partitions(count)]
+    return lambda: KafkaCodec.encode_offset_commit_request(
+        b'bench', 1, u'group', 1, u'consumer', payloads)
+
+
+def offset_fetch_request(count):
+    payloads = [OffsetFetchRequest(t, p) for t, p in _topic_partitions(count)]
+    return lambda: KafkaCodec.encode_offset_fetch_request(
+        b'bench', 1, u'group', payloads)
+
+
+BENCHMARKS = [
+    ('encode_produce_request', produce_request),
+    ('encode_fetch_request', fetch_request),
+    ('encode_offset_request', offset_request),
+    ('encode_offset_commit_request', offset_commit_request),
+    ('encode_offset_fetch_request', offset_fetch_request),
+]
+
+
+def bench(make_encoder, count, min_time=0.2):
+    """
+    Time a single encode of a request with *count* partitions.
+
+    :returns: best observed seconds per call
+    """
+    timer = timeit.Timer(make_encoder(count))
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(3, number)) / number
+
+
+def main(argv):
+    names = set(argv[1:])
+    for name, make_encoder in BENCHMARKS:
+        if names and name not in names:
+            continue
+        print(name)
+        print('  {:>10}  {:>12}  {:>16}'.format('partitions', 'usec/request', 'usec/partition'))
+        for count in PARTITION_COUNTS:
+            seconds = bench(make_encoder, count)
+            print('  {:>10}  {:>12.1f}  {:>16.3f}'.format(
+                count, seconds * 1e6, seconds * 1e6 / count))
+        print()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+"""
+Benchmark of reactor latency while a :class:`~afkak.producer.Producer`
+compresses heavily
+
+Run it with::
+
+    python -m afkak.test.bench_producer [threads...]
+
+A producer sends batches of JSON-ish records, gzipped at level 9, to
+a topic with eight partitions through a stub client, which encodes each
+request as :class:`~afkak.client.KafkaClient` would and acknowledges it
+a millisecond later. Meanwhile a looping call ticks every millisecond, and
+the gaps between its ticks show how long the reactor was blocked.
+
+This is done once compressing on the reactor thread, and once with
+a compression thread pool of each of the given sizes (default: 2 and 4).
+"""
+
+from __future__ import division, print_function
+
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python.threadpool import ThreadPool
+
+from afkak.common import ProduceResponse
+from afkak.kafkacodec import CODEC_GZIP, KafkaCodec
+from afkak.producer import Producer
+from afkak.test.bench_codec import _records
+
+TOPIC = u'bench'
+PARTITIONS = 8
+SENDS = 64
+MESSAGES = _records(400).split(b'\n')  # About 37 KiB per send
+MESSAGE_VERSION = 2
+
+
+class StubClient(object):
+    """
+    Just enough of a KafkaClient for a Producer
+    """
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.topic_partitions = {TOPIC: list(range(PARTITIONS))}
+        self.offset = 0
+
+    def metadata_error_for_topic(self, topic):
+        return None
+
+    def wait_for_capacity(self, payloads):
+        return defer.succeed(None)
+
+    def send_produce_request(self, payloads, acks, timeout, fail_on_error,
+                             compression_level):
+        KafkaCodec.encode_produce_request(
+            b'bench', 1, payloads, acks, timeout,
+            api_version=3 if MESSAGE_VERSION == 2 else 0,
+            compression_level=compression_level)
+        responses = []
+        for payload in payloads:
+            responses.append(ProduceResponse(payload.topic, payload.partition,
+                                             0, self.offset))
+            self.offset += 1
+        return task.deferLater(self.reactor, 0.001, lambda: responses)
+
+
+@defer.inlineCallbacks
+def run(reactor, threads):
+    pool = None
+    if threads:
+        pool = ThreadPool(threads, threads, 'bench-compression')
+        pool.start()
+    producer = Producer(StubClient(reactor), codec=CODEC_GZIP,
+                        message_version=MESSAGE_VERSION,
+                        compression_threadpool=pool)
+
+    gaps = []
+    last = [time.time()]
+
+    def tick():
+        now = time.time()
+        gaps.append(now - last[0])
+        last[0] = now
+
+    ticker = task.LoopingCall(tick)
+    ticker.start(0.001)
+    start = time.time()
+    yield defer.gatherResults([
+        producer.send_messages(TOPIC, msgs=MESSAGES) for _ in range(SENDS)
+    ])
+    elapsed = time.time() - start
+    ticker.stop()
+    producer.stop()
+    if pool is not None:
+        pool.stop()
+
+    gaps.sort()
+    mb = SENDS * sum(len(m) for m in MESSAGES) / 1e6
+    print('{:<12}  {:>9.1f}  {:>12.1f}  {:>12.1f}  {:>12.1f}'.format(
+        '{} threads'.format(threads) if threads else 'reactor',
+        mb / elapsed,
+        gaps[len(gaps) // 2] * 1000,
+        gaps[int(len(gaps) * 0.99)] * 1000,
+        gaps[-1] * 1000))
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    print('{:<12}  {:>9}  {:>12}  {:>12}  {:>12}'.format(
+        'compression', 'MB/s', 'p50 gap ms', 'p99 gap ms', 'max gap ms'))
+    for threads in [0] + [int(a) for a in argv or (2, 4)]:
+        yield run(reactor, threads)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
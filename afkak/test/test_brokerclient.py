@@ -11,12 +11,14 @@ from __future__ import division, absolute_import
 import struct
 import logging
 
-from mock import Mock, patch
+from mock import Mock, call, patch
 
 from twisted.internet.address import IPv4Address
+from twisted.internet.defer import CancelledError as t_CancelledError
 from twisted.internet.defer import Deferred
 from twisted.internet.error import (
-    ConnectionRefusedError, ConnectionDone, UserError, NotConnectingError)
+    ConnectionRefusedError, ConnectionDone, ConnectionLost, UserError,
+    NotConnectingError)
 from twisted.internet.protocol import Protocol
 from twisted.protocols.basic import StringTooLongError
 from twisted.python.failure import Failure
@@ -499,6 +501,26 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         # expectResponse=False, since we don't keep the requestID after send
         self.assertRaises(KeyError, c.cancelRequest, id2)
 
+    def test_makeRequestNoReplyWritten(self):
+        """
+        A request which expects no reply is written before its deferred
+        fires, along with any sent before it.
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient(reactor, 'test_connect', 9092, 'clientId')
+        c._connect()  # Force a connection attempt
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        c.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        c.proto.makeConnection(transport)
+        c.makeRequest(1, b'reply')
+        self.assertEqual(transport.value(), b'')
+
+        d = c.makeRequest(2, b'noreply', expectResponse=False)
+        self.assertIsNone(self.successResultOf(d))
+        self.assertEqual(transport.value(),
+                         b'\x00\x00\x00\x05reply\x00\x00\x00\x07noreply')
+
     def test_makeUnconnectedRequest(self):
         """
         Ensure that sending a request when not connected will attempt to bring
@@ -562,6 +584,33 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         # And the request should be 'sent'
         self.assertTrue(c.requests[id1].sent)
 
+    def test_requestNotRetried(self):
+        """
+        A request made with retry=False fails when the connection it was
+        sent over is lost, rather than being sent again.
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient(reactor, 'testrequestNotRetried', 9092,
+                              'clientId')
+        d1 = c.makeRequest(1, b'once', retry=False)
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        d2 = c.makeRequest(2, b'retried')
+        self.assertEqual(c.proto.sendString.call_count, 2)
+
+        from twisted.internet.main import CONNECTION_LOST
+        c.clientConnectionLost(c.connector, Failure(CONNECTION_LOST))
+        reactor.advance(0.1)
+        self.failureResultOf(d1, ConnectionLost)
+        self.assertEqual(list(c.requests), [2])
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        c.proto.sendString.assert_called_once_with(b'retried')
+        self.assertNoResult(d2)
+
     def test_handleResponse(self):
         def make_fetch_response(id):
             t1 = b"topic1"
@@ -634,6 +683,93 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         finally:
             brokerclient.log = logsave
 
+    def test_handleResponsePart(self):
+        """
+        Parts of a response are passed to the partCallback of the request
+        whose correlation ID they start with, and so is the whole response,
+        before the request's deferred fires.
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient(reactor, 'test_handleResponsePart', 9092,
+                              'clientId')
+        c.proto = Mock()
+        part_callback = Mock()
+        d = c.makeRequest(1, b'request1', partCallback=part_callback)
+        d.addCallback(lambda _: part_callback.call_count)
+        c.makeRequest(2, b'request2')
+        response = memoryview(bytearray(struct.pack('>ii', 1, 2)))
+
+        c.handleResponsePart(response, 3)
+        c.handleResponsePart(response, 6)
+        c.handleResponsePart(memoryview(struct.pack('>i', 2)), 4)
+        c.handleResponsePart(memoryview(struct.pack('>i', 3)), 4)
+
+        part_callback.assert_called_once_with(response, 6)
+
+        c.handleResponse(response)
+        part_callback.assert_called_with(response, 8)
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_handleResponsePart_fails(self):
+        """
+        When a partCallback raises, the failure is logged and its request
+        fails with it, while other requests carry on.
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient(reactor, 'test_handleResponsePart', 9092,
+                              'clientId')
+        c.proto = Mock()
+        d1 = c.makeRequest(1, b'request1',
+                           partCallback=Mock(side_effect=ValueError()))
+        d2 = c.makeRequest(2, b'request2')
+        response = memoryview(bytearray(struct.pack('>ii', 1, 2)))
+
+        with patch.object(brokerclient, 'log') as log:
+            c.handleResponsePart(response, 6)
+            self.failureResultOf(d1, ValueError)
+            self.assertEqual(log.exception.call_count, 1)
+            self.assertEqual(list(c.requests), [2])
+
+            # The rest of its response is ignored.
+            c.handleResponse(response)
+        c.handleResponse(struct.pack('>i', 2))
+        self.assertEqual(self.successResultOf(d2), struct.pack('>i', 2))
+
+    def test_maxInFlight(self):
+        """
+        Requests beyond the window wait, in order, for responses to make
+        room, and so do the callers of waitForRoom().
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient(reactor, 'test_maxInFlight', 9092, 'clientId',
+                              maxInFlight=2)
+        c._connect()  # Force a connection attempt
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        c.proto = Mock()
+        ds = [c.makeRequest(i, b'request%d' % i) for i in (1, 2, 3)]
+        d4 = c.makeRequest(4, b'request4', expectResponse=False)
+        self.assertEqual(c.proto.sendString.call_args_list,
+                         [call(b'request1'), call(b'request2')])
+        room_d = c.waitForRoom()
+        cancelled_d = c.waitForRoom()
+        cancelled_d.cancel()
+        self.failureResultOf(cancelled_d, t_CancelledError)
+
+        c.handleResponse(struct.pack('>i', 1))
+        self.assertEqual(self.successResultOf(ds[0]), struct.pack('>i', 1))
+        c.proto.sendString.assert_called_with(b'request3')
+        self.assertNoResult(d4)
+        self.assertNoResult(room_d)
+
+        ds[1].cancel()
+        c.proto.sendString.assert_called_with(b'request4')
+        self.assertIsNone(self.successResultOf(d4))
+        self.assertIsNone(self.successResultOf(room_d))
+        self.assertIsNone(self.successResultOf(c.waitForRoom()))
+        self.assertEqual(list(c.requests), [3])
+        self.assertEqual(c._inFlight, 1)
+        self.failureResultOf(ds[1], CancelledError)
+
     def test_Request(self):
         """
         test_Request
@@ -643,3 +779,40 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
 
         tReq = _Request(5, b"data", True)
         self.assertEqual(tReq.__repr__(), '_Request:5:True')
+        self.assertFalse(tReq.sent)
+        self.assertIsNone(tReq.partCallback)
+        self.assertRaises(AttributeError, setattr, tReq, 'other', 1)
+
+        canceller = Mock()
+        tReq = _Request(6, b"data", True, canceller)
+        tReq.d.cancel()
+        canceller.assert_called_once_with(6)
+        self.failureResultOf(tReq.d, t_CancelledError)
+
+    def test_makeRequest_resend_order(self):
+        """
+        Requests left unanswered when the connection is lost are sent again
+        in the order they were made, ahead of those made since, whatever
+        their correlation IDs.
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient(reactor, 'kafka', 9092, 'clientId')
+        c.connector = Mock()
+        c.proto = Mock()
+        ids = [9, 2, 7, 4]
+        ds = [c.makeRequest(requestId, b'request%d' % requestId)
+              for requestId in ids[:3]]
+        c.handleResponse(struct.pack('>i', 2))
+        ds[2].cancel()
+        self.failureResultOf(ds[2], CancelledError)
+
+        c.clientConnectionLost(c.connector, Failure(ConnectionDone()))
+        ds.append(c.makeRequest(4, b'request4'))
+        reactor.advance(0.0)
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.0)
+        self.assertEqual(c.proto.sendString.call_args_list,
+                         [call(b'request9'), call(b'request4')])
+        self.assertEqual(sorted(c.requests), [4, 9])
+        self.assertNoResult(ds[0])
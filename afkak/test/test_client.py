@@ -14,23 +14,26 @@ from copy import copy
 from functools import partial
 
 from mock import ANY, MagicMock, Mock, call, patch
+from twisted.internet.defer import CancelledError as t_CancelledError
 from twisted.internet.defer import Deferred, fail, succeed
 from twisted.internet.error import ConnectionDone, ConnectionLost, UserError
 from twisted.names.dns import Record_A, Record_CNAME, RRHeader
 from twisted.names.error import DomainError
 from twisted.python.compat import nativeString
 from twisted.python.failure import Failure
-from twisted.test.proto_helpers import MemoryReactorClock
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
 from twisted.trial import unittest
 
 from .. import KafkaClient
 from .. import client as kclient  # for patching
 from ..brokerclient import _KafkaBrokerClient
-from ..client import _collect_hosts
+from ..client import _collect_hosts, _Deadlines
 from ..common import (BrokerMetadata, ConsumerCoordinatorNotAvailableError,
                       DefaultKafkaPort, FailedPayloadsError, FetchRequest,
-                      FetchResponse, KafkaUnavailableError,
-                      LeaderUnavailableError, NotCoordinatorForConsumerError,
+                      FetchResponse, FetchSessionIdNotFound,
+                      InvalidFetchSessionEpoch, KafkaUnavailableError,
+                      LeaderUnavailableError, Message,
+                      NotCoordinatorForConsumerError,
                       NotLeaderForPartitionError, OffsetAndMessage,
                       OffsetCommitRequest, OffsetCommitResponse,
                       OffsetFetchRequest, OffsetFetchResponse, OffsetRequest,
@@ -38,7 +41,7 @@ from ..common import (BrokerMetadata, ConsumerCoordinatorNotAvailableError,
                       PartitionUnavailableError, ProduceRequest,
                       ProduceResponse, RequestTimedOutError, TopicAndPartition,
                       TopicMetadata, UnknownTopicOrPartitionError)
-from ..kafkacodec import KafkaCodec, create_message
+from ..kafkacodec import CODEC_ZSTD, KafkaCodec, create_message
 
 log = logging.getLogger(__name__)
 
@@ -299,6 +302,57 @@ class TestKafkaClient(unittest.TestCase):
             self.failUnlessFailure(respD, KafkaUnavailableError))
         self.assertTrue(cbArg[0].check(RequestTimedOutError))
 
+    def test_make_request_to_broker_timers(self):
+        """
+        However many requests are in flight, the client has one timer for
+        their timeouts and one probing the reactor, which stop when the
+        requests complete.
+        """
+        reactor = MemoryReactorClock()
+        client = KafkaClient(hosts='kafka31:9092', reactor=reactor)
+        broker = Mock()
+        ds = [Deferred() for _ in range(100)]
+        broker.makeRequest.side_effect = ds
+        results = [client._make_request_to_broker(broker, i, b'request')
+                   for i in range(100)]
+        self.assertEqual(len(reactor.getDelayedCalls()), 2)
+
+        with patch.object(kclient, 'log') as klog:
+            for _ in range(20):
+                reactor.advance(client.timeout * 0.05)
+            self.assertFalse(klog.error.called)
+
+        for d in ds:
+            d.callback(b'response')
+        self.assertEqual(reactor.getDelayedCalls(), [])
+        self.assertEqual([self.successResultOf(d) for d in results],
+                         [b'response'] * 100)
+
+    def test_deadlines(self):
+        """
+        Deadlines which fall within the same tick expire together, unless
+        they have been removed.
+        """
+        reactor = MemoryReactorClock()
+        expired = []
+        deadlines = _Deadlines(reactor, 1.0)
+        deadlines.add(2.5, partial(expired.append, 'a'))
+        token = deadlines.add(2.0, partial(expired.append, 'b'))
+        reactor.advance(0.7)
+        deadlines.add(2.0, partial(expired.append, 'c'))
+        deadlines.add(0.1, partial(expired.append, 'd'))
+        deadlines.remove(token)
+        self.assertEqual(len(deadlines), 3)
+
+        reactor.advance(0.3)
+        self.assertEqual(expired, ['d'])
+        reactor.advance(1.9)
+        self.assertEqual(expired, ['d'])
+        reactor.advance(0.1)
+        self.assertEqual(sorted(expired), ['a', 'c', 'd'])
+        self.assertEqual(len(deadlines), 0)
+        self.assertEqual(reactor.getDelayedCalls(), [])
+
     @patch('afkak.client.KafkaCodec')
     def test_load_metadata_for_topics(self, kCodec):
         """
@@ -900,7 +954,7 @@ class TestKafkaClient(unittest.TestCase):
         # "send" the results
         for topic, resp in ((T1, resp0), (T2, resp1)):
             brkr, reqs = brkrAndReqsForTopicAndPartition(client, topic)
-            for req in reqs.values():
+            for req in list(reqs.values()):
                 brkr.handleResponse(struct.pack('>i', req.id) + resp)
 
         # check the results
@@ -921,12 +975,12 @@ class TestKafkaClient(unittest.TestCase):
                             1, len(T2), T2.encode(), 1, 0, 7, 20)
         # 'send' the response for T1 request
         brkr, reqs = brkrAndReqsForTopicAndPartition(client, T1)
-        for req in reqs.values():
+        for req in list(reqs.values()):
             brkr.handleResponse(struct.pack('>i', req.id) + resp0)
 
         # cancel the request for T2 request (timeout eailure)
         brkr, reqs = brkrAndReqsForTopicAndPartition(client, T2)
-        for req in reqs.values():
+        for req in list(reqs.values()):
             brkr.cancelRequest(req.id)
 
         # check the result. Should be Failure(FailedPayloadsError)
@@ -1219,6 +1273,30 @@ class TestKafkaClient(unittest.TestCase):
                     req_d, ConsumerCoordinatorNotAvailableError))
             client.close()
 
+    def test_send_produce_request_version(self):
+        """
+        The Produce request version follows the newest message format in the
+        payloads, or Zstandard compression.
+        """
+        client = KafkaClient(hosts='kafka31:9092')
+        cases = [
+            ([create_message(b'v')], 0),
+            ([create_message(b'v'), create_message(b'v', magic=1)], 2),
+            ([Message(2, 0, None, b'v')], 3),
+            ([Message(2, CODEC_ZSTD, None, b'v')], 7),
+        ]
+        for messages, version in cases:
+            with patch.object(client, '_send_broker_aware_request',
+                              return_value=succeed([])) as send:
+                client.send_produce_request(
+                    [ProduceRequest(u'topic', 0, messages)], compression_level=5)
+
+            [(_, encoder, decoder)] = [c[1] for c in send.mock_calls]
+            self.assertEqual(encoder.keywords['api_version'], version)
+            self.assertEqual(encoder.keywords['compression_level'], 5)
+            self.assertEqual(decoder.keywords['api_version'], version)
+        client.close()
+
     def test_send_produce_request(self):
         """
         Test send_produce_request
@@ -1447,6 +1525,479 @@ class TestKafkaClient(unittest.TestCase):
                                                OffsetAndMessage(49, msgs[4])])]
         self.assertEqual(expect, expanded_responses)
 
+    def test_send_fetch_request_decode_threadpool(self):
+        """
+        Fetch responses of at least decode_thread_min_bytes are decoded in
+        the decode_threadpool. Smaller ones are decoded on the reactor
+        thread.
+        """
+        class SyncThreadPool(object):
+            calls = 0
+
+            def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+                self.calls += 1
+                onResult(True, f(*args, **kwargs))
+
+        reactor = MemoryReactorClock()
+        reactor.callFromThread = lambda f, *args, **kwargs: f(*args, **kwargs)
+        pool = SyncThreadPool()
+        client = KafkaClient(hosts='kafka41:9092', reactor=reactor,
+                             decode_threadpool=pool)
+        client.topic_partitions = {u'T1': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', 0): BrokerMetadata(1, 'kafka41', 9092),
+        }
+        ds = [Deferred(), Deferred()]
+        broker = MagicMock()
+        broker.makeRequest.side_effect = ds
+
+        msgs = [create_message(b"v1"), create_message(b"v2")]
+        ms = KafkaCodec._encode_message_set(msgs, offset=7)
+        encoded = struct.pack('>iih2siihqi%ds' % len(ms), 1, 1, 2, b'T1',
+                              1, 0, 0, 9, len(ms), ms)
+
+        for request_d, min_bytes, calls in [(ds[0], len(encoded) + 1, 0),
+                                            (ds[1], len(encoded), 1)]:
+            client.decode_thread_min_bytes = min_bytes
+            with patch.object(KafkaClient, '_get_brokerclient',
+                              return_value=broker):
+                d = client.send_fetch_request([FetchRequest(u'T1', 0, 7, 1024)])
+            request_d.callback(encoded)
+
+            [response] = self.successResultOf(d)
+            self.assertEqual(pool.calls, calls)
+            self.assertEqual(response[:4], (u'T1', 0, 0, 9))
+            self.assertEqual(list(response.messages), [
+                OffsetAndMessage(7, msgs[0]), OffsetAndMessage(8, msgs[1]),
+            ])
+
+    def test_send_fetch_request_max_bytes(self):
+        """
+        A limit on the size of the whole response is sent with Fetch v3.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock())
+        client.topic_partitions = {u'T1': list(range(100))}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', p): BrokerMetadata(1, 'kafka41', 9092)
+            for p in range(100)
+        }
+        request_d = Deferred()
+        broker = MagicMock()
+        broker.makeRequest.return_value = request_d
+        ms = KafkaCodec._encode_message_set([create_message(b"v1")], offset=7)
+        encoded = struct.pack('>iiih2siihqi%ds' % len(ms), 1, 0, 1, 2, b'T1',
+                              1, 0, 0, 9, len(ms), ms)
+
+        with patch.object(KafkaClient, '_get_brokerclient', return_value=broker):
+            d = client.send_fetch_request(
+                [FetchRequest(u'T1', p, 7, 1024 * 1024) for p in range(100)],
+                max_bytes=2 * 1024 * 1024)
+        [(_, request), _] = broker.makeRequest.call_args
+        self.assertEqual(struct.unpack_from('>hh', request), (1, 3))
+        self.assertEqual(struct.unpack_from('>iiii', request, 8 + 2 + 12),
+                         (-1, client.DEFAULT_FETCH_SERVER_WAIT_MSECS,
+                          client.DEFAULT_FETCH_MIN_BYTES, 2 * 1024 * 1024))
+        request_d.callback(encoded)
+
+        [response] = self.successResultOf(d)
+        self.assertEqual(list(response.messages),
+                         [OffsetAndMessage(7, create_message(b"v1"))])
+
+    def test_send_fetch_request_session(self):
+        """
+        Fetches within a session send only the partitions which changed, and
+        start over when the session is lost. The epoch advances only when
+        a response arrives: fetches made meanwhile go outside the session.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock())
+        client.topic_partitions = {u'T1': [0, 1, 2]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', p): BrokerMetadata(1, 'kafka41', 9092)
+            for p in range(3)
+        }
+        broker = MagicMock()
+        ds = []
+
+        def makeRequest(requestId, request, expectResponse=True):
+            ds.append(Deferred())
+            return ds[-1]
+
+        broker.makeRequest.side_effect = makeRequest
+
+        def summarize(call):
+            kw = call[1]
+            return [[(p.partition, p.offset) for p in kw['payloads']],
+                    sorted(kw['forgotten']), kw['session_id'],
+                    kw['session_epoch'], kw['api_version']]
+
+        def fetch(offsets, errors=(0,)):
+            """
+            Fetch, and answer each request made with an empty response
+            within session 77, with the next of errors
+            """
+            payloads = [FetchRequest(u'T1', p, o, 1024)
+                        for p, o in sorted(offsets.items())]
+            with patch.object(KafkaClient, '_get_brokerclient',
+                              return_value=broker), \
+                    patch.object(KafkaCodec, 'encode_fetch_request',
+                                 wraps=KafkaCodec.encode_fetch_request) as enc:
+                d = client.send_fetch_request(payloads, session=True)
+                for error in errors:
+                    ds[-1].callback(struct.pack('>iihii', 1, 0, error, 77, 0))
+            return d, [summarize(call) for call in enc.call_args_list]
+
+        d, requests = fetch({0: 10, 1: 20})
+        self.assertEqual(requests, [[[(0, 10), (1, 20)], [], 0, 0, 10]])
+        self.assertEqual(self.successResultOf(d), [])
+
+        d, requests = fetch({0: 11, 1: 20, 2: 5})
+        self.assertEqual(requests, [[[(0, 11), (2, 5)], [], 77, 1, 10]])
+
+        # The session is started over, once.
+        d, requests = fetch({0: 11, 2: 5}, errors=[
+            FetchSessionIdNotFound.errno, InvalidFetchSessionEpoch.errno])
+        self.assertEqual(requests, [
+            [[], [(u'T1', 1)], 77, 2, 10],
+            [[(0, 11), (2, 5)], [], 77, 0, 10],
+        ])
+        self.failureResultOf(d, InvalidFetchSessionEpoch)
+
+        d, requests = fetch({0: 11}, errors=[FetchSessionIdNotFound.errno, 0])
+        self.assertEqual(requests, [
+            [[(0, 11)], [], 77, 0, 10],
+            [[(0, 11)], [], 77, 0, 10],
+        ])
+        self.assertEqual(self.successResultOf(d), [])
+
+        # While a request is in flight, the next goes outside the session.
+        d1, requests = fetch({0: 12}, errors=[])
+        self.assertEqual(requests, [[[(0, 12)], [], 77, 1, 10]])
+        request_d = ds[-1]
+        d2, requests = fetch({0: 12})
+        self.assertEqual(requests, [[[(0, 12)], [], 0, -1, 10]])
+        self.assertEqual(self.successResultOf(d2), [])
+        request_d.callback(struct.pack('>iihii', 1, 0, 0, 77, 0))
+        self.assertEqual(self.successResultOf(d1), [])
+
+        d, requests = fetch({0: 13})
+        self.assertEqual(requests, [[[(0, 13)], [], 77, 2, 10]])
+
+        # A failed request starts the session over.
+        d, requests = fetch({0: 13}, errors=[])
+        ds[-1].errback(ConnectionLost())
+        self.failureResultOf(d, FailedPayloadsError)
+        client.topic_partitions = {u'T1': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', 0): BrokerMetadata(1, 'kafka41', 9092),
+        }
+        d, requests = fetch({0: 13})
+        self.assertEqual(requests, [[[(0, 13)], [], 77, 0, 10]])
+
+    @patch('afkak.client._KafkaBrokerClient')
+    def test_send_fetch_request_fetch_connections(self, brokerclient):
+        """
+        Fetches go on their own connections to the broker, the least busy
+        first, and other requests on the main one. Only the main one's
+        disconnection resets the metadata. All are closed together.
+        """
+        def make_brokerclient(reactor, host, port, clientId, subscriber,
+                              maxInFlight):
+            broker = MagicMock(host=host, port=port, requests={},
+                               subscriber=subscriber)
+
+            def makeRequest(requestId, request, expectResponse=True):
+                broker.requests[requestId] = request
+                return Deferred()
+
+            broker.makeRequest.side_effect = makeRequest
+            broker.close.return_value = succeed(None)
+            return broker
+
+        brokerclient.side_effect = make_brokerclient
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock(),
+                             fetch_connections=2)
+        client.topic_partitions = {u'T1': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', 0): BrokerMetadata(1, 'kafka41', 9092),
+        }
+
+        client.send_fetch_request([FetchRequest(u'T1', 0, 7, 1024)])
+        client.send_fetch_request([FetchRequest(u'T1', 0, 7, 1024)])
+        client.send_offset_request([OffsetRequest(u'T1', 0, -1, 1)])
+
+        main = client.clients[('kafka41', 9092)]
+        fetch1, fetch2 = client._fetch_clients[('kafka41', 9092)]
+        self.assertEqual(main.makeRequest.call_count, 1)
+        self.assertEqual(fetch1.makeRequest.call_count, 1)
+        self.assertEqual(fetch2.makeRequest.call_count, 1)
+
+        client._api_versions[fetch1] = {1: (0, 11)}
+        fetch1.subscriber(fetch1, False, Failure(ConnectionLost()))
+        self.assertEqual(client._api_versions, {})
+        self.assertIn(TopicAndPartition(u'T1', 0), client.topics_to_brokers)
+        with patch.object(client, 'load_metadata_for_topics'):
+            main.subscriber(main, False, Failure(ConnectionLost()))
+        self.assertEqual(client.topics_to_brokers, {})
+
+        client.close()
+        for broker in (main, fetch1, fetch2):
+            broker.close.assert_called_once_with()
+        self.assertEqual(client._fetch_clients, {})
+
+    def test_send_fetch_request_partition_callback(self):
+        """
+        The partition callback is passed each partition as soon as it has
+        arrived, once, even if the response is started over, whether the
+        response arrives whole or in pieces.
+        """
+        reactor = MemoryReactorClock()
+        client = KafkaClient(hosts='kafka41:9092', reactor=reactor)
+        client.topic_partitions = {u'T1': [0, 1]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', p): BrokerMetadata(1, 'kafka41', 9092)
+            for p in range(2)
+        }
+        ms1 = KafkaCodec._encode_message_set([create_message(b"v1")], offset=3)
+        ms2 = KafkaCodec._encode_message_set([create_message(b"v2")], offset=7)
+        body = struct.pack(
+            '>ih2siihqi%dsihqi%ds' % (len(ms1), len(ms2)),
+            1, 2, b'T1', 2, 0, 0, 10, len(ms1), ms1, 1, 0, 20, len(ms2), ms2)
+        # Where partition 0 ends in a frame
+        part0_end = 4 + 34 + len(ms1)
+        expected = [(0, [(3, create_message(b"v1"))]),
+                    (1, [(7, create_message(b"v2"))])]
+        with patch.object(_KafkaBrokerClient, '_connect'):
+            broker = client._get_brokerclient('kafka41', 9092)
+
+        def connect():
+            proto = broker.buildProtocol(None)
+            proto.makeConnection(StringTransport())
+            reactor.advance(0)
+            return proto
+
+        def fetch():
+            partitions = []
+
+            def partition_callback(response):
+                partitions.append((response.partition,
+                                   list(response.messages)))
+                raise Exception('Logged and ignored')
+
+            d = client.send_fetch_request(
+                [FetchRequest(u'T1', 0, 3, 1024),
+                 FetchRequest(u'T1', 1, 7, 1024)],
+                partition_callback=partition_callback)
+            [requestId] = broker.requests
+            frame = struct.pack('>ii', 4 + len(body), requestId) + body
+            return d, frame, partitions
+
+        def check(d, partitions):
+            self.assertEqual(partitions, expected)
+            responses = self.successResultOf(d)
+            self.assertEqual([(r.partition, list(r.messages))
+                              for r in responses], expected)
+
+        proto = connect()
+
+        # The response arrives whole.
+        d, frame, partitions = fetch()
+        proto.dataReceived(frame)
+        check(d, partitions)
+
+        # The response arrives in pieces, the last of which completes it.
+        d, frame, partitions = fetch()
+        proto.dataReceived(frame[:20])
+        self.assertEqual(partitions, [])
+        proto.dataReceived(frame[20:part0_end + 10])
+        self.assertEqual(partitions, expected[:1])
+        proto.dataReceived(frame[part0_end + 10:])
+        check(d, partitions)
+
+        # The connection is lost once partition 0 has arrived, and the
+        # response starts over.
+        d, frame, partitions = fetch()
+        proto.dataReceived(frame[:part0_end])
+        self.assertEqual(partitions, expected[:1])
+        with patch.object(KafkaClient, 'load_metadata_for_topics',
+                          return_value=Deferred()):
+            broker.clientConnectionLost(Mock(), Failure(ConnectionLost()))
+            proto = connect()
+        proto.dataReceived(frame)
+        check(d, partitions)
+
+    def test_wait_for_capacity(self):
+        """
+        wait_for_capacity() fires once the connections to the leaders of the
+        payloads' partitions have room for a request.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock(),
+                             max_in_flight=1)
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', 0): BrokerMetadata(1, 'kafka41', 9092),
+            TopicAndPartition(u'T1', 1): BrokerMetadata(1, 'kafka41', 9092),
+            TopicAndPartition(u'T2', 0): None,
+        }
+        payloads = [ProduceRequest(u'T1', 0, []),
+                    ProduceRequest(u'T1', 1, []),
+                    ProduceRequest(u'T2', 0, [])]
+        self.assertIsNone(self.successResultOf(
+            client.wait_for_capacity(payloads)))
+
+        with patch.object(_KafkaBrokerClient, '_connect'):
+            broker = client._get_brokerclient('kafka41', 9092)
+        self.assertEqual(broker.maxInFlight, 1)
+        broker.proto = Mock()
+        request_d = broker.makeRequest(1, b'request')
+        d = client.wait_for_capacity(payloads)
+        self.assertNoResult(d)
+
+        broker.handleResponse(struct.pack('>i', 1))
+        self.successResultOf(request_d)
+        self.assertIsNone(self.successResultOf(d))
+
+        # A cancelled wait gives up its place.
+        request_d = broker.makeRequest(2, b'request')
+        d = client.wait_for_capacity(payloads)
+        d.cancel()
+        self.failureResultOf(d, t_CancelledError)
+        self.assertEqual(broker._roomWaiters, [])
+        broker.handleResponse(struct.pack('>i', 2))
+        self.successResultOf(request_d)
+
+    def test_send_fetch_request_negotiated(self):
+        """
+        A client which negotiates API versions asks each broker which it
+        supports, once, and fetches with the newest it can.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock(),
+                             negotiate_api_versions=True)
+        client.topic_partitions = {u'T1': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', 0): BrokerMetadata(1, 'kafka41', 9092),
+        }
+        broker = MagicMock(host='kafka41', port=9092)
+        ds = [Deferred(), Deferred(), Deferred()]
+        broker.makeRequest.side_effect = ds
+        ms = KafkaCodec._encode_message_set([create_message(b"v1")], offset=7)
+        encoded = struct.pack('>iiih2siihqqii%ds' % len(ms), 2, 0, 1, 2, b'T1',
+                              1, 0, 0, 9, 9, 0, len(ms), ms)
+
+        with patch.object(KafkaClient, '_get_brokerclient', return_value=broker), \
+                patch.object(kclient, 'has_crc32c', return_value=True):
+            d = client.send_fetch_request([FetchRequest(u'T1', 0, 7, 1024)])
+        [(_, request), _] = broker.makeRequest.call_args_list[0]
+        self.assertEqual(struct.unpack_from('>hh', request), (18, 0))
+        ds[0].callback(struct.pack('>ihihhhhhh', 1, 0, 2, 0, 0, 7, 1, 0, 5))
+        [(_, request), _] = broker.makeRequest.call_args_list[1]
+        self.assertEqual(struct.unpack_from('>hh', request), (1, 4))
+        ds[1].callback(encoded)
+        [response] = self.successResultOf(d)
+        self.assertEqual(list(response.messages),
+                         [OffsetAndMessage(7, create_message(b"v1"))])
+
+        # The versions are remembered until the broker disconnects.
+        with patch.object(KafkaClient, '_get_brokerclient', return_value=broker):
+            client.send_fetch_request([FetchRequest(u'T1', 0, 8, 1024)])
+        self.assertEqual(broker.makeRequest.call_count, 3)
+        with patch.object(client, 'load_metadata_for_topics'):
+            client._update_broker_state(broker, False, None)
+        self.assertEqual(client._api_versions, {})
+
+    def test_send_fetch_request_negotiated_no_crc32c(self):
+        """
+        Without the crc32c package, fetches aren't negotiated to versions
+        which return message format v2, and the client warns about it.
+        """
+        with patch.object(kclient, 'has_crc32c', return_value=False), \
+                patch.object(kclient, 'log') as log:
+            client = KafkaClient(hosts='kafka41:9092',
+                                 reactor=MemoryReactorClock(),
+                                 negotiate_api_versions=True)
+        self.assertEqual(log.warning.call_count, 1)
+        client.topic_partitions = {u'T1': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition(u'T1', 0): BrokerMetadata(1, 'kafka41', 9092),
+        }
+        broker = MagicMock(host='kafka41', port=9092)
+        client._api_versions[broker] = {1: (0, 11)}
+
+        with patch.object(KafkaClient, '_get_brokerclient', return_value=broker), \
+                patch.object(kclient, 'has_crc32c', return_value=False):
+            client.send_fetch_request([FetchRequest(u'T1', 0, 7, 1024)])
+            client.send_fetch_request([FetchRequest(u'T1', 0, 7, 1024)],
+                                      api_version=4)
+        [(_, request), _] = broker.makeRequest.call_args_list[0]
+        self.assertEqual(struct.unpack_from('>hh', request), (1, 3))
+        # Asking for message format v2 explicitly still gets it.
+        [(_, request), _] = broker.makeRequest.call_args_list[1]
+        self.assertEqual(struct.unpack_from('>hh', request), (1, 10))
+
+    def test_negotiate_version(self):
+        """
+        The newest version supported by both the broker and KafkaCodec is
+        picked, within the bounds given, or else the oldest allowed.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock(),
+                             negotiate_api_versions=True)
+        broker = Mock(host='kafka41', port=9092)
+        client._api_versions[broker] = {0: (0, 7), 1: (0, 11)}
+
+        for api_key, min_version, max_version, expected in [
+                (0, 0, 2, 2),
+                (0, 3, None, 7),
+                (1, 0, None, 10),
+                (3, 0, None, 0),  # Broker didn't say
+                (1, 12, None, 12),  # Broker too old
+        ]:
+            self.assertEqual(expected, self.successResultOf(
+                client._negotiate_version(broker, api_key, min_version,
+                                          max_version)))
+
+    def test_negotiate_version_failure(self):
+        """
+        When a broker can't say which versions it supports, the oldest
+        allowed is used.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock(),
+                             negotiate_api_versions=True)
+        broker = Mock(host='kafka41', port=9092)
+        request_d = Deferred()
+        broker.makeRequest.return_value = request_d
+
+        d1 = client._negotiate_version(broker, 1, 2, None)
+        d2 = client._negotiate_version(broker, 1, 0, None)
+        self.assertNoResult(d1)
+        with patch.object(kclient, 'log'):
+            request_d.errback(RequestTimedOutError())
+
+        self.assertEqual(self.successResultOf(d1), 2)
+        self.assertEqual(self.successResultOf(d2), 0)
+        self.assertEqual(broker.makeRequest.call_count, 1)
+
+    def test_negotiate_version_failure_remembered(self):
+        """
+        A broker which drops the connection when asked which versions it
+        supports isn't asked again when the client reconnects.
+        """
+        client = KafkaClient(hosts='kafka41:9092', reactor=MemoryReactorClock(),
+                             negotiate_api_versions=True)
+        broker = Mock(host='kafka41', port=9092)
+        request_d = Deferred()
+        broker.makeRequest.return_value = request_d
+
+        d = client._negotiate_version(broker, 1, 2, None)
+        [(_, kwArgs)] = broker.makeRequest.call_args_list
+        self.assertIs(kwArgs['retry'], False)
+        with patch.object(kclient, 'log'):
+            request_d.errback(ConnectionLost())
+        self.assertEqual(self.successResultOf(d), 2)
+        with patch.object(client, 'load_metadata_for_topics'):
+            client._update_broker_state(broker, False, None)
+
+        d = client._negotiate_version(broker, 1, 0, None)
+        self.assertEqual(self.successResultOf(d), 0)
+        self.assertEqual(broker.makeRequest.call_count, 1)
+
     def test_send_fetch_request_bad_timeout(self):
         client = KafkaClient(hosts='kafka41:9092,kafka42:9092')
         payload = [FetchRequest(u'T1', 0, 0, 1024)]
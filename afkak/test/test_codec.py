@@ -11,8 +11,10 @@ from six.moves import reload_module
 
 import afkak
 from afkak.codec import (
-    has_gzip, has_snappy, gzip_encode, gzip_decode,
-    snappy_encode, snappy_decode
+    has_gzip, has_lz4, has_snappy, has_zstd, gzip_encode, gzip_decode,
+    gzip_decode_chunks,
+    lz4_encode, lz4_decode, snappy_encode, snappy_decode,
+    zstd_encode, zstd_decode, _xxh32
 )
 
 
@@ -24,6 +26,36 @@ class TestCodec(unittest.TestCase):
             s2 = gzip_decode(gzip_encode(s1))
             self.assertEqual(s1, s2)
 
+    def test_gzip_levels(self):
+        s1 = b'gzip level' * 1000
+        encoded = [gzip_encode(s1, level) for level in (0, 1, 9)]
+
+        self.assertEqual([gzip_decode(e) for e in encoded], [s1] * 3)
+        self.assertGreater(len(encoded[0]), len(s1))  # Stored, not compressed
+        self.assertLess(len(encoded[2]), len(encoded[1]))
+        self.assertEqual(gzip_encode(s1), encoded[2])
+
+    def test_gzip_decode_chunks(self):
+        s1 = os.urandom(5000) + b'\x00' * 100000
+        chunks = list(gzip_decode_chunks(gzip_encode(s1), 4096))
+
+        self.assertEqual(b''.join(chunks), s1)
+        self.assertLessEqual(max(len(c) for c in chunks), 4096)
+
+    def test_gzip_decode_multiple_members(self):
+        """
+        Like GzipFile, gzip_decode() accepts concatenated members followed
+        by zero padding.
+        """
+        encoded = gzip_encode(b'one') + gzip_encode(b'two') + b'\x00' * 8
+        self.assertEqual(gzip_decode(encoded), b'onetwo')
+        self.assertEqual(gzip_decode(memoryview(encoded)), b'onetwo')
+
+    def test_gzip_decode_truncated(self):
+        encoded = gzip_encode(os.urandom(100))
+        for end in (5, 50, len(encoded) - 1):
+            self.assertRaises(EOFError, gzip_decode, encoded[:end])
+
     @unittest.skipUnless(has_snappy(), "Snappy not available")
     def test_snappy(self):
         for i in range(100):
@@ -63,6 +95,28 @@ class TestCodec(unittest.TestCase):
             to_test, xerial_compatible=True, xerial_blocksize=300)
         self.assertEqual(compressed, to_ensure)
 
+    @unittest.skipUnless(has_snappy(), "Snappy not available")
+    def test_snappy_xerial_memoryview(self):
+        s1 = os.urandom(1000) + b'\x00' * 100000
+        encoded = snappy_encode(memoryview(s1), xerial_compatible=True)
+
+        self.assertEqual(snappy_decode(memoryview(encoded)), s1)
+        self.assertEqual(snappy_decode(memoryview(encoded)[:]), s1)
+
+    @unittest.skipUnless(has_snappy(), "Snappy not available")
+    def test_snappy_without_cramjam(self):
+        """
+        Older python-snappy releases, which aren't built on cramjam, are
+        still supported.
+        """
+        s1 = os.urandom(1000) + b'\x00' * 100000
+        with_cramjam = snappy_encode(s1, xerial_compatible=True)
+        with patch.object(afkak.codec, '_cramjam_snappy', None):
+            encoded = snappy_encode(s1, xerial_compatible=True)
+            self.assertEqual(encoded, with_cramjam)
+            self.assertEqual(snappy_decode(encoded), s1)
+            self.assertEqual(snappy_decode(snappy_encode(s1)), s1)
+
     @unittest.skipUnless(has_snappy(), "Snappy not available")
     def test_snappy_raises_when_not_present(self):
         with patch.object(afkak.codec, 'has_snappy',
@@ -72,6 +126,84 @@ class TestCodec(unittest.TestCase):
             with self.assertRaises(NotImplementedError):
                 snappy_decode(b"Snappy not available")
 
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4(self):
+        for i in range(100):
+            s1 = os.urandom(120)
+            s2 = lz4_decode(lz4_encode(s1))
+            self.assertEqual(s1, s2)
+
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4_frame_header(self):
+        """
+        Frames have independent blocks and no content size, with a header
+        checksum computed over the descriptor, or for old Kafka over the magic
+        number and descriptor.
+        """
+        correct = lz4_encode(b'LZ4' * 50)
+        broken = lz4_encode(b'LZ4' * 50, broken_checksum=True)
+
+        self.assertEqual(correct[:6], b'\x04\x22\x4d\x18\x60\x40')
+        self.assertEqual(correct[6:7], struct.pack('B', _xxh32(correct[4:6]) >> 8 & 0xff))
+        self.assertEqual(broken[6:7], struct.pack('B', _xxh32(correct[:6]) >> 8 & 0xff))
+        self.assertEqual(broken[:6] + broken[7:], correct[:6] + correct[7:])
+
+        self.assertEqual(lz4_decode(broken, broken_checksum=True), b'LZ4' * 50)
+        self.assertEqual(lz4_decode(correct, broken_checksum=True), b'LZ4' * 50)
+        self.assertEqual(lz4_decode(memoryview(bytearray(broken)), broken_checksum=True),
+                         b'LZ4' * 50)
+        self.assertRaises(RuntimeError, lz4_decode, broken)
+        self.assertRaises(RuntimeError, lz4_decode, broken[:-5], broken_checksum=True)
+
+    @unittest.skipUnless(has_zstd(), "Zstandard not available")
+    def test_zstd(self):
+        for level in (None, -1, 1, 3, 19):
+            s1 = os.urandom(60) * 2
+            s2 = zstd_decode(zstd_encode(s1, level))
+            self.assertEqual(s1, s2)
+
+    @unittest.skipUnless(has_zstd(), "Zstandard not available")
+    def test_zstd_decode_streamed_frame(self):
+        """
+        Frames which don't record their decompressed size, like those the
+        Java client writes, can be decoded. Incomplete frames are rejected.
+        """
+        import zstandard
+        compressor = zstandard.ZstdCompressor(write_content_size=False)
+        frame = compressor.compress(b'ZSTD' * 100)
+
+        self.assertEqual(zstd_decode(frame), b'ZSTD' * 100)
+        self.assertEqual(zstd_decode(memoryview(frame)), b'ZSTD' * 100)
+        self.assertRaises(RuntimeError, zstd_decode, frame[:-3])
+
+    def test_zstd_import_fails(self):
+        import sys
+        with patch.dict(sys.modules, values={'zstandard': None}):
+            reload_module(afkak.codec)
+            self.assertFalse(afkak.codec.has_zstd())
+            with self.assertRaises(NotImplementedError):
+                afkak.codec.zstd_encode(b"Zstandard not available")
+            with self.assertRaises(NotImplementedError):
+                afkak.codec.zstd_decode(b"Zstandard not available")
+        reload_module(afkak.codec)
+
+    def test_xxh32(self):
+        self.assertEqual(_xxh32(b''), 0x02CC5D05)
+        self.assertEqual(_xxh32(b'a'), 0x550D7456)
+        self.assertEqual(_xxh32(b'abc'), 0x32D153FF)
+        self.assertRaises(ValueError, _xxh32, b'x' * 16)
+
+    def test_lz4_import_fails(self):
+        import sys
+        with patch.dict(sys.modules, values={'lz4': None, 'lz4.frame': None}):
+            reload_module(afkak.codec)
+            self.assertFalse(afkak.codec.has_lz4())
+            with self.assertRaises(NotImplementedError):
+                afkak.codec.lz4_encode(b"LZ4 not available")
+            with self.assertRaises(NotImplementedError):
+                afkak.codec.lz4_decode(b"LZ4 not available")
+        reload_module(afkak.codec)
+
     def test_snappy_import_fails(self):
         import sys
         with patch.dict(sys.modules, values={'snappy': None}):
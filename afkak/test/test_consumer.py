@@ -19,7 +19,7 @@ from ..common import (KAFKA_SUCCESS, OFFSET_COMMITTED, OFFSET_EARLIEST,
                       OffsetFetchRequest, OffsetFetchResponse,
                       OffsetOutOfRangeError, OffsetRequest, OffsetResponse,
                       OperationInProgress, RestartError, RestopError,
-                      SourcedMessage)
+                      SourcedMessage, UnsupportedCompressionType)
 from ..consumer import FETCH_BUFFER_SIZE_BYTES, Consumer
 from ..kafkacodec import KafkaCodec, create_message
 
@@ -120,7 +120,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest('offset22Topic', 18, 22, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         consumer.stop()
         self.assertEqual(self.successResultOf(d), (None, None))
 
@@ -156,7 +156,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Stop the consumer to cleanup any outstanding operations
         consumer.stop()
         self.assertEqual(self.successResultOf(d), (None, None))
@@ -187,7 +187,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, fetch_offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Stop the consumer to cleanup any outstanding operations
         consumer.stop()
         self.assertEqual(self.successResultOf(d), (None, 2996))
@@ -476,14 +476,14 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Fire a response to the fetch request
         req_ds[0].callback(make_response(offset))
         self.assertEqual(self.successResultOf(start_d), (None, None))
         clock.advance(consumer.retry_max_delay)
         expected_calls = [
             call([request], max_wait_time=consumer.fetch_max_wait_time,
-                 min_bytes=consumer.fetch_min_bytes)]  # Unfixed code makes 2nd req.
+                 min_bytes=consumer.fetch_min_bytes, api_version=0)]  # Unfixed code makes 2nd req.
         self.assertEqual(mockclient.send_fetch_request.mock_calls,
                          expected_calls)
         req_ds[1].callback(make_response(offset + 4))  # Unfixed code hangs here
@@ -585,11 +585,36 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         fetch_fail.trap(KafkaUnavailableError)
         fetch_call = call(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         self.assertEqual(mockclient.send_fetch_request.mock_calls,
                          [fetch_call] * 100)
         consumer.stop()
 
+    def test_consumer_fetch_zstd_upgrade(self):
+        """
+        A message_version=2 consumer switches to Fetch v10 when the broker
+        says its partition holds Zstandard-compressed batches, which older
+        fetch versions can't return.
+        """
+        clock = MemoryReactorClock()
+        mockclient = Mock(reactor=clock)
+        mockclient.send_fetch_request.side_effect = [
+            fail(UnsupportedCompressionType()),
+            Deferred(),
+        ]
+        consumer = Consumer(mockclient, u'topic', 0, Mock(), message_version=2)
+        request = FetchRequest(u'topic', 0, 0, consumer.buffer_size)
+
+        consumer.start(0)
+        clock.advance(0)
+
+        self.assertEqual(mockclient.send_fetch_request.mock_calls, [
+            call([request], max_wait_time=consumer.fetch_max_wait_time,
+                 min_bytes=consumer.fetch_min_bytes, api_version=version)
+            for version in (4, 10)
+        ])
+        consumer.stop()
+
     def test_consumer_stop_during_initial_proc_call(self):
         # processor's deferred
         proc_d = Deferred(Mock())
@@ -615,7 +640,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v9", b"k9"),
@@ -728,7 +753,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -905,6 +930,139 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         consumer.stop()
         self.assertEqual(self.successResultOf(d), (0, None))
 
+    def test_consumer_fetch_large_message_exact(self):
+        """
+        When a message is too large for the fetch size, the next fetch is
+        sized to fit it exactly.
+        """
+        topic = 'fetch_large_message_exact'
+        part = 676
+        clock = MemoryReactorClock()
+        mockclient = Mock(reactor=clock)
+        mockclient.send_fetch_request.side_effect = [Deferred(), Deferred()]
+        consumer = Consumer(mockclient, topic, part, Mock())
+        message_set = KafkaCodec._encode_message_set(
+            [create_message(b'*' * consumer.buffer_size * 9)])
+        consumer.start(0)
+
+        [request] = mockclient.send_fetch_request.call_args[0][0]
+        with patch.object(kconsumer, 'log'):
+            consumer._request_d.callback([FetchResponse(
+                topic, part, KAFKA_SUCCESS, 486,
+                KafkaCodec._decode_message_set_iter(
+                    message_set[:request.max_bytes]))])
+        clock.advance(0.1)
+
+        [request] = mockclient.send_fetch_request.call_args[0][0]
+        self.assertEqual(request.max_bytes, len(message_set))
+        self.assertEqual(consumer.buffer_size, len(message_set))
+        consumer.stop()
+
+    def test_consumer_fetch_partial_message_grows_buffer(self):
+        """
+        When a fetch ends with part of a message which the next fetch
+        wouldn't have room for, the next fetch is sized to fit it.
+        """
+        topic = 'fetch_partial_message'
+        part = 676
+        mock_proc = Mock(return_value=None)
+        clock = MemoryReactorClock()
+        mockclient = Mock(reactor=clock)
+        mockclient.send_fetch_request.side_effect = [Deferred(), Deferred()]
+        consumer = Consumer(mockclient, topic, part, mock_proc)
+        small = create_message(b'v1')
+        first = KafkaCodec._encode_message_set([small], 0)
+        second = KafkaCodec._encode_message_set(
+            [create_message(b'*' * consumer.buffer_size * 2)], 1)
+        consumer.start(0)
+
+        [request] = mockclient.send_fetch_request.call_args[0][0]
+        consumer._request_d.callback([FetchResponse(
+            topic, part, KAFKA_SUCCESS, 486,
+            KafkaCodec._decode_message_set_iter(
+                (first + second)[:request.max_bytes]))])
+        clock.advance(0.1)
+
+        mock_proc.assert_called_once_with(consumer, [
+            SourcedMessage(topic, part, 0, small)])
+        [request] = mockclient.send_fetch_request.call_args[0][0]
+        self.assertEqual((request.offset, request.max_bytes),
+                         (1, len(second)))
+        consumer.stop()
+
+    def test_consumer_fetch_checksum_error(self):
+        """
+        A message whose CRC doesn't match fails the fetch, after the
+        messages before it are delivered, and it is fetched again.
+        """
+        topic = 'fetch_checksum_error'
+        part = 676
+        mock_proc = Mock(return_value=None)
+        clock = MemoryReactorClock()
+        mockclient = Mock(reactor=clock)
+        mockclient.send_fetch_request.side_effect = [Deferred(), Deferred()]
+        consumer = Consumer(mockclient, topic, part, mock_proc)
+        first = create_message(b'v1')
+        corrupt = bytearray(KafkaCodec._encode_message_set(
+            [create_message(b'v2')], 1))
+        corrupt[-1] ^= 0xff
+        message_set = b''.join([
+            KafkaCodec._encode_message_set([first], 0), bytes(corrupt),
+            KafkaCodec._encode_message_set([create_message(b'v3')], 2)])
+        consumer.start(0)
+
+        with patch.object(kconsumer, 'log'):
+            consumer._request_d.callback([FetchResponse(
+                topic, part, KAFKA_SUCCESS, 486,
+                KafkaCodec._decode_message_set_iter(message_set))])
+            clock.advance(consumer.retry_delay)
+
+        mock_proc.assert_called_once_with(consumer, [
+            SourcedMessage(topic, part, 0, first)])
+        [request] = mockclient.send_fetch_request.call_args[0][0]
+        self.assertEqual(request.offset, 1)
+        consumer.stop()
+
+    def test_consumer_fetch_size_decays(self):
+        """
+        Once fetches stop using the room a large message needed, the fetch
+        size shrinks by half at a time, back to its initial size.
+        """
+        topic = 'fetch_size_decays'
+        part = 676
+        clock = MemoryReactorClock()
+        mockclient = Mock(reactor=clock)
+        mockclient.send_fetch_request.side_effect = lambda *a, **kw: Deferred()
+        consumer = Consumer(mockclient, topic, part, Mock(return_value=None),
+                            buffer_size=1024)
+        message_set = KafkaCodec._encode_message_set(
+            [create_message(b'*' * 9000)])
+        consumer.start(0)
+
+        def fetch(data):
+            [request] = mockclient.send_fetch_request.call_args[0][0]
+            consumer._request_d.callback([FetchResponse(
+                topic, part, KAFKA_SUCCESS, 486,
+                KafkaCodec._decode_message_set_iter(data[:request.max_bytes]))])
+            clock.advance(0)
+            return request.max_bytes
+
+        with patch.object(kconsumer, 'log'):
+            self.assertEqual(fetch(message_set), 1024)
+        self.assertEqual(fetch(message_set), len(message_set))
+        for _ in range(15):
+            fetch(b'')
+        self.assertEqual(consumer.buffer_size, len(message_set))
+        fetch(b'')
+        self.assertEqual(consumer.buffer_size, len(message_set) // 2)
+
+        sizes = set()
+        for _ in range(16 * 4):
+            sizes.add(fetch(b''))
+        self.assertEqual(consumer.buffer_size, 1024)
+        self.assertEqual(min(sizes), 1024)
+        consumer.stop()
+
     def test_consumer_fetch_too_large_message(self):
         topic = 'fetch_too_large_message'
         part = 676
@@ -958,7 +1116,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         self.assertEqual(consumer._request_d, reqs_ds[0])
 
         # create & deliver the responses
@@ -993,7 +1151,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
                                consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
 
         # I think _do_fetch() cannot possibly (normally) be called when there's
         # an outstanding request, so force it
@@ -1005,7 +1163,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         # And make sure no additional fetch request was made
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # clean up
         consumer.stop()
         self.assertEqual(self.successResultOf(d), (None, None))
@@ -1022,7 +1180,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
                                consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # The error we'll return
         f = Failure(KafkaUnavailableError())  # Perhaps kafka wasn't up yet...
 
@@ -1195,7 +1353,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest('snpncgTopic', 1, 1, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Shutdown the consumer
         shutdown_d = consumer.shutdown()
         # Ensure the stop was signaled
@@ -1219,7 +1377,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest('snpTopic', 1, 1, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Shutdown the consumer
         shutdown_d = consumer.shutdown()
         # Ensure the stop was signaled
@@ -1253,7 +1411,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -1308,7 +1466,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -1360,7 +1518,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -1413,7 +1571,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -1475,7 +1633,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -1521,7 +1679,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # create & deliver the response
         messages = [
             create_message(b"v1", b"k1"),
@@ -1605,7 +1763,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, fetch_offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Fake the fetch response to trigger the processor call
         # create & deliver the response
         messages = [create_message(b"v1", b"k1")]
@@ -1668,7 +1826,7 @@ class TestAfkakConsumer(unittest.SynchronousTestCase):
         request = FetchRequest(topic, part, offset, consumer.buffer_size)
         mockclient.send_fetch_request.assert_called_once_with(
             [request], max_wait_time=consumer.fetch_max_wait_time,
-            min_bytes=consumer.fetch_min_bytes)
+            min_bytes=consumer.fetch_min_bytes, api_version=0)
         # Stop the consumer to cleanup any outstanding operations
         consumer.stop()
         self.assertEqual(self.successResultOf(d), (None, None))
@@ -9,6 +9,7 @@ Test code for KafkaCodec(object) class.
 from __future__ import division, absolute_import
 
 from contextlib import contextmanager
+import pickle
 import struct
 from unittest import TestCase, SkipTest
 
@@ -23,17 +24,22 @@ from afkak.common import (
     ConsumerFetchSizeTooSmall, ProduceResponse, FetchResponse,
     OffsetAndMessage, BrokerMetadata, PartitionMetadata, TopicMetadata,
     ProtocolError, UnsupportedCodecError, InvalidMessageError,
-    ConsumerMetadataResponse,
+    ConsumerMetadataResponse, FetchSessionIdNotFound, UnsupportedVersion,
+    BufferUnderflowError,
 )
 from afkak.codec import (
-    has_snappy, gzip_decode, snappy_decode
+    has_lz4, has_snappy, gzip_decode, lz4_decode, snappy_decode
 )
 import afkak.kafkacodec
 from afkak.kafkacodec import (
-    ATTRIBUTE_CODEC_MASK, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY,
+    ATTRIBUTE_CODEC_MASK, ATTRIBUTE_TIMESTAMP_LOG_APPEND,
+    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4, CODEC_ZSTD,
     create_message, create_gzip_message, create_snappy_message,
-    create_message_set, KafkaCodec
+    create_lz4_message,
+    create_message_set, KafkaCodec, _check_message
 )
+from afkak.records import EncodedRecordBatch, encode_record_batch
+
 from .testutil import make_send_requests
 
 
@@ -178,10 +184,124 @@ class TestKafkaCodec(TestCase):
         self.assertEqual(returned_offset, offset)
         self.assertEqual(decoded_message, create_message(b"test", b"key"))
 
+    def test_encode_message_v1(self):
+        message = create_message(b"test", b"key", magic=1, timestamp=1234)
+        encoded = KafkaCodec._encode_message(message)
+        expect = b"".join([
+            struct.pack(">i", 1331087195),   # CRC
+            struct.pack(">bb", 1, 0),        # Magic, flags
+            struct.pack(">q", 1234),         # Timestamp
+            struct.pack(">i", 3),            # Length of key
+            b"key",                          # key
+            struct.pack(">i", 4),            # Length of value
+            b"test",                         # value
+        ])
+
+        self.assertEqual(encoded, expect)
+
+    def test_decode_message_v1(self):
+        message = create_message(b"test", b"key", magic=1, timestamp=1234)
+        encoded = KafkaCodec._encode_message(message)
+
+        [(offset, decoded)] = KafkaCodec._decode_message(encoded, 7)
+
+        self.assertEqual(offset, 7)
+        self.assertEqual(decoded.timestamp, 1234)
+        self.assertEqual(decoded, Message(1, 0, b"key", b"test", 1234))
+
+    def test_decode_message_gzip_v1(self):
+        """
+        The inner messages of a magic 1 wrapper have offsets relative to the
+        first, and the wrapper has the offset of the last.
+        """
+        inner = [create_message(v, magic=1, timestamp=t)
+                 for v, t in [(b"v1", 100), (b"v2", 300), (b"v3", 200)]]
+        wrapper = create_gzip_message(inner, magic=1)
+        self.assertEqual(wrapper.magic, 1)
+        self.assertEqual(wrapper.timestamp, 300)
+
+        messages = list(KafkaCodec._decode_message(
+            KafkaCodec._encode_message(wrapper), 12))
+
+        self.assertEqual(messages, [(10, inner[0]), (11, inner[1]), (12, inner[2])])
+
+    def test_decode_message_gzip_v1_log_append_time(self):
+        """
+        The timestamp of a wrapper with the LogAppendTime attribute set
+        applies to all of the messages within it.
+        """
+        inner = [create_message(b"v1", magic=1, timestamp=100)]
+        wrapper = create_gzip_message(inner, magic=1)._replace(
+            attributes=CODEC_GZIP | ATTRIBUTE_TIMESTAMP_LOG_APPEND,
+            timestamp=500)
+
+        [(offset, message)] = KafkaCodec._decode_message(
+            KafkaCodec._encode_message(wrapper), 3)
+
+        self.assertEqual(offset, 3)
+        self.assertEqual(message, Message(1, 0, None, b"v1", 500))
+
+    def test_create_message_set_v1(self):
+        reqs = make_send_requests([b"a", b"b"], key=b"k")
+
+        self.assertEqual(create_message_set(reqs, magic=1, timestamp=42), [
+            Message(1, 0, b"k", b"a", 42),
+            Message(1, 0, b"k", b"b", 42),
+        ])
+
+    def test_create_message_set_v2(self):
+        """
+        Messages for a RecordBatch are compressed together with the batch,
+        not wrapped.
+        """
+        reqs = make_send_requests([b"a", b"b"])
+
+        self.assertEqual(create_message_set(reqs, CODEC_GZIP, magic=2, timestamp=42), [
+            Message(2, CODEC_GZIP, None, b"a", 42),
+            Message(2, CODEC_GZIP, None, b"b", 42),
+        ])
+
+    def test_encode_produce_request_encoded_record_batch(self):
+        """
+        A RecordBatch encoded ahead of time is sent as it is.
+        """
+        messages = [Message(2, CODEC_GZIP, None, b"v", 1)]
+        batch = EncodedRecordBatch.encode(messages, compression_level=1)
+
+        self.assertEqual(batch.attributes, CODEC_GZIP)
+        self.assertEqual(
+            KafkaCodec.encode_produce_request(
+                b"client", 3, [ProduceRequest(u"topic", 0, [batch])],
+                api_version=3),
+            KafkaCodec.encode_produce_request(
+                b"client", 3, [ProduceRequest(u"topic", 0, messages)],
+                api_version=3, compression_level=1))
+
+    def test_create_message_set_gzip_level(self):
+        reqs = make_send_requests([b"gzip level" * 100])
+
+        [fast] = create_message_set(reqs, CODEC_GZIP, compression_level=1)
+        [small] = create_message_set(reqs, CODEC_GZIP, compression_level=9)
+
+        self.assertEqual(gzip_decode(fast.value), gzip_decode(small.value))
+        self.assertLess(len(small.value), len(fast.value))
+
+    def test_create_message_set_zstd_legacy(self):
+        """
+        Kafka only accepts Zstandard compression in RecordBatches.
+        """
+        reqs = make_send_requests([b"a"])
+
+        for magic in (0, 1):
+            self.assertRaises(UnsupportedCodecError, create_message_set,
+                              reqs, CODEC_ZSTD, magic=magic)
+        self.assertEqual(create_message_set(reqs, CODEC_ZSTD, magic=2),
+                         [Message(2, CODEC_ZSTD, None, b"a", None)])
+
     def test_encode_message_failure(self):
         self.assertRaises(ProtocolError,
                           KafkaCodec._encode_message,
-                          Message(1, 0, "key", "test"))
+                          Message(2, 0, b"key", b"test"))
 
     def test_encode_message_set(self):
         message_set = [
@@ -266,6 +386,26 @@ class TestKafkaCodec(TestCase):
         self.assertEqual(returned_offset2, 0)
         self.assertEqual(decoded_message2, create_message(b"v2"))
 
+    def test_decode_message_lz4(self):
+        """
+        LZ4-compressed messages round-trip in both message formats, though
+        the frame header checksum differs between them.
+        """
+        if not has_lz4():
+            raise SkipTest("LZ4 not available")  # pragma: no cover
+        for magic in (0, 1):
+            inner = [create_message(b"v1", magic=magic, timestamp=1),
+                     create_message(b"v2", magic=magic, timestamp=2)]
+            wrapper = create_lz4_message(inner, magic=magic)
+            self.assertEqual(wrapper.attributes, CODEC_LZ4)
+            self.assertEqual(lz4_decode(wrapper.value, broken_checksum=magic == 0),
+                             KafkaCodec._encode_message_set(inner, offset=None if magic == 0 else 0))
+
+            messages = list(KafkaCodec._decode_message(
+                KafkaCodec._encode_message(wrapper), 1))
+
+            self.assertEqual([m for (_, m) in messages], inner)
+
     def test_decode_message_snappy(self):
         if not has_snappy():
             raise SkipTest("Snappy not available")  # pragma: no cover
@@ -292,11 +432,61 @@ class TestKafkaCodec(TestCase):
         iter = KafkaCodec._decode_message(invalid_encoded_message, 0)
         self.assertRaises(ChecksumError, list, iter)
 
+    def test_decode_message_lazy_checksum(self):
+        """
+        The CRC of an uncompressed message isn't checked until its key or
+        value is accessed, or it's checked explicitly.
+        """
+        encoded = b"".join([
+            struct.pack(">i", 1234),  # Bad CRC
+            struct.pack(">bb", 0, 0),  # Magic, flags
+            struct.pack(">i", 3),  # Length of key
+            b"key",  # key
+            struct.pack(">i", 4),  # Length of value
+            b"test",  # value
+        ])
+
+        [(offset, message)] = list(KafkaCodec._decode_message(encoded, 5))
+
+        self.assertEqual(offset, 5)
+        self.assertEqual(message.magic, 0)
+        self.assertEqual(message.attributes, 0)
+        self.assertRaises(ChecksumError, lambda: message.value)
+        self.assertRaises(ChecksumError, lambda: message.key)
+        self.assertRaises(ChecksumError, _check_message, message)
+
+    def test_lazy_message_is_message_like(self):
+        """
+        A lazily decoded message compares, hashes, unpacks and pickles like
+        the equivalent `Message`.
+        """
+        expected = create_message(b"test", b"key")
+        [(_, message)] = list(KafkaCodec._decode_message(
+            KafkaCodec._encode_message(expected), 0))
+
+        self.assertIsInstance(message, Message)
+        self.assertEqual(message, expected)
+        self.assertEqual(expected, message)
+        self.assertEqual(message._replace(key=None),
+                         expected._replace(key=None))
+        magic, attributes, key, value, timestamp = message
+        self.assertEqual((key, value), (b"key", b"test"))
+        self.assertIsNone(message._view)
+        self.assertFalse(message != expected)
+        self.assertNotEqual(message, create_message(b"test", b"other"))
+        self.assertEqual(hash(message), hash(expected))
+        self.assertEqual(tuple(message), tuple(expected))
+        self.assertEqual(message[2], b"key")
+        self.assertEqual(len(message), len(expected))
+        self.assertEqual(repr(message), repr(expected))
+        self.assertEqual(pickle.loads(pickle.dumps(message)), expected)
+        self.assertIs(type(pickle.loads(pickle.dumps(message))), Message)
+
     # NOTE: The error handling in _decode_message_set_iter() is questionable.
     # If it's modified, the next two tests might need to be fixed.
     def test_decode_message_set_fetch_size_too_small(self):
         self.assertRaises(ConsumerFetchSizeTooSmall,
-                          list, KafkaCodec._decode_message_set_iter('a'))
+                          list, KafkaCodec._decode_message_set_iter(b'a'))
 
     def test_decode_message_set_stop_iteration(self):
         encoded = b"".join([
@@ -333,6 +523,198 @@ class TestKafkaCodec(TestCase):
         self.assertEqual(returned_offset2, 1)
         self.assertEqual(decoded_message2, create_message(b"v2", b"k2"))
 
+    def test_decode_message_set_partial_info(self):
+        """
+        Once a MessageSet has been iterated, the decoder reports how much of
+        it was complete, and how large the partial message at its end is.
+        """
+        small = create_message(b"v1")
+        large = create_message(b"v2" * 100)
+        first = KafkaCodec._encode_message_set([small], offset=7)
+        second = KafkaCodec._encode_message_set([large], offset=8)
+        messages = KafkaCodec._decode_message_set_iter(first + second[:30])
+
+        self.assertEqual(list(messages), [OffsetAndMessage(7, small)])
+        self.assertEqual(messages.bytes_consumed, len(first))
+        self.assertEqual(messages.partial_bytes, 30)
+        self.assertEqual(messages.partial_size, len(second))
+        self.assertEqual(messages.next_offset, 8)
+
+        # The size of an entry whose header is cut off isn't known.
+        messages = KafkaCodec._decode_message_set_iter(first + second[:5])
+        self.assertEqual(list(messages), [OffsetAndMessage(7, small)])
+        self.assertEqual(messages.partial_bytes, 5)
+        self.assertIs(messages.partial_size, None)
+
+        # Nor is there any partial entry when the set is complete.
+        messages = KafkaCodec._decode_message_set_iter(first + second)
+        self.assertEqual(len(list(messages)), 2)
+        self.assertEqual(messages.bytes_consumed, len(first + second))
+        self.assertEqual(messages.max_entry_size, len(second))
+        self.assertEqual(
+            (messages.partial_bytes, messages.partial_size), (0, None))
+        self.assertEqual(messages.next_offset, 9)
+
+    def test_decode_message_set_partial_info_too_small(self):
+        """
+        The size of a partial message is known even when the decoder
+        raises because nothing else was received.
+        """
+        message_set = KafkaCodec._encode_message_set(
+            [create_message(b"v" * 100)], offset=3)
+        messages = KafkaCodec._decode_message_set_iter(message_set[:50])
+
+        self.assertRaises(ConsumerFetchSizeTooSmall, list, messages)
+        self.assertEqual(messages.bytes_consumed, 0)
+        self.assertEqual(messages.partial_size, len(message_set))
+        self.assertIs(messages.next_offset, None)
+
+    def test_decode_message_set_chunks(self):
+        """
+        A MessageSet decodes the same however it is split into chunks.
+        """
+        messages = [create_message(b"v1", b"k1"), create_message(b"v2" * 20),
+                    create_message(b"v3", b"k3")]
+        message_set = KafkaCodec._encode_message_set(messages, offset=7)
+        expected = [OffsetAndMessage(7 + i, m) for i, m in enumerate(messages)]
+
+        for size in range(1, len(message_set) + 1):
+            chunks = [message_set[i:i + size]
+                      for i in range(0, len(message_set), size)]
+            self.assertEqual(
+                list(KafkaCodec._decode_message_set_chunks(iter(chunks))),
+                expected)
+
+    def test_decode_message_set_chunks_partial(self):
+        """
+        A trailing partial message is ignored, unless it's all there is.
+        """
+        message_set = KafkaCodec._encode_message_set([
+            create_message(b"v1"), create_message(b"v2")])
+
+        self.assertEqual(
+            list(KafkaCodec._decode_message_set_chunks([message_set[:-1]])),
+            [OffsetAndMessage(0, create_message(b"v1"))])
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            list(KafkaCodec._decode_message_set_chunks([message_set[:20]]))
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            list(KafkaCodec._decode_message_set_chunks([struct.pack('>qi', 0, 1)]))
+
+    def test_decode_message_gzip_streaming(self):
+        """
+        The messages in a magic 0 gzip wrapper are yielded as they are
+        decompressed, rather than after decompressing the whole set.
+        """
+        inner = [create_message(b"v%d" % i) for i in range(10)]
+        encoded = KafkaCodec._encode_message(create_gzip_message(inner))
+        chunks = []
+
+        def gzip_decode_chunks(payload):
+            for chunk in afkak.codec.gzip_decode_chunks(payload, 20):
+                chunks.append(chunk)
+                yield chunk
+
+        with mock.patch.object(afkak.kafkacodec, 'gzip_decode_chunks',
+                               gzip_decode_chunks):
+            messages = KafkaCodec._decode_message(encoded, 0)
+
+            self.assertEqual(next(messages), (0, inner[0]))
+            self.assertEqual(len(chunks), 2)
+            self.assertEqual([m for (_, m) in messages], inner[1:])
+            self.assertEqual(len(b"".join(chunks)), 28 * 10)
+
+    def test_decode_message_set_view(self):
+        """
+        A MessageSet can be decoded from a view into a larger buffer, as
+        happens when decoding a fetch response.
+        """
+        message_set = KafkaCodec._encode_message_set([
+            create_message(b"v1", b"k1"),
+            create_message(b"v2", None),
+        ], offset=7)
+        buf = bytearray(b"junk" + message_set + b"junk")
+        view = memoryview(buf)[4:4 + len(message_set)]
+
+        msgs = list(KafkaCodec._decode_message_set_iter(view))
+
+        self.assertEqual(msgs, [
+            OffsetAndMessage(7, create_message(b"v1", b"k1")),
+            OffsetAndMessage(8, create_message(b"v2", None)),
+        ])
+        # Keys and values are independent of the underlying buffer.
+        buf[:] = b"\x00" * len(buf)
+        self.assertEqual(msgs[0].message.key, b"k1")
+        self.assertIsInstance(msgs[0].message.value, bytes)
+
+    def test_decode_fetch_response_no_copy(self):
+        """
+        The message sets in a fetch response are handed to the MessageSet
+        decoder as views into the response.
+        """
+        ms = KafkaCodec._encode_message_set([create_message(b"v1")])
+        encoded = struct.pack('>iih6siihqi%ds' % len(ms), 4, 1, 6, b"topic1",
+                              1, 0, 0, 10, len(ms), ms)
+
+        with mock.patch.object(KafkaCodec, '_decode_message_set_iter') as m:
+            list(KafkaCodec.decode_fetch_response(encoded))
+
+        [(message_set,), _] = m.call_args
+        self.assertIsInstance(message_set, memoryview)
+        self.assertEqual(message_set.tobytes(), ms)
+
+    def test_decode_fetch_response_buffered(self):
+        """
+        A buffered fetch response's message sets are decompressed up front,
+        and an error is raised after the messages which preceded it.
+        """
+        msgs = [create_message(b"v1"), create_message(b"v2")]
+        ms = bytearray(KafkaCodec._encode_message_set([
+            msgs[0],
+            create_gzip_message([msgs[1]]),
+            create_gzip_message([msgs[1]]),
+        ], offset=0))
+        ms[-1] ^= 0xff  # Corrupt the last message
+        encoded = struct.pack('>iih6siihqi%ds' % len(ms), 4, 1, 6, b"topic1",
+                              1, 0, 0, 10, len(ms), bytes(ms))
+
+        responses = KafkaCodec.decode_fetch_response(encoded, buffered=True)
+
+        self.assertIsInstance(responses, list)
+        [response] = responses
+        with mock.patch.object(afkak.kafkacodec, 'gzip_decode_chunks',
+                               side_effect=AssertionError('not buffered')):
+            self.assertEqual(next(response.messages), (0, msgs[0]))
+            self.assertEqual(next(response.messages), (0, msgs[1]))
+            self.assertRaises(ChecksumError, next, response.messages)
+        self.assertEqual(response.messages.next_offset, 1)
+
+    def test_fetch_response_parser(self):
+        """
+        The parser returns each partition of a fetch response once it has
+        arrived in full.
+        """
+        ms1 = KafkaCodec._encode_message_set([create_message(b"v1")], offset=3)
+        ms2 = KafkaCodec._encode_message_set([create_message(b"v2")], offset=7)
+        encoded = struct.pack(
+            '>iiih2siihqi%dsihqi%dsh2siihqi' % (len(ms1), len(ms2)),
+            4, 0, 2,
+            2, b"T1", 2, 0, 0, 10, len(ms1), ms1, 1, 0, 20, len(ms2), ms2,
+            2, b"T2", 1, 5, 3, -1, 0)
+        # Where each partition is complete
+        ends = [38 + len(ms1), 56 + len(ms1) + len(ms2), len(encoded)]
+
+        parser = KafkaCodec.fetch_response_parser(api_version=1)
+        received = []
+        for i in range(len(encoded) + 1):
+            for response in parser.feed(bytearray(encoded[:i])):
+                received.append((i, response[:4], list(response.messages)))
+
+        self.assertEqual(received, [
+            (ends[0], (u"T1", 0, 0, 10), [(3, create_message(b"v1"))]),
+            (ends[1], (u"T1", 1, 0, 20), [(7, create_message(b"v2"))]),
+            (ends[2], (u"T2", 5, 3, -1), []),
+        ])
+
     def test_get_response_correlation_id(self):
         t1 = b"topic1"
         t2 = b"topic2"
@@ -399,6 +781,74 @@ class TestKafkaCodec(TestCase):
             b"client1", 2, requests, 2, 100)
         self.assertIn(encoded, [expected1, expected2])
 
+    def test_encode_produce_request_v2(self):
+        message = create_message(b"a", magic=1, timestamp=5)
+        msg_binary = KafkaCodec._encode_message(message)
+
+        encoded = KafkaCodec.encode_produce_request(
+            b"client1", 2, [ProduceRequest(u"topic1", 0, [message])], 1, 100,
+            api_version=2)
+
+        self.assertEqual(encoded, b"".join([
+            struct.pack('>hhi', 0, 2, 2),        # Produce, v2, Correlation ID
+            struct.pack('>h7s', 7, b"client1"),  # The client ID
+            struct.pack('>hii', 1, 100, 1),      # Acks, Timeout, One topic
+            struct.pack('>h6s', 6, b'topic1'),
+            struct.pack('>ii', 1, 0),            # One partition: 0
+            struct.pack('>i', len(msg_binary) + 12),
+            struct.pack('>qi', 0, len(msg_binary)),
+            msg_binary,
+        ]))
+
+    def test_encode_produce_request_v3(self):
+        messages = [Message(2, 0, None, b"a", 5)]
+        batch = encode_record_batch(messages)
+
+        encoded = KafkaCodec.encode_produce_request(
+            b"client1", 2, [ProduceRequest(u"topic1", 0, messages)], 1, 100,
+            api_version=3)
+
+        self.assertEqual(encoded, b"".join([
+            struct.pack('>hhi', 0, 3, 2),        # Produce, v3, Correlation ID
+            struct.pack('>h7s', 7, b"client1"),  # The client ID
+            struct.pack('>h', -1),               # No transactional ID
+            struct.pack('>hii', 1, 100, 1),      # Acks, Timeout, One topic
+            struct.pack('>h6s', 6, b'topic1'),
+            struct.pack('>ii', 1, 0),            # One partition: 0
+            struct.pack('>i', len(batch)),
+            batch,
+        ]))
+
+    def test_encode_produce_request_bad_version(self):
+        self.assertRaises(ValueError, KafkaCodec.encode_produce_request,
+                          b"client1", 2, [], api_version=9)
+
+    def test_decode_produce_response_v2(self):
+        encoded = b"".join([
+            struct.pack('>ii', 2, 1),           # Correlation ID, One topic
+            struct.pack('>h6s', 6, b"topic1"),
+            struct.pack('>i', 1),               # One partition
+            struct.pack('>ihqq', 0, 0, 10, -1),  # Partition, Error, Offset, LogAppendTime
+            struct.pack('>i', 0),               # Throttle time
+        ])
+
+        responses = list(KafkaCodec.decode_produce_response(encoded, api_version=2))
+
+        self.assertEqual(responses, [ProduceResponse(u"topic1", 0, 0, 10)])
+
+    def test_decode_produce_response_v7(self):
+        encoded = b"".join([
+            struct.pack('>ii', 2, 1),           # Correlation ID, One topic
+            struct.pack('>h6s', 6, b"topic1"),
+            struct.pack('>i', 1),               # One partition
+            struct.pack('>ihqqq', 0, 0, 10, -1, 3),  # Partition, Error, Offset, LogAppendTime, LogStartOffset
+            struct.pack('>i', 0),               # Throttle time
+        ])
+
+        responses = list(KafkaCodec.decode_produce_response(encoded, api_version=7))
+
+        self.assertEqual(responses, [ProduceResponse(u"topic1", 0, 0, 10)])
+
     def test_decode_produce_response(self):
         t1 = "topic1"
         t2 = u"topic2"
@@ -480,6 +930,145 @@ class TestKafkaCodec(TestCase):
                                                OffsetAndMessage(0, msgs[4])])]
         self.assertEqual(expanded_responses, expect)
 
+    def test_decode_fetch_response_v2(self):
+        message = create_message(b"value", magic=1, timestamp=1000)
+        ms = KafkaCodec._encode_message_set([message], offset=4)
+        encoded = b"".join([
+            struct.pack('>iii', 4, 0, 1),       # Correlation ID, Throttle time, One topic
+            struct.pack('>h6s', 6, b"topic1"),
+            struct.pack('>i', 1),               # One partition
+            struct.pack('>ihq', 0, 0, 10),      # Partition, Error, Highwater mark
+            struct.pack('>i', len(ms)), ms,
+        ])
+
+        [response] = KafkaCodec.decode_fetch_response(encoded, api_version=2)
+
+        self.assertEqual(response[:4], (u"topic1", 0, 0, 10))
+        self.assertEqual(list(response.messages), [OffsetAndMessage(4, message)])
+
+    def test_encode_fetch_request_v3(self):
+        encoded = KafkaCodec.encode_fetch_request(
+            b"client1", 3, [FetchRequest(u"topic1", 0, 10, 1024)], 2, 100,
+            api_version=3, max_bytes=4096)
+
+        self.assertEqual(encoded, b"".join([
+            struct.pack('>hhi', 1, 3, 3),        # Fetch, v3, Correlation ID
+            struct.pack('>h7s', 7, b"client1"),  # The client ID
+            struct.pack('>iiii', -1, 2, 100, 4096),  # Replica ID, Max wait, Min bytes, Max bytes
+            struct.pack('>i', 1),                # One topic
+            struct.pack('>h6s', 6, b'topic1'),
+            struct.pack('>iiqi', 1, 0, 10, 1024),  # One partition
+        ]))
+
+    def test_encode_fetch_request_v4(self):
+        encoded = KafkaCodec.encode_fetch_request(
+            b"client1", 3, [FetchRequest(u"topic1", 0, 10, 1024)], 2, 100,
+            api_version=4)
+
+        self.assertEqual(encoded, b"".join([
+            struct.pack('>hhi', 1, 4, 3),        # Fetch, v4, Correlation ID
+            struct.pack('>h7s', 7, b"client1"),  # The client ID
+            struct.pack('>iii', -1, 2, 100),     # Replica ID, Max wait, Min bytes
+            struct.pack('>ib', 0x7fffffff, 0),   # Max bytes, read_uncommitted
+            struct.pack('>i', 1),                # One topic
+            struct.pack('>h6s', 6, b'topic1'),
+            struct.pack('>iiqi', 1, 0, 10, 1024),  # One partition
+        ]))
+
+    def test_decode_fetch_response_v4(self):
+        legacy = create_message(b"old")
+        batch = [Message(2, 0, None, b"new", 1000)]
+        records = b"".join([
+            KafkaCodec._encode_message_set([legacy], offset=4),
+            encode_record_batch(batch, base_offset=5),
+        ])
+        encoded = b"".join([
+            struct.pack('>iii', 4, 0, 1),       # Correlation ID, Throttle time, One topic
+            struct.pack('>h6s', 6, b"topic1"),
+            struct.pack('>i', 1),               # One partition
+            struct.pack('>ihqq', 0, 0, 10, 9),  # Partition, Error, HWM, Last stable offset
+            struct.pack('>iqq', 1, 7, 8),       # One aborted transaction
+            struct.pack('>i', len(records)), records,
+        ])
+
+        [response] = KafkaCodec.decode_fetch_response(encoded, api_version=4)
+
+        self.assertEqual(response[:4], (u"topic1", 0, 0, 10))
+        self.assertEqual(list(response.messages), [
+            OffsetAndMessage(4, legacy),
+            OffsetAndMessage(5, batch[0]),
+        ])
+
+    def test_encode_fetch_request_v10(self):
+        encoded = KafkaCodec.encode_fetch_request(
+            b"client1", 3, [FetchRequest(u"topic1", 0, 10, 1024)], 2, 100,
+            api_version=10)
+
+        self.assertEqual(encoded, b"".join([
+            struct.pack('>hhi', 1, 10, 3),       # Fetch, v10, Correlation ID
+            struct.pack('>h7s', 7, b"client1"),  # The client ID
+            struct.pack('>iii', -1, 2, 100),     # Replica ID, Max wait, Min bytes
+            struct.pack('>ib', 0x7fffffff, 0),   # Max bytes, read_uncommitted
+            struct.pack('>ii', 0, -1),           # No fetch session
+            struct.pack('>i', 1),                # One topic
+            struct.pack('>h6s', 6, b'topic1'),
+            struct.pack('>i', 1),                # One partition
+            struct.pack('>iiqqi', 0, -1, 10, -1, 1024),
+            struct.pack('>i', 0),                # No forgotten topics
+        ]))
+
+    def test_encode_fetch_request_v10_session(self):
+        encoded = KafkaCodec.encode_fetch_request(
+            b"client1", 3, [FetchRequest(u"topic1", 0, 10, 1024)], 2, 100,
+            api_version=10, session_id=123, session_epoch=4,
+            forgotten=[(u"topic2", 1), (u"topic2", 5)])
+
+        self.assertEqual(encoded, b"".join([
+            struct.pack('>hhi', 1, 10, 3),       # Fetch, v10, Correlation ID
+            struct.pack('>h7s', 7, b"client1"),  # The client ID
+            struct.pack('>iii', -1, 2, 100),     # Replica ID, Max wait, Min bytes
+            struct.pack('>ib', 0x7fffffff, 0),   # Max bytes, read_uncommitted
+            struct.pack('>ii', 123, 4),          # Session ID and epoch
+            struct.pack('>i', 1),                # One topic
+            struct.pack('>h6s', 6, b'topic1'),
+            struct.pack('>i', 1),                # One partition
+            struct.pack('>iiqqi', 0, -1, 10, -1, 1024),
+            struct.pack('>i', 1),                # One forgotten topic
+            struct.pack('>h6s', 6, b'topic2'),
+            struct.pack('>iii', 2, 1, 5),        # Two forgotten partitions
+        ]))
+
+    def test_decode_fetch_session(self):
+        self.assertEqual(
+            KafkaCodec.decode_fetch_session(struct.pack('>iihii', 4, 0, 70, 9, 0)),
+            (70, 9))
+        with self.assertRaises(BufferUnderflowError):
+            KafkaCodec.decode_fetch_session(b'\x00' * 13)
+
+    def test_decode_fetch_response_v10(self):
+        batch = [Message(2, 0, None, b"new", 1000)]
+        records = encode_record_batch(batch, base_offset=5)
+        encoded = b"".join([
+            struct.pack('>iihi', 4, 0, 0, 0),   # Correlation ID, Throttle time, Error, Session ID
+            struct.pack('>i', 1),               # One topic
+            struct.pack('>h6s', 6, b"topic1"),
+            struct.pack('>i', 1),               # One partition
+            struct.pack('>ihqqq', 0, 0, 10, 9, 0),  # Partition, Error, HWM, LSO, Log start offset
+            struct.pack('>i', 0),               # No aborted transactions
+            struct.pack('>i', len(records)), records,
+        ])
+
+        [response] = KafkaCodec.decode_fetch_response(encoded, api_version=10)
+
+        self.assertEqual(response[:4], (u"topic1", 0, 0, 10))
+        self.assertEqual(list(response.messages), [OffsetAndMessage(5, batch[0])])
+
+    def test_decode_fetch_response_v10_error(self):
+        encoded = struct.pack('>iihii', 4, 0, 70, 0, 0)  # FETCH_SESSION_ID_NOT_FOUND, no topics
+
+        with self.assertRaises(FetchSessionIdNotFound):
+            list(KafkaCodec.decode_fetch_response(encoded, api_version=10))
+
     def test_encode_metadata_request_no_topics(self):
         expected = b"".join([
             struct.pack('>h', 3),           # API key metadata fetch
@@ -737,6 +1326,36 @@ class TestKafkaCodec(TestCase):
                                 error=0, metadata=b"meta"),
         ]))
 
+    def test_encode_api_versions_request(self):
+        self.assertEqual(
+            KafkaCodec.encode_api_versions_request(b"cid", 4),
+            struct.pack(">hhih3s", 18, 0, 4, 3, b"cid"))
+
+    def test_decode_api_versions_response(self):
+        encoded = b"".join([
+            struct.pack(">i", 4),          # Correlation ID
+            struct.pack(">h", 0),          # No error
+            struct.pack(">i", 2),          # Two APIs
+            struct.pack(">hhh", 0, 0, 7),  # Produce v0-7
+            struct.pack(">hhh", 1, 0, 11),  # Fetch v0-11
+        ])
+
+        self.assertEqual(KafkaCodec.decode_api_versions_response(encoded),
+                         {0: (0, 7), 1: (0, 11)})
+        with self.assertRaises(UnsupportedVersion):
+            KafkaCodec.decode_api_versions_response(
+                struct.pack(">ihi", 4, UnsupportedVersion.errno, 0))
+
+    def test_supported_versions(self):
+        self.assertEqual(KafkaCodec.supported_versions(KafkaCodec.FETCH_KEY),
+                         [0, 1, 2, 3, 4, 10])
+        self.assertEqual(
+            KafkaCodec.supported_versions(KafkaCodec.PRODUCE_KEY),
+            list(range(8)))
+        self.assertEqual(
+            KafkaCodec.supported_versions(KafkaCodec.OFFSET_COMMIT_KEY), [1])
+        self.assertEqual(KafkaCodec.supported_versions(42), [])
+
     @contextmanager
     def mock_create_message_fns(self):
         p1 = mock.patch.object(afkak.kafkacodec, "create_message",
@@ -745,7 +1364,9 @@ class TestKafkaCodec(TestCase):
                                return_value=sentinel.gzip_message)
         p3 = mock.patch.object(afkak.kafkacodec, "create_snappy_message",
                                return_value=sentinel.snappy_message)
-        with p1, p2, p3:
+        p4 = mock.patch.object(afkak.kafkacodec, "create_lz4_message",
+                               return_value=sentinel.lz4_message)
+        with p1, p2, p3, p4:
             yield
 
     def test_create_message_set(self):
@@ -776,6 +1397,12 @@ class TestKafkaCodec(TestCase):
             message_set = create_message_set(reqs, CODEC_SNAPPY)
         self.assertEqual(message_set, expect)
 
+        # CODEC_LZ4: Expect list of one LZ4-encoded message.
+        expect = [sentinel.lz4_message]
+        with self.mock_create_message_fns():
+            message_set = create_message_set(reqs, CODEC_LZ4)
+        self.assertEqual(message_set, expect)
+
         # Unknown codec should raise UnsupportedCodecError.
         self.assertRaises(UnsupportedCodecError,
                           create_message_set, reqs, -1)
@@ -21,13 +21,23 @@ from ..common import (PRODUCER_ACK_NOT_REQUIRED, BrokerNotAvailableError,
                       NotLeaderForPartitionError, OffsetOutOfRangeError,
                       ProduceRequest, ProduceResponse,
                       UnknownTopicOrPartitionError, UnsupportedCodecError)
-from ..kafkacodec import create_message_set
+from ..kafkacodec import CODEC_GZIP, CODEC_ZSTD, create_message_set
 from ..producer import Producer
+from ..records import EncodedRecordBatch, encode_record_batch
 from .testutil import make_send_requests, random_string
 
 log = logging.getLogger(__name__)
 
 
+def mock_client(reactor):
+    """
+    Make a mock `KafkaClient` which always has capacity for a request
+    """
+    client = Mock(reactor=reactor)
+    client.wait_for_capacity.side_effect = lambda payloads: succeed(None)
+    return client
+
+
 class ProducerSendMessagesValidationTests(unittest.SynchronousTestCase):
     """
     Test the validation `afkak.producer.Producer.send_messages()` applies to
@@ -36,7 +46,7 @@ class ProducerSendMessagesValidationTests(unittest.SynchronousTestCase):
     :ivar producer: `Producer` with default arguments.
     """
     def setUp(self):
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         self.producer = Producer(client)
         self.addCleanup(self.producer.stop)
 
@@ -120,7 +130,7 @@ class TestAfkakProducer(unittest.TestCase):
         producer.stop()
 
     def test_producer_init_batch(self):
-        producer = Producer(Mock(reactor=MemoryReactorClock()), batch_send=True)
+        producer = Producer(mock_client(MemoryReactorClock()), batch_send=True)
         looper = producer.sendLooper
         self.assertEqual(type(looper), LoopingCall)
         self.assertTrue(looper.running)
@@ -141,7 +151,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages(self):
         first_part = 23
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         ret = Deferred()
         client.send_produce_request.return_value = ret
         client.topic_partitions = {self.topic: [first_part, 101, 102, 103]}
@@ -157,7 +167,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, first_part, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         # Check results when "response" fires
         self.assertNoResult(d)
         resp = [ProduceResponse(self.topic, first_part, 0, 10)]
@@ -166,13 +176,215 @@ class TestAfkakProducer(unittest.TestCase):
         self.assertEqual(result, resp[0])
         producer.stop()
 
+    def test_producer_waits_for_capacity(self):
+        """
+        The producer doesn't send a batch until the client has room for the
+        request on the leader's connection.
+        """
+        client = mock_client(MemoryReactorClock())
+        room = Deferred()
+        client.wait_for_capacity.side_effect = [room]
+        client.send_produce_request.return_value = Deferred()
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        msgs = [self.msg("one")]
+
+        producer = Producer(client)
+        d = producer.send_messages(self.topic, msgs=msgs)
+        req = ProduceRequest(self.topic, 0, create_message_set(
+            make_send_requests(msgs), producer.codec))
+        client.wait_for_capacity.assert_called_once_with([req])
+        self.assertFalse(client.send_produce_request.called)
+
+        room.callback(None)
+        client.send_produce_request.assert_called_once_with(
+            [req], acks=producer.req_acks, timeout=producer.ack_timeout,
+            fail_on_error=False, compression_level=None)
+        self.assertNoResult(d)
+        producer.stop()
+        self.failureResultOf(d, tid_CancelledError)
+
+    def test_producer_stop_waiting_for_capacity(self):
+        """
+        A producer stopped while it waits for the client to have room for
+        a batch cancels the wait, and doesn't send the batch.
+        """
+        client = mock_client(MemoryReactorClock())
+        room_canceller = Mock()
+        room = Deferred(room_canceller)
+        client.wait_for_capacity.side_effect = [room]
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+
+        producer = Producer(client)
+        d = producer.send_messages(self.topic, msgs=[self.msg("one")])
+        self.assertTrue(client.wait_for_capacity.called)
+        producer.stop()
+        room_canceller.assert_called_once_with(room)
+        self.assertIsNone(self.successResultOf(d))
+        self.assertFalse(client.send_produce_request.called)
+
+    def test_producer_compression_threadpool(self):
+        """
+        With a compression_threadpool, message sets of at least
+        compression_thread_min_bytes are compressed in the pool. Magic 2
+        messages are encoded as a RecordBatch there too.
+        """
+        class SyncThreadPool(object):
+            calls = 0
+
+            def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+                self.calls += 1
+                onResult(True, f(*args, **kwargs))
+
+        reactor = MemoryReactorClock()
+        reactor.callFromThread = lambda f, *args, **kwargs: f(*args, **kwargs)
+        client = mock_client(reactor)
+        ds = [Deferred(), Deferred()]
+        client.send_produce_request.side_effect = ds
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        pool = SyncThreadPool()
+        msgs = [self.msg("one"), self.msg("two")]
+
+        producer = Producer(client, codec=CODEC_GZIP, message_version=2,
+                            compression_level=1, compression_threadpool=pool)
+        resp = ProduceResponse(self.topic, 0, 0, 10)
+        producer.compression_thread_min_bytes = sum(len(m) for m in msgs) + 1
+        d = producer.send_messages(self.topic, msgs=msgs)
+        self.assertEqual(pool.calls, 0)
+        ds[0].callback([resp])
+        self.assertEqual(self.successResultOf(d), resp)
+
+        producer.compression_thread_min_bytes = sum(len(m) for m in msgs)
+        d = producer.send_messages(self.topic, msgs=msgs)
+        self.assertEqual(pool.calls, 1)
+        ds[1].callback([resp])
+        self.assertEqual(self.successResultOf(d), resp)
+
+        expected = [EncodedRecordBatch(CODEC_GZIP, encode_record_batch(
+            create_message_set(make_send_requests(msgs), CODEC_GZIP, 2, 0),
+            compression_level=1))]
+        for (payloads,), _ in client.send_produce_request.call_args_list:
+            self.assertEqual(payloads, [ProduceRequest(self.topic, 0, expected)])
+        producer.stop()
+
+    def test_producer_compression_threadpool_stop(self):
+        """
+        A producer stopped while a batch is compressed in the pool doesn't
+        send it once the compression is done.
+        """
+        class ThreadPool(object):
+            def __init__(self):
+                self.calls = []
+
+            def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+                self.calls.append(lambda: onResult(True, f(*args, **kwargs)))
+
+        reactor = MemoryReactorClock()
+        reactor.callFromThread = lambda f, *args, **kwargs: f(*args, **kwargs)
+        client = mock_client(reactor)
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        pool = ThreadPool()
+
+        producer = Producer(client, codec=CODEC_GZIP,
+                            compression_threadpool=pool)
+        producer.compression_thread_min_bytes = 0
+        d = producer.send_messages(self.topic, msgs=[self.msg("one")])
+        self.assertEqual(len(pool.calls), 1)
+        producer.stop()
+        # stop() cancels the outstanding requests, eating the errors
+        self.assertIsNone(self.successResultOf(d))
+
+        pool.calls[0]()
+        self.assertFalse(client.wait_for_capacity.called)
+        self.assertFalse(client.send_produce_request.called)
+
+    def test_producer_compression_failure(self):
+        """
+        The requests whose messages fail to compress fail, and the rest of
+        the batch is sent.
+        """
+        class ThreadPool(object):
+            def callInThreadWithCallback(self, onResult, f, reqs, *args):
+                if any(b'bad' in m for req in reqs for m in req.messages):
+                    onResult(False, Failure(ValueError('bad')))
+                else:
+                    onResult(True, f(reqs, *args))
+
+        reactor = MemoryReactorClock()
+        reactor.callFromThread = lambda f, *args, **kwargs: f(*args, **kwargs)
+        client = mock_client(reactor)
+        client.topic_partitions = {self.topic: [0, 1]}
+        client.metadata_error_for_topic.return_value = False
+        client.wait_for_capacity.return_value = succeed(None)
+        client.send_produce_request.return_value = Deferred()
+
+        producer = Producer(client, codec=CODEC_GZIP, batch_send=True,
+                            batch_every_n=2, batch_every_t=None,
+                            compression_threadpool=ThreadPool())
+        producer.compression_thread_min_bytes = 0
+        bad_d = producer.send_messages(self.topic, msgs=[b'bad'])
+        good_d = producer.send_messages(self.topic, msgs=[b'good'])
+        self.failureResultOf(bad_d, ValueError)
+        self.assertNoResult(good_d)
+        [(payloads,), _] = client.send_produce_request.call_args
+        self.assertEqual(len(payloads), 1)
+        producer.stop()
+        self.failureResultOf(good_d, tid_CancelledError)
+
+    def test_producer_bad_message_version(self):
+        with self.assertRaises(ValueError):
+            Producer(Mock(), message_version=3)
+
+    def test_producer_zstd_requires_message_version_2(self):
+        with self.assertRaises(UnsupportedCodecError):
+            Producer(Mock(), codec=CODEC_ZSTD, message_version=1)
+        Producer(Mock(), codec=CODEC_ZSTD, message_version=2)
+
+    def test_producer_bad_compression_level(self):
+        with self.assertRaises(TypeError):
+            Producer(Mock(), compression_level='high')
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=CODEC_GZIP, compression_level=10)
+        Producer(Mock(), codec=CODEC_GZIP, compression_level=1)
+
+    def test_producer_send_messages_v1(self):
+        """
+        With message_version=1 the producer sends magic 1 messages stamped
+        with the reactor's current time.
+        """
+        first_part = 23
+        client = mock_client(MemoryReactorClock())
+        client.reactor.advance(1234.5678)
+        ret = Deferred()
+        client.send_produce_request.return_value = ret
+        client.topic_partitions = {self.topic: [first_part, 101, 102, 103]}
+        client.metadata_error_for_topic.return_value = False
+        msgs = [self.msg("one"), self.msg("two")]
+
+        producer = Producer(client, message_version=1)
+        d = producer.send_messages(self.topic, msgs=msgs)
+
+        msgSet = create_message_set(
+            make_send_requests(msgs), producer.codec, 1, 1234567)
+        [req] = client.send_produce_request.call_args[0][0]
+        self.assertEqual(req, ProduceRequest(self.topic, first_part, msgSet))
+        self.assertEqual(req.messages[0].magic, 1)
+        self.assertEqual(req.messages[0].timestamp, 1234567)
+        resp = [ProduceResponse(self.topic, first_part, 0, 10)]
+        ret.callback(resp)
+        self.assertEqual(self.successResultOf(d), resp[0])
+        producer.stop()
+
     def test_producer_send_messages_keyed(self):
         """
         Test that messages sent with a key are actually sent with that key
         """
         first_part = 43
         second_part = 56
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         ret1 = Deferred()
         client.send_produce_request.side_effect = [ret1]
         client.topic_partitions = {self.topic: [first_part, second_part, 102]}
@@ -199,7 +411,7 @@ class TestAfkakProducer(unittest.TestCase):
         # Annoying, but order of requests is indeterminate...
         client.send_produce_request.assert_called_once_with(
             ANY, acks=producer.req_acks, timeout=ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         self.assertEqual(sorted([req1, req2]),
                          sorted(client.send_produce_request.call_args[0][0]))
         # Check results when "response" fires
@@ -221,7 +433,7 @@ class TestAfkakProducer(unittest.TestCase):
         """
         first_part = 43
         second_part = 55
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         ret1 = Deferred()
         client.send_produce_request.side_effect = [ret1]
         client.topic_partitions = {self.topic: [first_part, second_part]}
@@ -251,7 +463,7 @@ class TestAfkakProducer(unittest.TestCase):
         # Annoying, but order of requests is indeterminate...
         client.send_produce_request.assert_called_once_with(
             ANY, acks=producer.req_acks, timeout=ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         self.assertEqual(sorted([req1, req2]),
                          sorted(client.send_produce_request.call_args[0][0]))
         # Check results when "response" fires
@@ -271,7 +483,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages_no_acks(self):
         first_part = 19
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         ret = Deferred()
         client.send_produce_request.return_value = ret
         client.topic_partitions = {self.topic: [first_part, 101, 102, 103]}
@@ -288,7 +500,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, first_part, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         # Check results when "response" fires
         self.assertNoResult(d)
         ret.callback([])
@@ -297,7 +509,7 @@ class TestAfkakProducer(unittest.TestCase):
         producer.stop()
 
     def test_producer_send_messages_no_retry_fail(self):
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         f = Failure(BrokerNotAvailableError())
         client.send_produce_request.side_effect = [fail(f)]
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
@@ -312,13 +524,13 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, 0, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=producer.ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         self.failureResultOf(d, BrokerNotAvailableError)
 
         producer.stop()
 
     def test_producer_send_messages_unexpected_err(self):
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         f = Failure(TypeError())
         client.send_produce_request.side_effect = [fail(f)]
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
@@ -336,7 +548,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages_None_for_null_msg(self):
         first_part = 23
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         ret = Deferred()
         client.send_produce_request.return_value = ret
         client.topic_partitions = {self.topic: [first_part, 101, 102, 103]}
@@ -352,7 +564,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, first_part, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         # Check results when "response" fires
         self.assertNoResult(d)
         resp = [ProduceResponse(self.topic, first_part, 0, 10)]
@@ -363,7 +575,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_complete_batch_send_unexpected_error(self):
         # Purely for coverage
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
         client.metadata_error_for_topic.return_value = False
         e = ValueError('test_producer_complete_batch_send_unexpected_error')
@@ -382,7 +594,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages_batched(self):
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         f = Failure(BrokerNotAvailableError())
         ret = [fail(f), succeed([ProduceResponse(self.topic, 0, 0, 10)])]
         client.send_produce_request.side_effect = ret
@@ -399,7 +611,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, ANY, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=producer.ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         # At first, there's no result. Have to retry due to first failure
         self.assertNoResult(d)
         clock.advance(producer._retry_interval)
@@ -424,7 +636,7 @@ class TestAfkakProducer(unittest.TestCase):
                   The (mock) client then "succeeds" the remaining results.
         """
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         topic2 = u'tpsmbps_two'
         client.topic_partitions = {self.topic: [0, 1, 2, 3], topic2: [4, 5, 6]}
         client.metadata_error_for_topic.return_value = False
@@ -475,7 +687,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages_batched_fail(self):
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         ret = [Deferred(), Deferred(), Deferred()]
         client.send_produce_request.side_effect = ret
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
@@ -498,7 +710,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, 0, msgSet)
         produce_request_call = call([req], acks=producer.req_acks,
                                     timeout=producer.ack_timeout,
-                                    fail_on_error=False)
+                                    fail_on_error=False, compression_level=None)
         produce_request_calls = [produce_request_call]
         client.send_produce_request.assert_has_calls(produce_request_calls)
         self.assertNoResult(d)
@@ -534,7 +746,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_cancel_request_in_batch(self):
         # Test cancelling a request before it's begun to be processed
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
         client.metadata_error_for_topic.return_value = False
         msgs = [self.msg("one"), self.msg("two")]
@@ -556,7 +768,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_cancel_request_in_batch_None_for_null_msg(self):
         # Test cancelling a request before it's begun to be processed
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
         client.metadata_error_for_topic.return_value = False
         msgs = [self.msg("one"), self.msg("two")]
@@ -579,7 +791,7 @@ class TestAfkakProducer(unittest.TestCase):
     def test_producer_cancel_getting_topic(self):
         # Test cancelling while waiting to retry getting metadata
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         client.topic_partitions = {}  # start with no metadata
         rets = [Deferred(), Deferred()]
         client.load_metadata_for_topics.side_effect = rets
@@ -617,7 +829,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_cancel_one_request_getting_topic(self):
         # Test cancelling a request after it's begun to be processed
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         client.topic_partitions = {}
         ret = Deferred()
         client.load_metadata_for_topics.return_value = ret
@@ -646,7 +858,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, 1, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=producer.ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
 
         producer.stop()
 
@@ -655,7 +867,7 @@ class TestAfkakProducer(unittest.TestCase):
         Test stopping producer while it's waiting for reply from client
         """
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         f = Failure(BrokerNotAvailableError())
         ret = [fail(f), Deferred()]
         client.send_produce_request.side_effect = ret
@@ -678,7 +890,7 @@ class TestAfkakProducer(unittest.TestCase):
         Test stopping producer while it's waiting to retry a request
         """
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         f = Failure(BrokerNotAvailableError())
         ret = [fail(f)]
         client.send_produce_request.side_effect = ret
@@ -699,7 +911,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages_unknown_topic(self):
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         ds = [Deferred() for _ in range(Producer.DEFAULT_REQ_ATTEMPTS)]
         client.load_metadata_for_topics.side_effect = ds
         client.metadata_error_for_topic.return_value = 3
@@ -725,7 +937,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_messages_bad_response(self):
         first_part = 68
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         ret = Deferred()
         client.send_produce_request.return_value = ret
         client.topic_partitions = {self.topic: [first_part, 101, 102, 103]}
@@ -741,7 +953,7 @@ class TestAfkakProducer(unittest.TestCase):
         req = ProduceRequest(self.topic, first_part, msgSet)
         client.send_produce_request.assert_called_once_with(
             [req], acks=producer.req_acks, timeout=ack_timeout,
-            fail_on_error=False)
+            fail_on_error=False, compression_level=None)
         # Check results when "response" fires
         self.assertNoResult(d)
         ret.callback([])
@@ -756,7 +968,7 @@ class TestAfkakProducer(unittest.TestCase):
         looping call is restarted.
         """
         clock = MemoryReactorClock()
-        client = Mock(reactor=clock)
+        client = mock_client(clock)
         client.topic_partitions = {self.topic: [0, 1, 2, 3]}
         client.metadata_error_for_topic.return_value = False
         batch_t = 5
@@ -783,7 +995,7 @@ class TestAfkakProducer(unittest.TestCase):
 
     def test_producer_send_timer_stopped_error(self):
         # Purely for coverage
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         producer = Producer(client, batch_send=True)
         with patch.object(aProducer, 'log') as klog:
             producer._send_timer_stopped('Borg')
@@ -794,13 +1006,13 @@ class TestAfkakProducer(unittest.TestCase):
         producer.stop()
 
     def test_producer_non_integral_batch_every_n(self):
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         with self.assertRaises(TypeError):
             producer = Producer(client, batch_send=True, batch_every_n="10")
             producer.__repr__()  # pragma: no cover  # STFU pyflakes
 
     def test_producer_non_integral_batch_every_b(self):
-        client = Mock(reactor=MemoryReactorClock())
+        client = mock_client(MemoryReactorClock())
         with self.assertRaises(TypeError):
             producer = Producer(client, batch_send=True, batch_every_b="10")
             producer.__repr__()  # pragma: no cover  # STFU pyflakes
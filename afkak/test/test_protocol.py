@@ -6,7 +6,9 @@ import unittest
 import afkak.protocol
 from afkak.protocol import KafkaProtocol
 from twisted.internet.error import ConnectionLost
+from twisted.protocols.basic import StringTooLongError
 from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactorClock
 
 from mock import MagicMock
 
@@ -18,6 +20,110 @@ class TestProtocol(unittest.TestCase):
         kp.stringReceived("testing")
         kp.factory.handleResponse.assert_called_once_with("testing")
 
+    def test_dataReceived_whole(self):
+        """
+        Strings which arrive whole are passed on as views of the data.
+        """
+        kp = KafkaProtocol()
+        kp.factory = MagicMock()
+        data = b'\x00\x00\x00\x03abc\x00\x00\x00\x00\x00\x00\x00\x02de'
+        kp.dataReceived(data)
+        strings = [c[0][0] for c in kp.factory.handleResponse.call_args_list]
+        self.assertEqual([s.tobytes() for s in strings], [b'abc', b'', b'de'])
+        self.assertIs(strings[0].obj, data)
+
+    def test_dataReceived_chunked(self):
+        """
+        Strings which arrive in pieces, however small, are gathered into
+        a buffer of their length.
+        """
+        kp = KafkaProtocol()
+        kp.factory = MagicMock()
+        data = b'\x00\x00\x00\x05hello\x00\x00\x00\x02hi\x00\x00'
+        for i in range(len(data)):
+            kp.dataReceived(data[i:i + 1])
+        kp.dataReceived(b'\x00\x03bye\x00\x00\x00\x04wo')
+        kp.dataReceived(b'rld')
+        strings = [c[0][0] for c in kp.factory.handleResponse.call_args_list]
+        self.assertEqual([s.tobytes() for s in strings],
+                         [b'hello', b'hi', b'bye', b'worl'])
+        self.assertIsInstance(strings[0].obj, bytearray)
+        # The factory heard about 'worl' as it arrived.
+        [(string, received), _] = kp.factory.handleResponsePart.call_args
+        self.assertIs(string, strings[-1])
+        self.assertEqual(received, 2)
+        # The start of the next length prefix is held on to.
+        self.assertEqual(kp._header, b'd')
+        self.assertIsNone(kp._buffer)
+
+    def test_dataReceived_too_long(self):
+        kp = KafkaProtocol()
+        kp.factory = MagicMock()
+        kp.transport = MagicMock()
+        kp.dataReceived(b'\x80\x00\x00\x00abc')
+        kp.transport.loseConnection.assert_called_once_with()
+        self.assertFalse(kp.factory.handleResponse.called)
+
+    def test_sendString_coalesced(self):
+        """
+        Strings sent during one pass of the reactor are written with a single
+        writeSequence call, without being copied.
+        """
+        kp = KafkaProtocol()
+        kp.factory = MagicMock(clock=MemoryReactorClock())
+        kp.transport = MagicMock()
+        first, second = b'first', b'second request'
+        kp.sendString(first)
+        kp.sendString(second)
+        self.assertFalse(kp.transport.writeSequence.called)
+
+        kp.factory.clock.advance(0)
+        [(sequence,), _] = kp.transport.writeSequence.call_args
+        self.assertEqual(sequence, [b'\x00\x00\x00\x05', first,
+                                    b'\x00\x00\x00\x0e', second])
+        self.assertIs(sequence[1], first)
+        self.assertIs(sequence[3], second)
+
+        kp.sendString(first)
+        kp.factory.clock.advance(0)
+        self.assertEqual(kp.transport.writeSequence.call_count, 2)
+
+    def test_flush(self):
+        """
+        Flushing writes the strings sent so far at once.
+        """
+        kp = KafkaProtocol()
+        kp.factory = MagicMock(clock=MemoryReactorClock())
+        kp.transport = MagicMock()
+        kp.flush()
+        self.assertFalse(kp.transport.writeSequence.called)
+
+        kp.sendString(b'first')
+        kp.sendString(b'second')
+        kp.flush()
+        kp.transport.writeSequence.assert_called_once_with(
+            [b'\x00\x00\x00\x05', b'first', b'\x00\x00\x00\x06', b'second'])
+        self.assertEqual(kp.factory.clock.getDelayedCalls(), [])
+
+    def test_sendString_too_long(self):
+        kp = KafkaProtocol()
+        kp.prefixLength = 1  # Rather than allocate 4 GiB
+        self.assertRaises(StringTooLongError, kp.sendString, b'x' * 256)
+
+    def test_connectionLost_unflushed(self):
+        """
+        Strings which haven't been written when the connection is lost are
+        dropped.
+        """
+        kp = KafkaProtocol()
+        kp.factory = MagicMock(clock=MemoryReactorClock())
+        kp.transport = MagicMock()
+        clock = kp.factory.clock
+        kp.sendString(b'request')
+        kp.connectionLost()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertFalse(kp.transport.writeSequence.called)
+
     def test_connectionLost_cleanly(self):
         kp = KafkaProtocol()
         logsave = afkak.protocol.log
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+
+"""
+Test code for the RecordBatch (message format v2) codec
+"""
+
+from __future__ import absolute_import
+
+import struct
+import unittest
+import warnings
+
+from mock import patch
+
+from afkak.codec import has_lz4, has_snappy, has_zstd, zstd_decode
+from afkak.common import BufferUnderflowError, ChecksumError, Message
+from afkak.kafkacodec import (CODEC_GZIP, CODEC_LZ4, CODEC_SNAPPY, CODEC_ZSTD,
+                              KafkaCodec, create_message)
+from afkak.records import (BATCH_CONTROL, BATCH_TIMESTAMP_LOG_APPEND,
+                           _crc32c_python, crc32c, decode_record_batch,
+                           decode_varint, encode_record_batch, encode_varint)
+
+
+class TestRecords(unittest.TestCase):
+    def test_crc32c(self):
+        # The check value from the CRC catalogue
+        self.assertEqual(crc32c(b'123456789'), 0xE3069283)
+        self.assertEqual(_crc32c_python(b'123456789'), 0xE3069283)
+        self.assertEqual(_crc32c_python(b''), 0)
+
+    def test_crc32c_fallback_warns(self):
+        # Falling back to pure Python isn't silent.
+        with patch('afkak.records._crc32c_native', None), \
+                warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(crc32c(b'123456789'), 0xE3069283)
+        [warning] = caught
+        self.assertIs(warning.category, RuntimeWarning)
+        self.assertIn('crc32c', str(warning.message))
+
+    def test_varint(self):
+        self.assertEqual(encode_varint(0), b'\x00')
+        self.assertEqual(encode_varint(-1), b'\x01')
+        self.assertEqual(encode_varint(1), b'\x02')
+        self.assertEqual(encode_varint(300), b'\xd8\x04')
+        for value in (0, 1, -1, 63, -64, 64, -65, 2 ** 31 - 1, -2 ** 31,
+                      2 ** 63 - 1, -2 ** 63):
+            encoded = encode_varint(value)
+            self.assertEqual(decode_varint(bytearray(encoded), 0),
+                             (value, len(encoded)))
+
+    def test_varint_truncated(self):
+        with self.assertRaises(IndexError):
+            decode_varint(bytearray(b'\xd8'), 0)
+
+    def test_encode_record_batch(self):
+        messages = [
+            Message(2, 0, b'k', b'v1', 1000),
+            Message(2, 0, None, b'v2', 1005),
+        ]
+        encoded = encode_record_batch(messages, base_offset=10)
+
+        (base_offset, length, leader_epoch, magic, crc, attributes,
+         last_offset_delta, first_timestamp, max_timestamp, producer_id,
+         producer_epoch, base_sequence, count) = struct.unpack_from(
+            '>qiibIhiqqqhii', encoded)
+        self.assertEqual((base_offset, length, magic), (10, len(encoded) - 12, 2))
+        self.assertEqual(crc, crc32c(encoded[21:]))
+        self.assertEqual((attributes, last_offset_delta, count), (0, 1, 2))
+        self.assertEqual((first_timestamp, max_timestamp), (1000, 1005))
+        self.assertEqual((producer_id, producer_epoch, base_sequence), (-1, -1, -1))
+        self.assertEqual(encoded[61:], b''.join([
+            b'\x12\x00\x00\x00\x02k\x04v1\x00',  # Length 9, no deltas
+            b'\x10\x00\x0a\x02\x01\x04v2\x00',  # Length 8, deltas 5 & 1, null key
+        ]))
+
+    def test_decode_record_batch(self):
+        messages = [
+            Message(2, 0, b'k', b'v1', 1000),
+            Message(2, 0, None, b'v2', 1005),
+        ]
+        encoded = encode_record_batch(messages, base_offset=10)
+
+        self.assertEqual(list(decode_record_batch(memoryview(encoded))),
+                         [(10, messages[0]), (11, messages[1])])
+
+    def test_decode_record_batch_copies(self):
+        """
+        Keys and values are decoded as bytes, which don't share the buffer
+        the batch was received into.
+        """
+        encoded = encode_record_batch([Message(2, 0, b'k', b'v', 1000)])
+        buf = bytearray(encoded)
+
+        [(_, message)] = decode_record_batch(memoryview(buf))
+        buf[:] = b'\x00' * len(buf)
+
+        self.assertIs(type(message.key), bytes)
+        self.assertIs(type(message.value), bytes)
+        self.assertEqual((message.key, message.value), (b'k', b'v'))
+
+    def test_decode_record_batch_gzip(self):
+        messages = [Message(2, CODEC_GZIP, None, b'v%d' % i, 7) for i in range(10)]
+        encoded = encode_record_batch(messages)
+
+        decoded = list(decode_record_batch(memoryview(encoded)))
+
+        self.assertEqual(decoded, list(enumerate(messages)))
+
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_decode_record_batch_lz4(self):
+        messages = [Message(2, CODEC_LZ4, None, b'v%d' % i, 7) for i in range(10)]
+        encoded = encode_record_batch(messages)
+
+        decoded = list(decode_record_batch(memoryview(encoded)))
+
+        self.assertEqual(decoded, list(enumerate(messages)))
+
+    @unittest.skipUnless(has_snappy(), "Snappy not available")
+    def test_decode_record_batch_snappy(self):
+        messages = [Message(2, CODEC_SNAPPY, None, b'v%d' % i, 7) for i in range(10)]
+        encoded = encode_record_batch(messages)
+
+        decoded = list(decode_record_batch(memoryview(encoded)))
+
+        self.assertEqual(decoded, list(enumerate(messages)))
+
+    @unittest.skipUnless(has_zstd(), "Zstandard not available")
+    def test_record_batch_zstd_level(self):
+        messages = [Message(2, CODEC_ZSTD, None, b'v%d' % i, 7) for i in range(100)]
+        fast = encode_record_batch(messages, compression_level=1)
+        small = encode_record_batch(messages, compression_level=19)
+
+        self.assertEqual(zstd_decode(fast[61:]), zstd_decode(small[61:]))
+        self.assertLess(len(small), len(fast))
+        self.assertEqual(list(decode_record_batch(memoryview(small))),
+                         list(enumerate(messages)))
+
+    def test_decode_record_batch_log_append_time(self):
+        encoded = bytearray(encode_record_batch([Message(2, 0, None, b'v', 5)]))
+        struct.pack_into('>hiqq', encoded, 21, BATCH_TIMESTAMP_LOG_APPEND, 0, 5, 99)
+        struct.pack_into('>I', encoded, 17, crc32c(bytes(encoded[21:])))
+
+        [(_, message)] = decode_record_batch(memoryview(bytes(encoded)))
+
+        self.assertEqual(message.timestamp, 99)
+
+    def test_decode_record_batch_control(self):
+        encoded = bytearray(encode_record_batch([Message(2, 0, None, b'v', 5)]))
+        struct.pack_into('>h', encoded, 21, BATCH_CONTROL)
+        struct.pack_into('>I', encoded, 17, crc32c(bytes(encoded[21:])))
+
+        self.assertEqual(list(decode_record_batch(memoryview(bytes(encoded)))), [])
+
+    def test_decode_record_batch_checksum_error(self):
+        encoded = bytearray(encode_record_batch([Message(2, 0, None, b'v', 5)]))
+        encoded[-2] ^= 0xff
+
+        with self.assertRaises(ChecksumError):
+            list(decode_record_batch(memoryview(bytes(encoded))))
+
+    def test_decode_record_batch_truncated(self):
+        encoded = encode_record_batch([Message(2, 0, None, b'v', 5)])
+
+        with self.assertRaises(BufferUnderflowError):
+            list(decode_record_batch(memoryview(encoded[:40])))
+
+    def test_decode_mixed_message_set(self):
+        """
+        A fetch response may contain legacy messages followed by
+        RecordBatches.
+        """
+        legacy = create_message(b'old')
+        batch = [Message(2, 0, None, b'new1', 1), Message(2, 0, None, b'new2', 1)]
+        data = b''.join([
+            KafkaCodec._encode_message_set([legacy], offset=4),
+            encode_record_batch(batch, base_offset=5),
+        ])
+
+        self.assertEqual(list(KafkaCodec._decode_message_set_iter(data)),
+                         [(4, legacy), (5, batch[0]), (6, batch[1])])
+
+    def test_decode_partial_trailing_batch(self):
+        batch = [Message(2, 0, None, b'v', 1)]
+        data = encode_record_batch(batch) + encode_record_batch(batch, 1)[:-3]
+
+        self.assertEqual(list(KafkaCodec._decode_message_set_iter(data)),
+                         [(0, batch[0])])
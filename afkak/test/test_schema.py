@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Ciena Corporation
+
+import struct
+import unittest
+from collections import namedtuple
+
+from afkak.common import BufferUnderflowError, InvalidMessageError
+from afkak.schema import (Array, Bytes, Int8, Int16, Int32, Int64, ShortBytes,
+                          String, Struct, compile_decoder, compile_encoder)
+
+Partition = namedtuple('Partition', ['partition', 'offset', 'metadata'])
+
+PARTITION = Struct('Partition', [
+    ('partition', Int32),
+    ('offset', Int64),
+    ('metadata', ShortBytes),
+], factory=Partition)
+
+RESPONSE = Struct('Response', [
+    ('correlation_id', Int32),
+    ('flags', Int8),
+    ('topics', Array(Struct('Topic', [
+        ('topic', String),
+        ('partitions', Array(PARTITION)),
+        ('replicas', Array(Int32)),
+    ]))),
+    ('error', Int16),
+    ('payload', Bytes),
+])
+
+ENCODED = b''.join([
+    struct.pack('>ib', 7, 1),
+    struct.pack('>i', 1),  # One topic
+    struct.pack('>h6s', 6, b'topic1'),
+    struct.pack('>i', 2),  # Two partitions
+    struct.pack('>iqh4s', 0, 10, 4, b'meta'),
+    struct.pack('>iqh', 1, 20, -1),
+    struct.pack('>iii', 2, 3, 4),  # Two replicas
+    struct.pack('>h', 5),
+    struct.pack('>i3s', 3, b'abc'),
+])
+
+VALUE = (7, 1, [(u'topic1', [Partition(0, 10, b'meta'), Partition(1, 20, None)], (3, 4))], 5, b'abc')
+
+
+class TestSchema(unittest.TestCase):
+    def test_decode(self):
+        decode = compile_decoder(RESPONSE)
+        value, cur = decode(ENCODED)
+
+        self.assertEqual(cur, len(ENCODED))
+        self.assertEqual(value[:4], VALUE[:4])
+        self.assertIsInstance(value[2][0][1][0], Partition)
+        self.assertIsInstance(value[4], memoryview)
+        self.assertEqual(value[4].tobytes(), b'abc')
+
+    def test_decode_offset(self):
+        decode = compile_decoder(PARTITION)
+        data = b'xx' + struct.pack('>iqh', 1, 2, 0)
+
+        self.assertEqual(decode(data, 2), (Partition(1, 2, b''), len(data)))
+
+    def test_decode_underflow(self):
+        decode = compile_decoder(RESPONSE)
+        for end in range(len(ENCODED)):
+            with self.assertRaises(BufferUnderflowError):
+                decode(ENCODED[:end])
+
+    def test_decode_array_too_long(self):
+        """
+        An array count that can't fit in the remaining data is rejected
+        before any elements are decoded.
+        """
+        decode = compile_decoder(Array(String))
+        with self.assertRaises(BufferUnderflowError):
+            decode(struct.pack('>ih', 0x7fffffff, 0))
+
+    def test_decode_array_max_length(self):
+        decode = compile_decoder(Array(Int32, max_length=1))
+        self.assertEqual(decode(struct.pack('>ii', 1, 9)), ((9,), 8))
+        with self.assertRaises(InvalidMessageError):
+            decode(struct.pack('>iii', 2, 9, 9))
+
+    def test_encode(self):
+        encode = compile_encoder(RESPONSE)
+        self.assertEqual(encode(VALUE), ENCODED)
+
+    def test_encode_append_to(self):
+        encode = compile_encoder(Array(Int16))
+        parts = [b'x']
+        encode.append_to(parts, [1, 2])
+        self.assertEqual(b''.join(parts), b'x' + struct.pack('>ihh', 2, 1, 2))
+
+    def test_encode_type_errors(self):
+        encode = compile_encoder(Struct('S', [('s', String), ('b', ShortBytes)]))
+        self.assertRaises(TypeError, encode, (b'bytes', b''))
+        self.assertRaises(TypeError, encode, (u'text', u'text'))
@@ -111,6 +111,14 @@ def write_short_bytes(b):
 
 
 def read_short_bytes(data, cur):
+    """
+    Read a Kafka short string from *data* at position *cur*.
+
+    :returns:
+        A tuple of the string as :class:`bytes` (``None`` for the null string)
+        and the position following it. The string is copied out when *data* is
+        a :class:`memoryview`.
+    """
     if len(data) < cur + 2:
         raise BufferUnderflowError("Not enough data left")
 
@@ -123,6 +131,8 @@ def read_short_bytes(data, cur):
         raise BufferUnderflowError("Not enough data left")
 
     out = data[cur:cur + strlen]
+    if isinstance(out, memoryview):
+        out = out.tobytes()
     return out, cur + strlen
 
 
@@ -132,6 +142,12 @@ def read_short_ascii(data, cur):
 
 
 def read_int_string(data, cur):
+    """
+    Read a Kafka int32 length-prefixed string from *data* at position *cur*.
+
+    When *data* is a :class:`memoryview` the string returned is a view into it
+    rather than a copy.
+    """
     if len(data) < cur + 4:
         raise BufferUnderflowError(
             "Not enough data left to read string len (%d < %d)" %
@@ -149,13 +165,19 @@ def read_int_string(data, cur):
     return out, cur + strlen
 
 
+_structs = {}
+
+
 def relative_unpack(fmt, data, cur):
-    size = struct.calcsize(fmt)
-    if len(data) < cur + size:
+    try:
+        s = _structs[fmt]
+    except KeyError:
+        s = _structs[fmt] = struct.Struct(fmt)
+    if len(data) < cur + s.size:
         raise BufferUnderflowError("Not enough data left")
 
-    out = struct.unpack(fmt, data[cur:cur + size])
-    return out, cur + size
+    out = s.unpack_from(data, cur)
+    return out, cur + s.size
 
 
 def group_by_topic_and_partition(tuples):
@@ -21,7 +21,10 @@ setup(
     python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, <4',
     extras_require={
         'FastMurmur2': ['Murmur>=0.1.3'],
+        'crc32c': ['crc32c'],
+        'lz4': ['lz4>=1.0'],
         'snappy': ['python-snappy>=0.5'],
+        'zstd': ['zstandard>=0.15'],
     },
 
     packages=find_packages(),